@@ -1,6 +1,6 @@
 nextflow.enable.dsl=2
 
-include { runMACE; calcREF; updateDataset; reTrainMACE } from './processes.nf'
+include { runMACE; calcREF; calcREF_stream; updateDataset; reTrainMACE; dftStreaming } from './processes.nf'
 
 workflow ITERATION_STEP {
     take:
@@ -27,16 +27,26 @@ workflow ITERATION_STEP {
         )
 
         // === DFT Refinement ===
-        calcREF_out = calcREF(
-            file('scripts/prepare_cp2k_farming_jobs.py'),
-            file('scripts/parse_cp2k_farmed_to_extxyz.py'),
-            file('input/template.inp'),
-            mace_out.mace_frames,
-            label_ch
-        )
+        // Streaming starts the CP2K jobs alongside runMACE instead of after it
+        if (dftStreaming()) {
+            calcREF_out = calcREF_stream(
+                file('scripts/cp2k_stream_worker.py'),
+                file('input/template.inp'),
+                label_ch
+            )
+        } else {
+            calcREF_out = calcREF(
+                file('scripts/prepare_cp2k_farming_jobs.py'),
+                file('scripts/parse_cp2k_farmed_to_extxyz.py'),
+                file('input/template.inp'),
+                mace_out.mace_frames,
+                label_ch
+            )
+        }
 
         // === Update dataset ===
         update_out = updateDataset(
+            file('scripts/dataset_store.py'),
             calcREF_out.new_data,
             dataset_ch,
             label_ch
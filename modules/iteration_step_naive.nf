@@ -37,6 +37,7 @@ workflow ITERATION_STEP {
 
         // === Update dataset ===
         update_out = updateDataset(
+            file('scripts/dataset_store.py'),
             calcREF_out.new_data,
             dataset_ch,
             label_ch
@@ -1,5 +1,29 @@
 #!/usr/bin/env nextflow
 
+// With params.dft_streaming (single walker only), runMACE writes the frames
+// accepted by its online filter to this directory as they are accepted and
+// calcREF_stream computes them while MTD is still running.
+def dftStreaming() {
+  params.dft_streaming && (params.mtd_walkers ?: 1) == 1
+}
+
+def dftStreamDir(run_label) {
+  "${workflow.workDir}/dft_stream/${workflow.sessionId}/${run_label}"
+}
+
+// Append-only store of the growing dataset (scripts/dataset_store.py). One
+// store per session under the work directory, so a resumed run continues it
+// and a new run starts again from its initial dataset.
+def datasetStoreDir() {
+  params.dataset_store ?: "${workflow.workDir}/dataset_store/${workflow.sessionId}"
+}
+
+// On-disk store of reference descriptors, shared by the runs of all
+// sessions that use the same work directory.
+def descriptorCacheDir() {
+  params.descriptor_cache ?: "${workflow.workDir}/descriptor_cache"
+}
+
 process runMACE {
   label 'gpu_mace_run'
 
@@ -22,6 +46,11 @@ process runMACE {
 
   script:
     def model_paths_string = model_files.join(' ')
+    def n_walkers = params.mtd_walkers ?: 1
+    def online_filter = (params.mtd_online_filter || dftStreaming()) ? 'true' : 'false'
+    def stream = dftStreaming() ? "--stream_dir ${dftStreamDir(run_label)}" : ''
+    def cv_config = params.mtd_cv_config ? "--cv_config ${params.mtd_cv_config}" : ''
+    def max_segments = params.mtd_max_segments ?: 0
     """
     set -euo pipefail
 
@@ -37,64 +66,103 @@ process runMACE {
 
     echo "Model files: ${model_paths_string}"
 
+    MTD_ARGS=(
+        --input_file ${initialFrame}
+        --model_paths ${model_paths_string}
+        --timestep 1.0
+        --temperature 400
+        --pace 400
+        --height 2.0
+        --z_threshold 2.6
+        --sigma1 0.1
+        --sigma2 0.2
+        --biasfactor 5
+        --nsteps 5000
+        --variance_limit 0.0015
+        --interval 5
+        --stride 10
+        --c1_threshold 0.0
+        --c2_threshold 3.2
+        ${cv_config}
+    )
+
+    FILTER_CMD="python ${descriptorFilter} --new frames_for_DFT_eval.xyz --reference ${growingDataset} --descriptor_cache ${descriptorCacheDir()} --threshold 5 --max_structures 100"
+
     #############################################
     # ADAPTIVE SAMPLING LOOP: REPEAT UNTIL ≥ 20
     #############################################
-
-    while true; do
-
-        echo "Cleaning previous MTD output..."
-        rm -f MACE_MTD_committee_system.xyz # frames_for_DFT_eval.xyz
-
-        echo "Running MTD..."
-        python ${propagatorMTD} \
-            --input_file ${initialFrame} \
-            --model_paths ${model_paths_string} \
-            --timestep 1.0 \
-            --temperature 400 \
-            --pace 400 \
-            --height 2.0 \
-            --z_threshold 2.6 \
-            --sigma1 0.1 \
-            --sigma2 0.2 \
-            --biasfactor 5 \
-            --nsteps 5000 \
-            --variance_limit 0.0015 \
-            --interval 5 \
-            --stride 10 \
-            --c1_threshold 0.0 \
-            --c2_threshold 3.2
-
-        echo "Running descriptor filter..."
+    # ----------------------------------------
+    #  Exit code interpretation:
+    #    0  -> Enough structures collected
+    #    10 -> <20 structures -> continue MTD (multi-walker: relaunched with
+    #          --resume; single walker: MTD continues inside the propagator,
+    #          which only returns 10 after params.mtd_max_segments segments)
+    #  other -> fatal error
+    # ----------------------------------------
+
+    if [[ ${n_walkers} -gt 1 ]]; then
+        # Multi-walker MTD (params.mtd_walkers > 1) runs the propagator through
+        # run_mtd_walkers.py, which lives next to the propagator script. Retries
+        # resume every walker from its last state and the shared hills.
+        scripts_dir=\$(dirname \$(readlink -f ${propagatorMTD}))
+        RESUME=""
+
+        while true; do
+
+            echo "Running MTD..."
+            python \${scripts_dir}/run_mtd_walkers.py --propagator ${propagatorMTD} --n_walkers ${n_walkers} --shared_hills -- \
+                "\${MTD_ARGS[@]}" \${RESUME}
+
+            echo "Running descriptor filter..."
+            set +e
+            eval "\${FILTER_CMD}"
+            status=\$?
+            set -e
+
+            if [[ \$status -eq 10 ]]; then
+                echo "Fewer than 20 total structures — continuing metadynamics..."
+                RESUME="--resume"
+                continue
+            elif [[ \$status -eq 0 ]]; then
+                echo "Enough structures collected — proceeding!"
+                break
+            else
+                echo "Descriptor filter error (exit code \$status). Aborting."
+                exit \$status
+            fi
+
+        done
+    else
+        # Single walker: MTD and the filter alternate inside one propagator
+        # process, which keeps the models, the bias and the MD state loaded and
+        # continues sampling while the filter returns 10. With
+        # params.mtd_online_filter, candidates are instead filtered as they are
+        # generated, with the descriptor model and threshold of the offline filter.
         set +e
-        python ${descriptorFilter} \
-            --new frames_for_DFT_eval.xyz \
-            --reference ${growingDataset} \
-            --threshold 5 \
-            --max_structures 100
-
+        if [[ ${online_filter} == true ]]; then
+            echo "Running MTD with online descriptor filtering..."
+            python ${propagatorMTD} "\${MTD_ARGS[@]}" --max_segments ${max_segments} \
+                --online_filter \
+                --reference ${growingDataset} \
+                --descriptor_cache ${descriptorCacheDir()} \
+                --descriptor_threshold 5 \
+                --max_structures 100 ${stream}
+        else
+            echo "Running MTD with in-process descriptor filtering..."
+            python ${propagatorMTD} "\${MTD_ARGS[@]}" --filter_cmd "\${FILTER_CMD}" --max_segments ${max_segments}
+        fi
         status=\$?
-        set -e 
-        
-        # ----------------------------------------
-        #  Exit code interpretation:
-        #    0  -> Enough structures collected
-        #    10 -> <20 structures -> repeat MTD
-        #  other -> fatal error
-        # ----------------------------------------
+        set -e
 
         if [[ \$status -eq 10 ]]; then
-            echo "Fewer than 20 total structures — repeating metadynamics..."
-            continue
-        elif [[ \$status -eq 0 ]]; then
-            echo "Enough structures collected — proceeding!"
-            break
-        else
-            echo "Descriptor filter error (exit code \$status). Aborting."
+            echo "Not enough structures after params.mtd_max_segments = ${max_segments} MD segments. Aborting."
+            exit \$status
+        elif [[ \$status -ne 0 ]]; then
+            echo "Adaptive sampling failed (exit code \$status). Aborting."
             exit \$status
         fi
-
-    done
+        echo "Enough structures collected — proceeding!"
+    fi
 
     echo "Filtering done!"
     """
@@ -206,9 +274,15 @@ process calcREF {
     python ${prepare_cp2k_input}
     echo "Seeds sown for cp2k farming!"
 
+    # Load-balanced work queue over the allocation (run_cp2k_jobs.py lives
+    # next to the preparation script): jobs are sized by atom count, the
+    # largest start first, each SCF starts from the wavefunction of the
+    # closest finished frame, and jobs stuck for over an hour are cancelled
+    # and requeued instead of holding up the batch.
     echo "Harvest time!"
-    if ! srun cp2k.psmp farming_driver.inp > farming.out 2> farming.err; then
-        echo "WARNING: CP2K farming failed for some inputs (see farming.err)" >&2
+    scripts_dir=\$(dirname \$(readlink -f ${prepare_cp2k_input}))
+    if ! python \${scripts_dir}/run_cp2k_jobs.py --job_timeout 3600 --reuse_wfn > farming.out 2> farming.err; then
+        echo "WARNING: CP2K farming failed for some inputs (see farming.out)" >&2
     fi
     echo "CP2K calcs finished (some may have failed)."
     
@@ -218,42 +292,87 @@ process calcREF {
     """
 }
 
+process calcREF_stream {
+  label 'cp2k_farming'
+
+  input:
+    path stream_worker
+    path template
+    val run_label
+
+  output:
+    path "cp2k_farmed_dataset.xyz", emit: new_data
+    path "*.xyz"
+    path "run*"
+    path "*.out"
+
+  publishDir "results/calcREF/${run_label}", mode: 'copy'
+
+  script:
+    """
+    set -euo pipefail
+
+    export OMP_PLACES=cores
+    export OMP_PROC_BIND=close
+    export OMP_NUM_THREADS=2
+    ulimit -s unlimited
+
+    export PATH="/project/project_462000838/container_wrapper/mace_env_cueq/bin:\$PATH"
+
+    echo "Loading in CP2K modules.."
+    module use /appl/local/csc/modulefiles
+    module load cp2k/2024.3
+    echo "Modules loaded!"
+
+    # CP2K jobs are queued as runMACE accepts frames. If runMACE is killed
+    # without closing the stream, the worker stops after
+    # params.dft_stream_idle_timeout seconds without a new frame instead of
+    # holding the allocation until its walltime. The clock starts when
+    # runMACE opens the stream, so time runMACE spends queued is not counted.
+    echo "Harvesting frames as they are sown..."
+    python ${stream_worker} --stream_dir ${dftStreamDir(run_label)} --template ${template} --job_timeout 3600 --reuse_wfn \
+        --idle_timeout ${params.dft_stream_idle_timeout} > stream_worker.out
+    echo "Harvest has been parsed!"
+    """
+}
+
 process updateDataset {
   label 'local'
   
   input:
+    path datasetStore
     path new_data
     path existing_dataset
     val run_label
     
   output:
     path "growing_dataset.xyz", emit: updated_dataset
-    path "growing_dataset_*.xyz", emit: backup_dataset
+    path "growing_dataset_delta_*.xyz", emit: backup_dataset
     //path "growing_retrain_dataset.xyz", emit: persistent_dataset
 
   publishDir "results/updateDataset/${run_label}", mode: 'copy'
 
   script:
+    // The frames live in the append-only store of scripts/dataset_store.py;
+    // each update appends only new_data and records a snapshot instead of
+    // rewriting and backing up the whole file. The store is seeded from
+    // existing_dataset on the first update of a session. Frames already in
+    // the store (by structure fingerprint) are dropped and counted in the log.
+    def store = datasetStoreDir()
     """
+    set -euo pipefail
     echo "Updating dataset..."
-    
-    # Create a temporary file to avoid overwriting existing_dataset before reading
-    tmp_file=\$(mktemp)
 
-    # Concatenate existing dataset and new data into the temp file
-    cat ${existing_dataset} ${new_data} > \${tmp_file}
+    python ${datasetStore} append --store ${store} --frames ${new_data} --label ${run_label} --seed ${existing_dataset}
 
-    # Move temp file to growing_dataset.xyz
-    mv \${tmp_file} growing_dataset.xyz
+    # Dataset as of this update for the downstream steps, and the delta of this update
+    python ${datasetStore} export --store ${store} --snapshot ${run_label} --output growing_dataset.xyz
 
-    # Backup with timestamp
     timestamp=\$(date +%Y%m%d_%H%M%S)
-    backup_name="growing_dataset_\${timestamp}.xyz"
-    cp growing_dataset.xyz \${backup_name}
-
-    mkdir -p growing_dataset/backup
-    cp \${backup_name} growing_dataset/backup/
-    echo "Dataset updated and backed up as \${backup_name}"
+    delta_name="growing_dataset_delta_\${timestamp}.xyz"
+    python ${datasetStore} export --store ${store} --iterations ${run_label} --output \${delta_name}
+    python ${datasetStore} info --store ${store}
+    echo "Dataset updated; snapshot ${run_label} in ${store}, delta saved as \${delta_name}"
     """
 }
 
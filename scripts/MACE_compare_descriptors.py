@@ -1,21 +1,21 @@
-from ase.io import read, write
-from collections import Counter
+from ase.io import iread, read, write
 import numpy as np
+import torch
 from mace.calculators import MACECalculator
 from tqdm import tqdm
+from dataset_store import DatasetStore, composition_signature
+from descriptor_index import NoveltyIndex
+from mace_descriptors import (
+    DEFAULT_DESCRIPTOR_MODEL,
+    build_reference_index,
+    iter_descriptors,
+    reference_cache_dir,
+    structure_signature,
+    with_reference_distances,
+)
 import argparse
-import matplotlib.pyplot as plt
 import os
 
-# -----------------------
-# Helper: Structure Signature
-# -----------------------
-def structure_signature(atoms):
-    """Return a canonical chemical signature based on atom types."""
-    counts = Counter(atoms.get_chemical_symbols())
-    return tuple(sorted(counts.items()))  # e.g. (('C',7),('H',10),('O',2))
-
-
 # -----------------------
 # Arguments
 # -----------------------
@@ -26,31 +26,56 @@ parser.add_argument("--reference", default="growing_dataset.xyz",
                     help="Path to existing dataset")
 parser.add_argument("--output", default="frames_for_DFT_eval_filtered.xyz",
                     help="Filtered output structure file")
+parser.add_argument("--reference_store", default=None,
+                    help="Read the reference frames from this dataset store (dataset_store.py) instead of --reference; "
+                         "only frames with the compositions of the new structures are read (all of them with --stream)")
 parser.add_argument("--threshold", type=float, default=1.0,
                     help="Descriptor distance threshold")
-parser.add_argument("--model",
-                    default="/scratch/project_462000838/active_learning_nextflow/input/MACE_models/mace-mpa-0-medium.model",
+parser.add_argument("--model", default=DEFAULT_DESCRIPTOR_MODEL,
                     help="Path to MACE model")
 parser.add_argument("--max_structures", type=int, default=None,
                     help="Maximum number of structures to keep")
 parser.add_argument("--min_new_structures", type=int, default=20,
                     help="If fewer than this number of *new* structures are present or pass filtering, "
                          "exit(10) to request new metadynamics sampling.")
+parser.add_argument("--descriptor_cache", default=None,
+                    help="Directory of the on-disk reference descriptor store. "
+                         "Defaults to <reference>_descriptor_cache next to the (resolved) reference file.")
+parser.add_argument("--no_descriptor_cache", action="store_true",
+                    help="Recompute all reference descriptors and do not touch the descriptor store.")
+parser.add_argument("--batch_size", type=int, default=32,
+                    help="Number of structures per batched MACE descriptor evaluation")
+parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu",
+                    help="Torch device for the MACE model (default: cuda if available, else cpu)")
+parser.add_argument("--nn_index", choices=NoveltyIndex.METHODS, default="brute",
+                    help="Nearest-neighbour search used against the reference dataset: vectorised brute force, "
+                         "or a scipy KD-tree, sklearn ball tree or FAISS flat index")
+parser.add_argument("--no_heatmap", action="store_true",
+                    help="Do not compute or save the descriptor distance heatmap (skips matplotlib entirely)")
+parser.add_argument("--stream", action="store_true",
+                    help="Stream --new and --reference frame by frame (ase.io.iread) instead of loading whole files. "
+                         "The up-front --min_new_structures check on the raw candidate count is skipped.")
 args = parser.parse_args()
 
-device = "cuda"
+device = args.device
 
 # -----------------------
 # Load new candidate structures
 # -----------------------
-new_structures = read(args.new, ":")
-print(f"Loaded {len(new_structures)} new structures.")
+if args.stream:
+    new_structures = iread(args.new, ":")
+    n_new = None
+    print(f"Streaming new structures from {args.new}.")
+else:
+    new_structures = read(args.new, ":")
+    n_new = len(new_structures)
+    print(f"Loaded {n_new} new structures.")
 
-# --- NEW REQUIREMENT: Request new MTD runs if too few new structures ---
-if len(new_structures) < args.min_new_structures:
-    print(f"Only {len(new_structures)} new structures. "
-          f"Need at least {args.min_new_structures}. Requesting more MTD sampling...")
-    exit(10)
+    # --- NEW REQUIREMENT: Request new MTD runs if too few new structures ---
+    if n_new < args.min_new_structures:
+        print(f"Only {n_new} new structures. "
+              f"Need at least {args.min_new_structures}. Requesting more MTD sampling...")
+        exit(10)
 
 # -----------------------
 # Load MACE calculator
@@ -64,10 +89,22 @@ calculator = MACECalculator(
 # Load reference dataset
 # -----------------------
 reference_structures = []
-if os.path.exists(args.reference) and os.path.getsize(args.reference) > 0:
+if args.reference_store is not None:
+    # Structures are only compared within one signature, so reference frames
+    # of other compositions are never read
+    store = DatasetStore(args.reference_store)
+    wanted = None if args.stream else {composition_signature(atoms) for atoms in new_structures}
+    selected = store.select(signatures=wanted)
+    reference_structures = store.iter_frames(selected)
+    print(f"Reading {len(selected)} of {len(store)} reference structures from {args.reference_store}.")
+elif os.path.exists(args.reference) and os.path.getsize(args.reference) > 0:
     try:
-        reference_structures = read(args.reference, ":")
-        print(f"Loaded {len(reference_structures)} reference structures.")
+        if args.stream:
+            reference_structures = iread(args.reference, ":")
+            print(f"Streaming reference structures from {args.reference}.")
+        else:
+            reference_structures = read(args.reference, ":")
+            print(f"Loaded {len(reference_structures)} reference structures.")
     except Exception as e:
         print(f"Warning: failed to read reference dataset: {e}")
 else:
@@ -76,18 +113,16 @@ else:
 # -----------------------
 # Precompute reference descriptors by chemical signature
 # -----------------------
-signature_to_ref_desc = {}
+# Descriptors are keyed on structure hash inside a per-model subdirectory,
+# so only frames appended since the last iteration are recomputed.
+cache_dir = None
+reference_path = store.log_path if args.reference_store is not None else args.reference
+if not args.no_descriptor_cache and os.path.exists(reference_path):
+    cache_dir = reference_cache_dir(reference_path, args.model, args.descriptor_cache)
 
-if len(reference_structures) > 0:
-    print("Computing descriptors for reference dataset...")
-    for atoms in tqdm(reference_structures, desc="Reference descriptors"):
-        sig = structure_signature(atoms)
-        try:
-            desc = calculator.get_descriptors(atoms, invariants_only=False)
-        except Exception as e:
-            print(f"Skipping reference structure due to descriptor error: {e}")
-            continue
-        signature_to_ref_desc.setdefault(sig, []).append(desc)
+reference_index = build_reference_index(
+    calculator, reference_structures, cache_dir=cache_dir, batch_size=args.batch_size, method=args.nn_index
+)
 
 
 # -----------------------
@@ -95,72 +130,73 @@ if len(reference_structures) > 0:
 # -----------------------
 print("Filtering new structures (signature-aware)...")
 
-filtered_structures = []
-filtered_descriptors = []
-filtered_signatures = []
-
-distance_matrix = np.zeros((len(new_structures), len(new_structures)))
-
-for i, atoms in enumerate(tqdm(new_structures, desc="Filtering new structures")):
+# Accepted structures are written as they are found to a temporary file,
+# which only replaces --output once enough structures passed the filter.
+partial_output = args.output + ".part"
+n_filtered = 0
+filtered_index = NoveltyIndex()
 
-    if args.max_structures is not None and len(filtered_structures) >= args.max_structures:
-        print(f"Reached maximum {args.max_structures} filtered structures. Stopping.")
-        break
+# Distances between accepted structures of the same signature, one row per
+# accepted structure; the dense matrix is only built for the heatmap.
+heatmap_rows = []
 
-    sig = structure_signature(atoms)
+with open(partial_output, "w") as output_handle:
+    for i, atoms, desc, error, ref_dist in tqdm(
+        with_reference_distances(
+            iter_descriptors(calculator, new_structures, args.batch_size), reference_index, args.batch_size
+        ),
+        total=n_new, desc="Filtering new structures"
+    ):
 
-    try:
-        desc = calculator.get_descriptors(atoms, invariants_only=False)
-    except Exception as e:
-        print(f"Skipping structure {i} due to descriptor error: {e}")
-        continue
+        if args.max_structures is not None and n_filtered >= args.max_structures:
+            print(f"Reached maximum {args.max_structures} filtered structures. Stopping.")
+            break
 
-    is_similar = False
-
-    # ---- Compare with reference structures of same signature ----
-    if sig in signature_to_ref_desc:
-        for ref_desc in signature_to_ref_desc[sig]:
-            if np.linalg.norm(desc - ref_desc) < args.threshold:
-                is_similar = True
-                break
+        sig = structure_signature(atoms)
 
-    # ---- Compare with previously filtered new structures ----
-    if not is_similar:
-        for j, (sig_existing, existing_desc) in enumerate(zip(filtered_signatures, filtered_descriptors)):
-            if sig_existing != sig:
-                continue  # skip different compositions
+        if error is not None:
+            print(f"Skipping structure {i} due to descriptor error: {error}")
+            continue
 
-            dist = np.linalg.norm(desc - existing_desc)
-            distance_matrix[len(filtered_descriptors)][j] = dist
-            distance_matrix[j][len(filtered_descriptors)] = dist
+        # ---- Compare with reference structures of same signature ----
+        is_similar = ref_dist < args.threshold
 
-            if dist < args.threshold:
-                is_similar = True
-                break
+        # ---- Compare with previously filtered new structures of same signature ----
+        if not is_similar:
+            labels, dists = filtered_index.distances(sig, desc)
+            is_similar = bool(len(dists)) and dists.min() < args.threshold
 
-    if not is_similar:
-        filtered_structures.append(atoms)
-        filtered_descriptors.append(desc)
-        filtered_signatures.append(sig)
+        if not is_similar:
+            if not args.no_heatmap:
+                heatmap_rows.append((np.array(labels, dtype=int), dists))
+            filtered_index.add(sig, desc, label=n_filtered)
+            write(output_handle, atoms, format='extxyz')
+            output_handle.flush()
+            n_filtered += 1
 
 
 # -----------------------
 # REQUIREMENT: Filter count check based on NEW structures only
 # -----------------------
-if len(filtered_structures) < args.min_new_structures:
-    print(f"Only {len(filtered_structures)} filtered new structures "
+if n_filtered < args.min_new_structures:
+    print(f"Only {n_filtered} filtered new structures "
           f"(required {args.min_new_structures}). Requesting more MTD sampling...")
+    os.remove(partial_output)
     exit(10)
 
 
 # -----------------------
 # Save heatmap (optional)
 # -----------------------
-if len(filtered_descriptors) > 1:
-    n = len(filtered_descriptors)
-    cropped = distance_matrix[:n, :n]
+if not args.no_heatmap and n_filtered > 1:
+    import matplotlib.pyplot as plt
+
+    distance_matrix = np.zeros((n_filtered, n_filtered), dtype=np.float32)
+    for row, (cols, dists) in enumerate(heatmap_rows):
+        distance_matrix[row, cols] = dists
+        distance_matrix[cols, row] = dists
     plt.figure(figsize=(8, 6))
-    plt.imshow(cropped, cmap='viridis', interpolation='nearest')
+    plt.imshow(distance_matrix, cmap='viridis', interpolation='nearest')
     plt.colorbar(label='Descriptor Distance')
     plt.title('Filtered New Structures Descriptor Distances')
     plt.xlabel('Structure Index')
@@ -171,9 +207,10 @@ if len(filtered_descriptors) > 1:
 # -----------------------
 # Save output
 # -----------------------
-if filtered_structures:
-    write(args.output, filtered_structures, format='extxyz')
-    print(f"Saved {len(filtered_structures)} filtered structures to {args.output}")
+if n_filtered:
+    os.replace(partial_output, args.output)
+    print(f"Saved {n_filtered} filtered structures to {args.output}")
 else:
+    os.remove(partial_output)
     print("No new unique structures found.")
 
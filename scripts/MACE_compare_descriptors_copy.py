@@ -1,13 +1,23 @@
 from ase.io import read, write
 import numpy as np
+import torch
 from mace.calculators import MACECalculator
 from tqdm import tqdm
+from mace_descriptors import iter_descriptors
 import matplotlib.pyplot as plt
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=32,
+                    help="Number of structures per batched MACE descriptor evaluation")
+parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu",
+                    help="Torch device for the MACE model (default: cuda if available, else cpu)")
+args = parser.parse_args()
 
 # Load all structures
 all_structures = read('frames_for_DFT_eval.xyz', ':')
 
-device = 'cuda'  # or 'cuda:0'
+device = args.device  # e.g. 'cuda', 'cuda:0' or 'cpu'
 
 calculator = MACECalculator(
     model_paths='/scratch/project_462000838/active_learning_nextflow/input/MACE_models/mace-mpa-0-medium.model',
@@ -25,11 +35,12 @@ max_possible = n_structures
 distance_matrix = np.zeros((max_possible, max_possible))
 kept_indices = []
 
-for idx, atoms in enumerate(tqdm(all_structures, desc="Filtering structures")):
-    try:
-        desc = calculator.get_descriptors(atoms, invariants_only=False)
-    except Exception as e:
-        print(f"⚠️ Failed to get descriptor for structure {idx}, skipping: {e}")
+for idx, atoms, desc, error in tqdm(
+    iter_descriptors(calculator, all_structures, args.batch_size),
+    total=len(all_structures), desc="Filtering structures"
+):
+    if error is not None:
+        print(f"⚠️ Failed to get descriptor for structure {idx}, skipping: {error}")
         continue
 
     is_similar = False
@@ -1,24 +1,44 @@
 import argparse
 from ase.calculators.plumed import Plumed
 from ase import units
-from ase.io import read, write
+from ase.io import iread, read, write
 from ase.constraints import FixAtoms
 from mace.calculators import MACECalculator
+from committee_calculator import CommitteeCalculator
+from native_bias import from_plumed_input
+from cv_config import load_cv_config, plumed_bias_lines, resolve_groups, stop_conditions
+from dft_stream import FrameStream
 from ase.md.verlet import VelocityVerlet
 from ase.md.velocitydistribution import MaxwellBoltzmannDistribution
-import matplotlib.pyplot as plt
+import heapq
+import itertools
 import numpy as np
 import os
+import torch
+import subprocess
+import sys
+from plot_mtd_log import plot_mtd_log
+from mtd_monitoring import BufferedTrajectoryWriter, ColvarTail, TimeSeriesLog
+from mace_descriptors import DEFAULT_DESCRIPTOR_MODEL, OnlineNoveltyFilter, build_reference_index, reference_cache_dir
 
 # === Custom exception to stop MD cleanly ===
 class StopMD(Exception):
     pass
 
+# === Raised by the online filter once --max_structures frames are accepted ===
+class EnoughStructures(Exception):
+    pass
+
 # === Argument parser ===
 parser = argparse.ArgumentParser(description="Run MTD with MACE committee and PLUMED")
 
 parser.add_argument("--input_file", type=str, help="Initial structure file (.traj)")
 parser.add_argument("--model_paths", type=str, nargs='+', required=True, help="List of trained MACE model paths")
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu",
+                    help="Torch device for the MACE committee (default: cuda if available, else cpu)")
+parser.add_argument("--nl_skin", type=float, default=0.5,
+                    help="Verlet skin in Å: the neighbour list is rebuilt only after an atom moved more than "
+                         "half of it (0 rebuilds it every step)")
 parser.add_argument("--timestep", type=float, default=1.0, help="MD timestep in fs")
 parser.add_argument("--z_threshold", type=float, default=2.0, help="z-threshold in Å for fixing slab atoms")
 parser.add_argument("--nsteps", type=int, default=2500, help="Number of MD steps")
@@ -33,123 +53,337 @@ parser.add_argument("--interval", type=int, default=5, help="ASE attach interval
 parser.add_argument("--variance_limit", type=float, default=0.0015, help="Variance threshold")
 parser.add_argument("--c1_threshold", type=float, default=2.0, help="Threshold for CV c1")
 parser.add_argument("--c2_threshold", type=float, default=2.5, help="Threshold for CV c2")
+parser.add_argument("--cv_config", type=str, default=None,
+                    help="YAML/JSON file with the atom groups, CVs, walls, METAD bias and stop conditions "
+                         "(see cv_config.py); without it the TDMAS/SiO2 CVs c1, c2 are used. "
+                         "Without a stop section --c1_threshold/--c2_threshold apply to the first two CVs")
+
+parser.add_argument("--seed", type=int, default=None, help="Seed for the initial Maxwell-Boltzmann velocities")
+parser.add_argument("--walkers_n", type=int, default=1, help="Number of PLUMED multiple walkers sharing the METAD bias")
+parser.add_argument("--walker_id", type=int, default=0, help="ID of this walker (0 .. walkers_n-1)")
+parser.add_argument("--walkers_dir", type=str, default=".", help="Directory holding the shared HILLS.<id> files")
+parser.add_argument("--walkers_rstride", type=int, default=100, help="Steps between reading the other walkers' hills")
+
+parser.add_argument("--restart_file", type=str, default="mtd_restart.traj",
+                    help="Positions and velocities written at the end of every MD segment")
+parser.add_argument("--resume", action="store_true",
+                    help="Continue from --restart_file and the existing HILLS (PLUMED RESTART) if present")
+parser.add_argument("--filter_cmd", type=str, default=None,
+                    help="Command run after each MD segment (e.g. the descriptor filter); exit code 10 "
+                         "continues MD in this process, any other code ends the run with that code")
+parser.add_argument("--max_segments", type=int, default=0,
+                    help="Maximum number of MD segments with --filter_cmd or --online_filter before giving up "
+                         "with exit code 10; 0 (default) samples until the filter is satisfied")
+
+parser.add_argument("--online_filter", action="store_true",
+                    help="Filter high-variance frames by descriptor novelty during MD and write the accepted "
+                         "frames to --filtered_output, instead of collecting candidates for a separate filter run")
+parser.add_argument("--reference", type=str, default="growing_dataset.xyz",
+                    help="Reference dataset of the online filter")
+parser.add_argument("--descriptor_model", type=str, default=DEFAULT_DESCRIPTOR_MODEL,
+                    help="MACE model for the online filter descriptors (default: the --model of "
+                         "MACE_compare_descriptors.py, so --descriptor_threshold has the same scale as its "
+                         "--threshold). The first --model_paths entry reuses the loaded committee model, but "
+                         "its descriptors need a threshold calibrated for that model")
+parser.add_argument("--descriptor_cache", type=str, default=None,
+                    help="Reference descriptor store shared with MACE_compare_descriptors.py")
+parser.add_argument("--descriptor_threshold", type=float, default=1.0, help="Descriptor distance threshold")
+parser.add_argument("--max_structures", type=int, default=None,
+                    help="Stop MD once this many novel frames are accepted by the online filter")
+parser.add_argument("--min_new_structures", type=int, default=20,
+                    help="Novel frames required by the online filter; fewer exits with code 10")
+parser.add_argument("--filtered_output", type=str, default="frames_for_DFT_eval_filtered.xyz",
+                    help="Output of the online filter")
+parser.add_argument("--stream_dir", type=str, default=None,
+                    help="Also write every frame accepted by the online filter to this directory as it is "
+                         "accepted, for cp2k_stream_worker.py to compute while MD is running")
+
+parser.add_argument("--bias_engine", choices=["plumed", "native"], default="plumed",
+                    help="Compute the CVs, walls and METAD bias with PLUMED or with the built-in NumPy engine "
+                         "(native_bias.py; no multiple walkers)")
+parser.add_argument("--bias_flush_stride", type=int, default=100,
+                    help="Steps between COLVAR/HILLS writes of the native bias engine")
+
+parser.add_argument("--traj_file", type=str, default="MACE_MTD_committee_system.xyz",
+                    help="Trajectory of the monitored frames; a .traj suffix writes a binary ASE trajectory")
+parser.add_argument("--traj_flush_every", type=int, default=20,
+                    help="Number of frames buffered in memory before they are written to --traj_file")
+parser.add_argument("--max_frames", type=int, default=None,
+                    help="Keep only this many highest-variance frames above --variance_limit (default: all)")
+parser.add_argument("--log_file", type=str, default="mace_mtd_log.npz", help="NPZ log of the monitored time series")
+parser.add_argument("--no_plot", action="store_true", help="Only write --log_file; plot later with plot_mtd_log.py")
 
 args = parser.parse_args()
+if args.stream_dir and not args.online_filter:
+    parser.error("--stream_dir needs --online_filter")
 
 # === Derived ===
 kT = args.temperature * units.kB
-atoms = read(args.input_file)
+resuming = args.resume and os.path.isfile(args.restart_file)
+initial_atoms = read(args.input_file)
+atoms = read(args.restart_file) if resuming else initial_atoms.copy()
+if resuming:
+    print(f"Resuming MTD from {args.restart_file}")
 
 # === MACE Committee ===
-mace_committee = MACECalculator(model_paths=args.model_paths, device='cuda', default_dtype='float64', head='default')
+mace_committee = CommitteeCalculator(model_paths=args.model_paths, device=args.device, default_dtype='float64', head='default',
+                                     skin=args.nl_skin)
+
+# === Online novelty filter ===
+novelty = None
+if args.online_filter:
+    if os.path.abspath(args.descriptor_model) == os.path.abspath(args.model_paths[0]):
+        descriptor_calc, descriptor_models, descriptor_model_path = mace_committee, mace_committee.models[:1], args.model_paths[0]
+    else:
+        descriptor_calc = MACECalculator(model_paths=args.descriptor_model, device=args.device)
+        descriptor_models, descriptor_model_path = None, args.descriptor_model
+
+    reference_structures = []
+    cache_dir = None
+    if os.path.exists(args.reference) and os.path.getsize(args.reference) > 0:
+        reference_structures = iread(args.reference, ":")
+        cache_dir = reference_cache_dir(args.reference, descriptor_model_path, args.descriptor_cache)
+    else:
+        print("Reference dataset missing or empty.")
+    reference_index = build_reference_index(descriptor_calc, reference_structures, cache_dir=cache_dir,
+                                            models=descriptor_models)
+    novelty = OnlineNoveltyFilter(descriptor_calc, reference_index, args.descriptor_threshold, models=descriptor_models)
+    filtered_partial = args.filtered_output + ".part"
+    filtered_handle = open(filtered_partial, "w")
+# A fresh (not resumed) run replaces the frames of an earlier attempt in the stream
+stream = FrameStream(args.stream_dir, resume=resuming) if args.stream_dir else None
 
 # === PLUMED input string ===
+walkers_suffix = (f" WALKERS_N={args.walkers_n} WALKERS_ID={args.walker_id} WALKERS_DIR={args.walkers_dir} "
+                  f"WALKERS_RSTRIDE={args.walkers_rstride}" if args.walkers_n > 1 else "")
+if args.cv_config:
+    # Atom groups are resolved once, on the initial structure (also when resuming)
+    cv_config = load_cv_config(args.cv_config)
+    groups = resolve_groups(cv_config, initial_atoms)
+    for name, indices in groups.items():
+        print(f"Atom group {name}: {len(indices)} atoms")
+    bias_lines = plumed_bias_lines(
+        cv_config, groups, metad_suffix=walkers_suffix,
+        defaults={"height": args.height, "pace": args.pace, "sigma": [args.sigma1, args.sigma2],
+                  "grid_min": [0.0, 0.0], "grid_max": [5.0, 5.0], "biasfactor": args.biasfactor,
+                  "temp": args.temperature, "stride": args.stride},
+    )
+    stop = stop_conditions(cv_config) if "stop" in cv_config else None
+else:
+    cv_config, groups, stop = None, {}, None
+    bias_lines = [
+        "c1: COORDINATION GROUPA=217 GROUPB=219-221 R_0=2.2",
+        "c2: COORDINATION GROUPA=217 GROUPB=39,56,57,58,59,60,61,62,63,64,79,80,81,85,87,89,90,92 R_0=2.0",
+        "LOWER_WALLS ARG=c2 AT=0.3 KAPPA=100 LABEL=d1",
+        f"metad: METAD ARG=c1,c2 HEIGHT={args.height} PACE={args.pace} " +
+        f"SIGMA={args.sigma1},{args.sigma2} GRID_MIN=0.0,0.0 GRID_MAX=5.0,5.0 " +
+        f"BIASFACTOR={args.biasfactor} TEMP={args.temperature} FILE=HILLS" + walkers_suffix,
+        f"PRINT ARG=c1,c2,metad.bias STRIDE={args.stride} FILE=COLVAR",
+    ]
+n_cvs = len(cv_config["cvs"]) if cv_config else 2
+if stop is None:
+    stop = [(0, "below", args.c1_threshold), (1, "above", args.c2_threshold)][:n_cvs]
+
 plumed_input = [
+    *(["RESTART"] if resuming else []),  # append to HILLS/COLVAR and rebuild the bias from HILLS
     f"UNITS LENGTH=A TIME={1/(1000*units.fs)} ENERGY={units.mol/units.kJ}",
-    "c1: COORDINATION GROUPA=217 GROUPB=219-221 R_0=2.2",
-    "c2: COORDINATION GROUPA=217 GROUPB=39,56,57,58,59,60,61,62,63,64,79,80,81,85,87,89,90,92 R_0=2.0",
-    "LOWER_WALLS ARG=c2 AT=0.3 KAPPA=100 LABEL=d1",
-    f"metad: METAD ARG=c1,c2 HEIGHT={args.height} PACE={args.pace} " +
-    f"SIGMA={args.sigma1},{args.sigma2} GRID_MIN=0.0,0.0 GRID_MAX=5.0,5.0 " +
-    f"BIASFACTOR={args.biasfactor} TEMP={args.temperature} FILE=HILLS",
-    f"PRINT ARG=c1,c2,metad.bias STRIDE={args.stride} FILE=COLVAR",
+    *bias_lines,
     f"FLUSH STRIDE=1"
 ]
 
+# The input is kept next to the outputs, e.g. to validate the native engine
+# against PLUMED with validate_native_bias.py
+with open("plumed.dat", "w") as f:
+    f.write("\n".join(plumed_input) + "\n")
+
 # === Setup calc ===
-atoms.calc = Plumed(calc=mace_committee, input=plumed_input, timestep=args.timestep, atoms=atoms, kT=kT)
-z_threshold = args.z_threshold
-print(z_threshold)
-fixed_indices = [i for i, atom in enumerate(atoms) if atom.position[2] < z_threshold]
+if args.bias_engine == "native":
+    atoms.calc = from_plumed_input(mace_committee, plumed_input, timestep=args.timestep,
+                                   flush_stride=args.bias_flush_stride)
+else:
+    atoms.calc = Plumed(calc=mace_committee, input=plumed_input, timestep=args.timestep, atoms=atoms, kT=kT)
+if "fixed" in groups:
+    fixed_indices = groups["fixed"]
+else:
+    z_threshold = args.z_threshold
+    print(z_threshold)
+    fixed_indices = [i for i, atom in enumerate(atoms) if atom.position[2] < z_threshold]
 print(fixed_indices)
 fix_constraint = FixAtoms(indices=fixed_indices)
 atoms.set_constraint(fix_constraint)
-MaxwellBoltzmannDistribution(atoms, temperature_K=args.temperature)
+rng = np.random.RandomState(args.seed) if args.seed is not None else None
+if not resuming:
+    MaxwellBoltzmannDistribution(atoms, temperature_K=args.temperature, rng=rng)
 dyn = VelocityVerlet(atoms, timestep=args.timestep * units.fs)
 
 # === Monitoring and output ===
-time_fs = []
-temperatures = []
-energies_all = [[] for _ in range(len(args.model_paths))]
-variances = []
-committee_energies = []
+mtd_log = TimeSeriesLog(args.nsteps // args.interval + 1, len(args.model_paths))
+# Min-heap of (variance, sequence, snapshot) holding the --max_frames
+# highest-variance frames (all of them without a cap); the root is the
+# first frame to be evicted.
 frames_with_variance = []
+n_candidates = 0
 
-fig, ax = plt.subplots(3, 1, figsize=(8, 6), sharex='all', gridspec_kw={'hspace': 0})
+trajectory = BufferedTrajectoryWriter(args.traj_file, args.traj_flush_every)
 
-def read_last_colvar(filename="COLVAR"):
-    """Read the last line of COLVAR to get c1 and c2."""
-    with open(filename, "r") as f:
-        lines = [l for l in f if not l.startswith("#")]
-        if not lines:
-            return None, None
-        last_line = lines[-1].split()
-        c1 = float(last_line[1])  # adjust indices if needed
-        c2 = float(last_line[2])
-        return c1, c2
+colvar = ColvarTail("COLVAR", n_cvs=n_cvs)
+if resuming and os.path.exists(colvar.filename):
+    colvar.offset = os.path.getsize(colvar.filename)  # CVs of the previous run do not apply
 
 def write_frame():
-    atoms_copy = atoms.copy()
-    atoms_copy.calc = mace_committee
+    global n_candidates
 
     # === Read CVs from COLVAR ===
-    c1, c2 = read_last_colvar()
-    if (c1 is not None and c1 < args.c1_threshold) or (c2 is not None and c2 > args.c2_threshold):
-        print(f"Stopping simulation: c1={c1}, c2={c2}")
-        raise StopMD
+    if args.bias_engine == "native":
+        cvs = atoms.calc.cv_values  # in memory, COLVAR is only written every --bias_flush_stride steps
+    else:
+        cvs = colvar.read_last()
+    if cvs is not None:
+        for i, kind, threshold in stop:
+            if cvs[i] < threshold if kind == "below" else cvs[i] > threshold:
+                print(f"Stopping simulation: CVs={', '.join(f'{v:.4f}' for v in cvs)} ({kind} {threshold})")
+                raise StopMD
 
     # === Logging and saving ===
-    dyn.atoms.write('MACE_MTD_committee_system.xyz', append=True, write_results=False)
+    trajectory.write(dyn.atoms)
 
-    t_fs = dyn.get_time() / units.fs
-    time_fs.append(t_fs)
-    temperatures.append(dyn.atoms.get_temperature())
+    # Results of the last force call on the live atoms; nothing is copied here
+    results = mace_committee.results
+    variance = results['energy_var']
+    mtd_log.append(
+        dyn.get_time() / units.fs,
+        dyn.atoms.get_temperature(),
+        variance,
+        results['energy'] / len(dyn.atoms),
+        np.asarray(results['energies']) / len(dyn.atoms),
+    )
 
-    for i, e in enumerate(atoms_copy.calc.results['energies']):
-        energies_all[i].append(e / len(dyn.atoms))
-    committee_energies.append(atoms_copy.calc.results['energy'] / len(dyn.atoms))
-
-    variance = atoms_copy.calc.results['energy_var']
-    variances.append(variance)
+    # Online filter: keep a candidate only if its descriptor is novel
+    if novelty is not None:
+        if variance is not None and variance >= args.variance_limit:
+            n_candidates += 1
+            snapshot = dyn.atoms.copy()
+            snapshot.info['variance'] = variance
+            if novelty.consider(snapshot):
+                write(filtered_handle, snapshot, format='extxyz', write_results=False)
+                filtered_handle.flush()
+                if stream is not None:
+                    stream.write(snapshot)
+                if args.max_structures is not None and novelty.n_accepted >= args.max_structures:
+                    raise EnoughStructures
+        return
 
+    # Only frames that make it into the top-K heap are copied
     if variance is not None and variance >= args.variance_limit:
-        atoms_copy.info['variance'] = variance
-        frames_with_variance.append((variance, atoms_copy))
+        has_room = args.max_frames is None or len(frames_with_variance) < args.max_frames
+        if has_room or variance > frames_with_variance[0][0]:
+            snapshot = dyn.atoms.copy()
+            snapshot.info['variance'] = variance
+            entry = (variance, n_candidates, snapshot)
+            if has_room:
+                heapq.heappush(frames_with_variance, entry)
+            else:
+                heapq.heapreplace(frames_with_variance, entry)
+        n_candidates += 1
 
 dyn.attach(write_frame, interval=args.interval)
 
+def run_segment():
+    """Run one MD segment; return True if it was stopped by the CV condition."""
+    try:
+        dyn.run(args.nsteps)
+        return False
+    except StopMD:
+        print("Simulation stopped early by CV or variance threshold.")
+        return True
+    except EnoughStructures:
+        print(f"Reached maximum {args.max_structures} filtered structures. Stopping.")
+        return False
+    finally:
+        trajectory.flush()
+        mtd_log.save(args.log_file, args.variance_limit)
+        write(args.restart_file, atoms)
+
+
+def write_candidates():
+    """Append the collected high-variance frames to frames_for_DFT_eval.xyz and reset the heap."""
+    global n_candidates
+
+    # === Ensure at least the last frame is saved ===
+    if not frames_with_variance:
+        last_frame = atoms.copy()
+        last_frame.calc = mace_committee
+        last_frame.info['variance'] = None  # no variance exceeded
+        frames_with_variance.append((None, 0, last_frame))
+    else:
+        print(f"Kept {len(frames_with_variance)} of {n_candidates} frames above the variance limit.")
+
+    # === Output filtered frames ===
+    sorted_frames = [frame for _, _, frame in sorted(frames_with_variance, key=lambda x: (-x[0] if x[0] is not None else 1, x[1]))]
+    write('frames_for_DFT_eval.xyz', sorted_frames, format='extxyz', write_results=False, append=True)
+    frames_with_variance.clear()
+    n_candidates = 0
+
+
 # === Run dynamics with clean stopping ===
+# With --filter_cmd or --online_filter, sampling and filtering alternate in
+# this process: the committee models, the PLUMED bias and the MD state are
+# kept between segments. A segment that ran to completion is continued from
+# its last positions and velocities; one stopped by the CV condition
+# restarts from the initial structure with fresh velocities under the
+# accumulated bias.
+exit_code = 0
+adaptive = args.filter_cmd or args.online_filter
 try:
-    dyn.run(args.nsteps)
-except StopMD:
-    print("Simulation stopped early by CV or variance threshold.")
-
-# === Plot the data ===
-ax[0].axhline(y=args.variance_limit, color='r', linestyle=':')
-ax[0].plot(time_fs, variances, color="y")
-ax[0].set_ylabel("Variance")
-ax[0].legend(["Threshold", "Estimated Variance"])
-
-ax[1].plot(time_fs, temperatures, color="r")
-ax[1].set_ylabel("T (K)")
-
-for i, e_list in enumerate(energies_all):
-    ax[2].plot(time_fs, e_list, label=f"E mace{i+1}")
-ax[2].plot(time_fs, committee_energies, color="black", label="E committee")
-ax[2].set_ylabel("E (eV/atom)")
-ax[2].set_xlabel("Time (fs)")
-ax[2].legend(loc='upper left')
-
-# === Ensure at least the last frame is saved ===
-if not frames_with_variance:
-    last_frame = atoms.copy()
-    last_frame.calc = mace_committee
-    last_frame.info['variance'] = None  # no variance exceeded
-    frames_with_variance.append((None, last_frame))
-
-# === Output filtered frames ===
-sorted_frames = [atoms for _, atoms in sorted(frames_with_variance, key=lambda x: (x[0] if x[0] is not None else -1), reverse=True)]
-write('frames_for_DFT_eval.xyz', sorted_frames, format='extxyz', write_results=False, append=True)
-
-plt.tight_layout()
-plt.savefig('mace_mtd_committee_analysis.png', dpi=300)
+    n_segments = (args.max_segments or None) if adaptive else 1
+    for segment in itertools.count() if n_segments is None else range(n_segments):
+        stopped = run_segment()
+        if novelty is not None:
+            print(f"Accepted {novelty.n_accepted} novel frames of {n_candidates} above the variance limit.")
+            enough = novelty.n_accepted >= args.min_new_structures or (
+                args.max_structures is not None and novelty.n_accepted >= args.max_structures)
+            exit_code = 0 if enough else 10
+        else:
+            write_candidates()
+            if not args.filter_cmd:
+                break
+            print(f"Running filter after MD segment {segment + 1}: {args.filter_cmd}")
+            exit_code = subprocess.call(args.filter_cmd, shell=True)
+        if exit_code != 10:
+            break
+
+        if stopped:
+            atoms.set_positions(initial_atoms.get_positions())
+            MaxwellBoltzmannDistribution(atoms, temperature_K=args.temperature, rng=rng)
+            colvar.last = None  # CVs of the stopped segment no longer apply
+        print("Filter requested more structures, continuing MTD...")
+    else:
+        if adaptive:
+            print(f"Reached --max_segments {args.max_segments} without enough structures.")
+finally:
+    colvar.close()
+    if args.bias_engine == "native":
+        atoms.calc.close()
+    trajectory.close()
+    if novelty is not None:
+        filtered_handle.close()
+    if stream is not None:
+        # The DFT workers finish the frames they have and stop; 1 marks a crashed propagator
+        stream.close(exit_code if sys.exc_info()[0] is None else 1)
+
+# === Online filter output, kept only once enough structures were accepted ===
+if novelty is not None:
+    if exit_code == 0 and novelty.n_accepted:
+        os.replace(filtered_partial, args.filtered_output)
+        print(f"Saved {novelty.n_accepted} filtered structures to {args.filtered_output}")
+    else:
+        os.remove(filtered_partial)
+        if exit_code == 10:
+            print(f"Only {novelty.n_accepted} filtered new structures "
+                  f"(required {args.min_new_structures}). Requesting more MTD sampling...")
+
+# === Plot the monitored data once, after the MD loop ===
+if not args.no_plot:
+    plot_mtd_log(args.log_file, 'mace_mtd_committee_analysis.png')
+
+sys.exit(exit_code)
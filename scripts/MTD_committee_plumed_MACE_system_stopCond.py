@@ -2,12 +2,15 @@ import argparse
 from ase.calculators.plumed import Plumed
 from ase import units
 from ase.io import read, write
-from mace.calculators import MACECalculator
+from committee_calculator import CommitteeCalculator
 from ase.md.verlet import VelocityVerlet
 from ase.md.velocitydistribution import MaxwellBoltzmannDistribution
-import matplotlib.pyplot as plt
+import heapq
 import numpy as np
 import os
+import torch
+from plot_mtd_log import plot_mtd_log
+from mtd_monitoring import BufferedTrajectoryWriter, ColvarTail, TimeSeriesLog
 
 # === Custom exception to stop MD cleanly ===
 class StopMD(Exception):
@@ -18,6 +21,11 @@ parser = argparse.ArgumentParser(description="Run MTD with MACE committee and PL
 
 parser.add_argument("--input_file", type=str, help="Initial structure file (.traj)")
 parser.add_argument("--model_paths", type=str, nargs='+', required=True, help="List of trained MACE model paths")
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu",
+                    help="Torch device for the MACE committee (default: cuda if available, else cpu)")
+parser.add_argument("--nl_skin", type=float, default=0.5,
+                    help="Verlet skin in Å: the neighbour list is rebuilt only after an atom moved more than "
+                         "half of it (0 rebuilds it every step)")
 parser.add_argument("--timestep", type=float, default=1.0, help="MD timestep in fs")
 parser.add_argument("--nsteps", type=int, default=2500, help="Number of MD steps")
 parser.add_argument("--temperature", type=float, default=400, help="Temperature in Kelvin")
@@ -32,6 +40,15 @@ parser.add_argument("--variance_limit", type=float, default=0.0015, help="Varian
 parser.add_argument("--c1_threshold", type=float, default=1.5, help="Threshold for CV c1")
 parser.add_argument("--c2_threshold", type=float, default=2.5, help="Threshold for CV c2")
 
+parser.add_argument("--traj_file", type=str, default="MACE_MTD_committee_system.xyz",
+                    help="Trajectory of the monitored frames; a .traj suffix writes a binary ASE trajectory")
+parser.add_argument("--traj_flush_every", type=int, default=20,
+                    help="Number of frames buffered in memory before they are written to --traj_file")
+parser.add_argument("--max_frames", type=int, default=None,
+                    help="Keep only this many highest-variance frames above --variance_limit (default: all)")
+parser.add_argument("--log_file", type=str, default="mace_mtd_log.npz", help="NPZ log of the monitored time series")
+parser.add_argument("--no_plot", action="store_true", help="Only write --log_file; plot later with plot_mtd_log.py")
+
 args = parser.parse_args()
 
 # === Derived ===
@@ -39,7 +56,8 @@ kT = args.temperature * units.kB
 atoms = read(args.input_file)
 
 # === MACE Committee ===
-mace_committee = MACECalculator(model_paths=args.model_paths, device='cuda', default_dtype='float64', head='default')
+mace_committee = CommitteeCalculator(model_paths=args.model_paths, device=args.device, default_dtype='float64', head='default',
+                                     skin=args.nl_skin)
 
 # === PLUMED input string ===
 plumed_input = [
@@ -60,69 +78,52 @@ MaxwellBoltzmannDistribution(atoms, temperature_K=args.temperature)
 dyn = VelocityVerlet(atoms, timestep=args.timestep * units.fs)
 
 # === Monitoring and output ===
-time_fs = []
-temperatures = []
-energies_all = [[] for _ in range(len(args.model_paths))]
-variances = []
-committee_energies = []
+mtd_log = TimeSeriesLog(args.nsteps // args.interval + 1, len(args.model_paths))
+# Min-heap of (variance, sequence, snapshot) holding the --max_frames
+# highest-variance frames (all of them without a cap); the root is the
+# first frame to be evicted.
 frames_with_variance = []
+n_candidates = 0
 
-fig, ax = plt.subplots(3, 1, figsize=(8, 6), sharex='all', gridspec_kw={'hspace': 0})
+trajectory = BufferedTrajectoryWriter(args.traj_file, args.traj_flush_every)
 
-def read_last_colvar(filename="COLVAR"):
-    """Read the last line of COLVAR to get c1 and c2."""
-    with open(filename, "r") as f:
-        lines = [l for l in f if not l.startswith("#")]
-        if not lines:
-            return None, None
-        last_line = lines[-1].split()
-        c1 = float(last_line[1])  # adjust indices if needed
-        c2 = float(last_line[2])
-        return c1, c2
+colvar = ColvarTail("COLVAR", n_cvs=2)
 
 def write_frame():
-    atoms_copy = atoms.copy()
-    atoms_copy.calc = mace_committee
+    global n_candidates
 
     # === Read CVs from COLVAR ===
-    c1, c2 = read_last_colvar()
+    c1, c2 = colvar.read_last() or (None, None)
     if (c1 is not None and c1 < args.c1_threshold) or (c2 is not None and c2 > args.c2_threshold):
         print(f"Stopping simulation: c1={c1}, c2={c2}")
         raise StopMD
 
     # === Logging and saving ===
-    dyn.atoms.write('MACE_MTD_committee_system.xyz', append=True, write_results=False)
-
-    t_fs = dyn.get_time() / units.fs
-    time_fs.append(t_fs)
-    temperatures.append(dyn.atoms.get_temperature())
-
-    for i, e in enumerate(atoms_copy.calc.results['energies']):
-        energies_all[i].append(e / len(dyn.atoms))
-    committee_energies.append(atoms_copy.calc.results['energy'] / len(dyn.atoms))
-
-    variance = atoms_copy.calc.results['energy_var']
-    variances.append(variance)
-
+    trajectory.write(dyn.atoms)
+
+    # Results of the last force call on the live atoms; nothing is copied here
+    results = mace_committee.results
+    variance = results['energy_var']
+    mtd_log.append(
+        dyn.get_time() / units.fs,
+        dyn.atoms.get_temperature(),
+        variance,
+        results['energy'] / len(dyn.atoms),
+        np.asarray(results['energies']) / len(dyn.atoms),
+    )
+
+    # Only frames that make it into the top-K heap are copied
     if variance is not None and variance >= args.variance_limit:
-        atoms_copy.info['variance'] = variance
-        frames_with_variance.append((variance, atoms_copy))
-
-    # === Plot updates ===
-    ax[0].axhline(y=args.variance_limit, color='r', linestyle=':')
-    ax[0].plot(time_fs, variances, color="y")
-    ax[0].set_ylabel("Variance")
-    ax[0].legend(["Threshold", "Estimated Variance"])
-
-    ax[1].plot(time_fs, temperatures, color="r")
-    ax[1].set_ylabel("T (K)")
-
-    for i, e_list in enumerate(energies_all):
-    #ax[2].plot(time_fs, e_list, label=f"E mace{i+1}")
-    ax[2].plot(time_fs, committee_energies, color="black", label="E committee")
-    ax[2].set_ylabel("E (eV/atom)")
-    ax[2].set_xlabel("Time (fs)")
-    ax[2].legend(loc='upper left')
+        has_room = args.max_frames is None or len(frames_with_variance) < args.max_frames
+        if has_room or variance > frames_with_variance[0][0]:
+            snapshot = dyn.atoms.copy()
+            snapshot.info['variance'] = variance
+            entry = (variance, n_candidates, snapshot)
+            if has_room:
+                heapq.heappush(frames_with_variance, entry)
+            else:
+                heapq.heapreplace(frames_with_variance, entry)
+        n_candidates += 1
 
 dyn.attach(write_frame, interval=args.interval)
 
@@ -131,17 +132,24 @@ try:
     dyn.run(args.nsteps)
 except StopMD:
     print("Simulation stopped early by CV or variance threshold.")
+finally:
+    colvar.close()
+    trajectory.close()
+    mtd_log.save(args.log_file, args.variance_limit)
 
 # === Ensure at least the last frame is saved ===
 if not frames_with_variance:
     last_frame = atoms.copy()
     last_frame.calc = mace_committee
     last_frame.info['variance'] = None  # no variance exceeded
-    frames_with_variance.append((None, last_frame))
+    frames_with_variance.append((None, 0, last_frame))
+else:
+    print(f"Kept {len(frames_with_variance)} of {n_candidates} frames above the variance limit.")
 
 # === Output filtered frames ===
-sorted_frames = [atoms for _, atoms in sorted(frames_with_variance, key=lambda x: (x[0] if x[0] is not None else -1), reverse=True)]
+sorted_frames = [atoms for _, _, atoms in sorted(frames_with_variance, key=lambda x: (-x[0] if x[0] is not None else 1, x[1]))]
 write('frames_for_DFT_eval.xyz', sorted_frames, format='extxyz', write_results=False)
 
-plt.tight_layout()
-plt.savefig('mace_mtd_committee_analysis.png', dpi=300)
+# === Plot the monitored data once, after the MD loop ===
+if not args.no_plot:
+    plot_mtd_log(args.log_file, 'mace_mtd_committee_analysis.png')
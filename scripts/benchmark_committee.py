@@ -0,0 +1,72 @@
+import argparse
+import time
+import numpy as np
+import torch
+from ase.io import read
+from mace.calculators import MACECalculator
+from committee_calculator import CommitteeCalculator
+
+# === Benchmark: committee evaluation of the MTD propagators ===
+# Compares MACECalculator, which evaluates the committee members one after
+# another, with CommitteeCalculator on the same structure, and checks both
+# give the same energies, forces and energy variance. Each evaluation uses
+# slightly displaced positions, as in an MD step.
+
+parser = argparse.ArgumentParser(description="Benchmark sequential vs single-pass MACE committee evaluation")
+parser.add_argument("--structure", type=str, required=True, help="Structure file (first frame is used)")
+parser.add_argument("--model_paths", type=str, nargs='+', required=True, help="Committee model paths")
+parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu",
+                    help="Torch device (default: cuda if available, else cpu)")
+parser.add_argument("--default_dtype", default="float64", help="Model dtype")
+parser.add_argument("--n_evals", type=int, default=20, help="Timed evaluations per calculator")
+parser.add_argument("--n_warmup", type=int, default=2, help="Untimed evaluations per calculator")
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+atoms = read(args.structure)
+rng = np.random.default_rng(args.seed)
+displacements = [rng.normal(scale=1e-3, size=(len(atoms), 3)) for _ in range(args.n_warmup + args.n_evals)]
+
+
+def displaced(positions):
+    frame = atoms.copy()
+    frame.set_positions(positions)
+    return frame
+
+
+def run(calc):
+    """Return (seconds per evaluation, results of the last evaluation)."""
+    positions = atoms.get_positions()
+    for k, dx in enumerate(displacements):
+        if k == args.n_warmup:
+            if str(args.device).startswith("cuda"):
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+        calc.calculate(displaced(positions + dx), ["energy", "forces"])
+    if str(args.device).startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t0) / args.n_evals, calc.results
+
+
+calculators = [
+    ("sequential", MACECalculator(model_paths=args.model_paths, device=args.device, default_dtype=args.default_dtype)),
+    ("committee", CommitteeCalculator(model_paths=args.model_paths, device=args.device,
+                                      default_dtype=args.default_dtype, parallel=False)),
+    ("parallel", CommitteeCalculator(model_paths=args.model_paths, device=args.device,
+                                     default_dtype=args.default_dtype, parallel=True)),
+]
+
+print(f"{len(atoms)} atoms, {len(args.model_paths)} models, device {args.device}")
+t_ref, ref = None, None
+for name, calc in calculators:
+    t_eval, results = run(calc)
+    if ref is None:
+        t_ref, ref = t_eval, results
+        print(f"{name:<10}: {1000 * t_eval:8.1f} ms/eval  ({1 / t_eval:6.2f} evals/s)")
+        continue
+    same = (np.isclose(results["energy"], ref["energy"])
+            and np.allclose(results["forces"], ref["forces"])
+            and np.isclose(results["energy_var"], ref["energy_var"]))
+    status = "same results" if same else "DIFFERENT results"
+    print(f"{name:<10}: {1000 * t_eval:8.1f} ms/eval  ({1 / t_eval:6.2f} evals/s, {status}, "
+          f"speed-up x{t_ref / t_eval:.2f})")
@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from ase.calculators.calculator import Calculator, all_changes
+from ase.stress import full_3x3_to_voigt_6_stress
+from mace import data as mace_data
+from mace.calculators import MACECalculator
+from mace.tools import torch_geometric, torch_tools
+
+
+class CommitteeCalculator(MACECalculator):
+    """
+    MACE committee evaluated in one pass per structure.
+
+    The neighbour list and graph are built once per call and shared by all
+    members, with the floating point fields cast to the committee dtype once
+    rather than per member. Stress is only computed when ASE asks for it, so
+    MD steps pay for energies and forces alone. When parallel is enabled the
+    member forward/backward passes overlap: each member runs on its own CUDA
+    stream on a GPU, or in a thread of a small pool on a CPU-only node
+    (with the intra-op threads split between members).
+
+    With skin > 0 the neighbour list is a Verlet list: the graph is built
+    with cutoff r_max + skin and reused, with the edges longer than r_max
+    masked out, until an atom has moved more than skin / 2 since the last
+    build (or the cell, PBC or species change). MACE's radial cutoff makes
+    edges beyond r_max contribute nothing, so the results do not depend on
+    the skin.
+
+    Results use the committee layout read by the MTD propagators: energy,
+    forces and stress are committee means, energies holds one total energy
+    per member, and energy_var / forces_var are the committee variances.
+    """
+
+    def __init__(self, model_paths=None, device="cpu", parallel=None, skin=0.0, **kwargs):
+        super().__init__(model_paths=model_paths, device=device, **kwargs)
+        self.skin = skin
+        self.neighbour_list = None
+        self.n_neighbour_builds = 0
+        dtypes = {next(model.parameters()).dtype for model in self.models}
+        if len(dtypes) != 1:
+            raise ValueError(f"Committee members have different dtypes: {sorted(map(str, dtypes))}")
+        self.model_dtype = dtypes.pop()
+
+        if parallel is None:
+            parallel = self.num_models > 1 and str(self.device).startswith("cuda")
+        self.parallel = parallel and self.num_models > 1
+        self.streams = None
+        self.executor = None
+        if self.parallel:
+            if str(self.device).startswith("cuda"):
+                self.streams = [torch.cuda.Stream(device=self.device) for _ in self.models]
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.num_models)
+                self.threads_per_member = max(1, torch.get_num_threads() // self.num_models)
+
+    def _run_member(self, i, batch_dict, compute_stress):
+        """Run committee member i on its own copy of the shared graph."""
+        member_dict = dict(batch_dict)
+        member_dict["positions"] = batch_dict["positions"].detach().clone()
+        if self.executor is not None:
+            torch.set_num_threads(self.threads_per_member)
+        if self.streams is not None:
+            stream = self.streams[i]
+            stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(stream):
+                out = self.models[i](member_dict, compute_stress=compute_stress, training=False)
+                return {k: out[k].detach() for k in ("energy", "forces", "stress") if out.get(k) is not None}
+        out = self.models[i](member_dict, compute_stress=compute_stress, training=False)
+        return {k: out[k].detach() for k in ("energy", "forces", "stress") if out.get(k) is not None}
+
+    def _cast(self, batch):
+        """Return batch as a dict with floating point fields in the committee dtype."""
+        return {
+            key: value.to(dtype=self.model_dtype) if torch.is_tensor(value) and torch.is_floating_point(value) else value
+            for key, value in batch.to_dict().items()
+        }
+
+    def _needs_neighbour_build(self, atoms):
+        nl = self.neighbour_list
+        if nl is None or len(atoms) != len(nl["positions"]):
+            return True
+        if not (np.array_equal(atoms.numbers, nl["numbers"]) and np.array_equal(atoms.pbc, nl["pbc"])
+                and np.array_equal(atoms.cell.array, nl["cell"])):
+            return True
+        displacement2 = np.sum((atoms.positions - nl["positions"]) ** 2, axis=1)
+        return displacement2.max() > (0.5 * self.skin) ** 2
+
+    def _graph(self, atoms):
+        """Return the graph of atoms, reusing the Verlet neighbour list when skin > 0."""
+        if self.skin <= 0:
+            self.n_neighbour_builds += 1
+            return self._cast(self._atoms_to_batch(atoms))
+
+        if self._needs_neighbour_build(atoms):
+            self.arrays_keys.update({self.charges_key: "charges"})
+            keyspec = mace_data.KeySpecification(info_keys=self.info_keys, arrays_keys=self.arrays_keys)
+            with torch_tools.default_dtype(self.default_dtype):
+                config = mace_data.config_from_atoms(atoms, key_specification=keyspec, head_name=self.head)
+                graph = mace_data.AtomicData.from_config(
+                    config, z_table=self.z_table, cutoff=self.r_max + self.skin, heads=self.available_heads
+                )
+            self.neighbour_list = {
+                "graph": self._cast(torch_geometric.Batch.from_data_list([graph]).to(self.device)),
+                "positions": atoms.positions.copy(),
+                "numbers": atoms.numbers.copy(),
+                "pbc": atoms.pbc.copy(),
+                "cell": atoms.cell.array.copy(),
+            }
+            self.n_neighbour_builds += 1
+
+        graph = dict(self.neighbour_list["graph"])
+        positions = torch.tensor(atoms.positions, dtype=self.model_dtype, device=self.device)
+        sender, receiver = graph["edge_index"]
+        vectors = positions[receiver] - positions[sender] + graph["shifts"]
+        within = torch.sum(vectors ** 2, dim=1) < self.r_max ** 2
+        graph["positions"] = positions
+        graph["edge_index"] = graph["edge_index"][:, within]
+        graph["shifts"] = graph["shifts"][within]
+        graph["unit_shifts"] = graph["unit_shifts"][within]
+        return graph
+
+    # pylint: disable=dangerous-default-value
+    def calculate(self, atoms=None, properties=None, system_changes=all_changes):
+        Calculator.calculate(self, atoms)
+
+        batch_dict = self._graph(atoms)
+        num_atoms = len(atoms)
+        compute_stress = self.model_type == "MACE" and "stress" in (properties or [])
+
+        if self.executor is not None:
+            # The member threads set their own intra-op thread count, which also
+            # changes the process-wide setting; restore it for the rest of the
+            # propagator (descriptor model, native bias, ...)
+            n_threads = torch.get_num_threads()
+            try:
+                outs = list(self.executor.map(lambda i: self._run_member(i, batch_dict, compute_stress),
+                                              range(self.num_models)))
+            finally:
+                torch.set_num_threads(n_threads)
+        else:
+            outs = [self._run_member(i, batch_dict, compute_stress) for i in range(self.num_models)]
+        if self.streams is not None:
+            for stream in self.streams:
+                torch.cuda.current_stream(self.device).wait_stream(stream)
+
+        e_conv = self.energy_units_to_eV
+        f_conv = self.energy_units_to_eV / self.length_units_to_A
+        energies = torch.stack([out["energy"].reshape(-1)[0] for out in outs]).cpu().numpy() * e_conv
+        forces = torch.stack([out["forces"][:num_atoms] for out in outs]).cpu().numpy() * f_conv
+
+        self.results = {
+            "energy": float(energies.mean()),
+            "free_energy": float(energies.mean()),
+            "energies": energies,
+            "forces": forces.mean(axis=0),
+        }
+        if compute_stress:
+            s_conv = self.energy_units_to_eV / self.length_units_to_A**3
+            stress = torch.stack([out["stress"].reshape(-1, 3, 3)[0] for out in outs]).mean(dim=0)
+            self.results["stress"] = full_3x3_to_voigt_6_stress(stress.cpu().numpy() * s_conv)
+        if self.num_models > 1:
+            self.results["energy_comm"] = energies
+            self.results["energy_var"] = float(energies.var())
+            self.results["forces_comm"] = forces
+            self.results["forces_var"] = forces.var(axis=0)
+
+    def __del__(self):
+        if getattr(self, "executor", None) is not None:
+            self.executor.shutdown(wait=False)
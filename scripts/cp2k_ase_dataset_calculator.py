@@ -1,8 +1,17 @@
 import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import multiprocessing
 import numpy as np
-from ase.io import read, write
+from collections import OrderedDict
+from ase.io import iread, read, write
 from ase.calculators.cp2k import CP2K
 import os
+import queue
+import time
+from wfn_restart import find_wfn, nearest_frame, report_scf_steps, scf_summary, set_scf_guess, similarity_order
 
 # CP2K input string
 inp = """
@@ -102,8 +111,15 @@ def parse_args():
     parser.add_argument('--start', type=int, help='Start index (inclusive) for a range.')
     parser.add_argument('--end', type=int, default=50 , help='End index (exclusive) for a range.')
     parser.add_argument('--cp2k-label', type=str, default='cp2k_calc', help='Label prefix for CP2K runs.')
-    parser.add_argument('--output', type=str, default='cp2k_results.extxyz', help='Output extxyz file with energy and forces.')
-    parser.add_argument('--checkpoint', type=str, default='cp2k_completed_indices.txt', help='Checkpoint file to store completed indices.')
+    parser.add_argument('--output', type=str, default='cp2k_results.extxyz', help='Output extxyz file with energy and forces, generated from the journal.')
+    parser.add_argument('--journal', type=str, default='cp2k_results.journal', help='Result journal; frames recorded in it are not recomputed on resume.')
+    parser.add_argument('--checkpoint', type=str, default='cp2k_completed_indices.txt', help='Checkpoint file of completed indices from older versions; imported once, with --output, into an empty journal.')
+    parser.add_argument('--export_only', action='store_true', help='Only write --output from the journal, without computing anything.')
+    parser.add_argument('--stream', action='store_true', help='Stream frames from --xyz (ase.io.iread) instead of loading the whole file; frames are processed in file order.')
+    parser.add_argument('--reuse_wfn', action='store_true', help='Start each SCF from the converged wavefunction of the closest frame computed so far (atomic guess if that fails); without --stream, frames are computed in similarity order.')
+    parser.add_argument('--pool_size', type=int, default=0, help='Keep up to this many CP2K shells alive (one per composition and cell) and only update the positions between frames; 0 starts a new shell per frame.')
+    parser.add_argument('--workers', type=int, default=1, help='Hand the frames out in chunks, as they are read, to this many parallel CP2K workers, each pinned to its own share of the cores and writing its CP2K files to <cp2k-label>_worker<k>/. Results go to the shared --journal.')
+    parser.add_argument('--cores', type=int, default=None, help='Number of cores to divide among the workers (default: all cores this process may run on).')
     return parser.parse_args()
 
 def select_indices(args, total):
@@ -116,76 +132,373 @@ def select_indices(args, total):
     else:
         raise ValueError("Please provide --indices, or --start/--end to define which frames to calculate.")
 
+def iter_selected_frames(args):
+    """Yield (index, atoms) for the selected frames of args.xyz."""
+    if not args.stream:
+        atoms_list = read(args.xyz, index=":")
+        for i in select_indices(args, len(atoms_list)):
+            yield i, atoms_list[i]
+        return
+
+    # Without a known total, an open --end range streams to the end of the file.
+    if args.indices:
+        wanted = set(args.indices)
+        last = max(wanted)
+    elif args.start is not None or args.end is not None:
+        start = args.start if args.start is not None else 0
+        wanted = None
+        last = args.end - 1 if args.end is not None else None
+    else:
+        raise ValueError("Please provide --indices, or --start/--end to define which frames to calculate.")
+
+    for i, atoms in enumerate(iread(args.xyz, index=":")):
+        if last is not None and i > last:
+            break
+        if (wanted is None and i >= start) or (wanted is not None and i in wanted):
+            yield i, atoms
+
 def load_checkpoint(path):
     if not os.path.isfile(path):
-        return set()
+        return []
     with open(path, 'r') as f:
-        return set(int(line.strip()) for line in f if line.strip().isdigit())
+        return [int(line.strip()) for line in f if line.strip().isdigit()]
+
+class ResultJournal:
+    """
+    Append-only journal of finished frames with one checksummed record per frame.
+
+    A record is a header line "<index>\t<length>\t<sha1>" followed by the
+    frame with its results as extxyz text (length bytes). It is appended
+    with a single write and fsync, so a frame counts as finished exactly
+    when its whole record is on disk: a kill during an append leaves an
+    incomplete record at the end, which fails its checksum and is dropped
+    by repair(), and the frame is recomputed. The extxyz output is
+    generated from the journal (export), so it never disagrees with it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _scan(self):
+        """Return ([(index, extxyz bytes)] of the intact records, bytes they span)."""
+        if not os.path.isfile(self.path):
+            return [], 0
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        records, pos = [], 0
+        while pos < len(data):
+            end = data.find(b"\n", pos)
+            if end == -1:
+                break
+            try:
+                index, length, checksum = data[pos:end].decode().split("\t")
+                index, length = int(index), int(length)
+            except ValueError:
+                break
+            payload = data[end + 1:end + 1 + length]
+            if len(payload) != length or hashlib.sha1(payload).hexdigest() != checksum:
+                break
+            records.append((index, payload))
+            pos = end + 1 + length
+        return records, pos
+
+    def completed(self):
+        return {index for index, _ in self._scan()[0]}
+
+    def repair(self):
+        """Cut an incomplete or corrupt tail left by a killed run; call before any worker appends."""
+        records, valid_bytes = self._scan()
+        if os.path.isfile(self.path) and os.path.getsize(self.path) > valid_bytes:
+            print(f"Dropping {os.path.getsize(self.path) - valid_bytes} bytes of incomplete records from {self.path}")
+            with open(self.path, 'r+b') as f:
+                f.truncate(valid_bytes)
+        return len(records)
+
+    def append(self, index, atoms):
+        buffer = io.StringIO()
+        write(buffer, atoms, format='extxyz')
+        payload = buffer.getvalue().encode()
+        record = f"{index}\t{len(payload)}\t{hashlib.sha1(payload).hexdigest()}\n".encode() + payload
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, record)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def export(self, output_file):
+        """Write the journalled frames, ordered by index, to output_file; return their number."""
+        frames = dict(self._scan()[0])  # a recomputed frame keeps its latest record
+        with open(output_file + '.tmp', 'wb') as f:
+            for index in sorted(frames):
+                f.write(frames[index])
+        os.replace(output_file + '.tmp', output_file)
+        return len(frames)
+
+def import_checkpoint(journal, checkpoint_file, output_file):
+    """
+    Move the results of an older run (checkpoint + output extxyz) into an empty journal.
+
+    Both files were appended frame by frame in the same order, output
+    first, so the k-th index of the checkpoint belongs to the k-th frame of
+    the output; output frames beyond the checkpoint are not trusted.
+    """
+    indices = load_checkpoint(checkpoint_file)
+    if journal.completed() or not indices or not os.path.isfile(output_file):
+        return
+    n_imported = 0
+    for index, atoms in zip(indices, iread(output_file, index=':')):
+        journal.append(index, atoms)
+        n_imported += 1
+    print(f"Imported {n_imported} completed frames from {checkpoint_file} and {output_file} into {journal.path}")
+
+def make_calculator(label, input_text):
+    return CP2K(
+        basis_set=None,
+        basis_set_file=None,
+        max_scf=None,
+        cutoff=None,
+        force_eval_method=None,
+        potential_file=None,
+        poisson_solver=None,
+        pseudo_potential=None,
+        stress_tensor=False,
+        xc=None,
+        inp=input_text,
+        label=label
+    )
+
+class CP2KShellPool:
+    """
+    Long-lived CP2K calculators, one per composition and cell.
+
+    A frame with the same atoms and cell as an earlier one reuses that
+    calculator: its cp2k_shell process and force environment stay alive and
+    only the positions are sent (SET_POS), so process startup, basis set
+    parsing and grid setup are paid once per shell instead of per frame. The
+    SCF then also starts from the shell's previous wavefunction. At most
+    max_shells shells are kept; the least recently used one is closed first.
+    """
 
-def append_checkpoint(path, index):
-    with open(path, 'a') as f:
-        f.write(f"{index}\n")
+    def __init__(self, max_shells, label_prefix, input_text):
+        self.max_shells = max_shells
+        self.label_prefix = label_prefix
+        self.input_text = input_text
+        self.shells = OrderedDict()  # key -> calculator
+        self.n_created = 0
 
-def run_cp2k_calculations(atoms_list, indices, label_prefix, output_file, checkpoint_file):
-    completed = load_checkpoint(checkpoint_file)
+    @staticmethod
+    def key(atoms):
+        return (atoms.numbers.tobytes(), atoms.pbc.tobytes(), np.round(atoms.cell.array, 6).tobytes())
 
-    # Truncate output file if starting from scratch
-    if not os.path.exists(output_file):
-        open(output_file, 'w').close()
+    def get(self, atoms):
+        """Return (calculator, new) for atoms; new is True for a freshly started shell."""
+        key = self.key(atoms)
+        if key in self.shells:
+            self.shells.move_to_end(key)
+            return self.shells[key], False
+        if len(self.shells) >= self.max_shells:
+            _, oldest = self.shells.popitem(last=False)
+            oldest.close()
+        calc = make_calculator(f"{self.label_prefix}_shell{self.n_created}", self.input_text)
+        self.n_created += 1
+        self.shells[key] = calc
+        return calc, True
 
-    for i in indices:
+    def discard(self, atoms):
+        """Close the shell of atoms, e.g. after CP2K failed in it."""
+        calc = self.shells.pop(self.key(atoms), None)
+        if calc is not None:
+            calc.close()
+
+    def close(self):
+        for calc in self.shells.values():
+            calc.close()
+        self.shells.clear()
+
+def run_cp2k_calculations(frames, label_prefix, journal_file, reuse_wfn=False, pool_size=0, lock=None):
+    # lock serialises the journal appends of parallel workers
+    lock = lock if lock is not None else contextlib.nullcontext()
+    journal = ResultJournal(journal_file)
+    completed = journal.completed()
+    computed = {}  # index -> frame whose converged wavefunction is on disk (with reuse_wfn)
+    scf_records = []
+    frame_times = []
+    pool = CP2KShellPool(pool_size, label_prefix, inp) if pool_size else None
+
+    for i, atoms in frames:
+        label = f"{label_prefix}_{i}"
         if i in completed:
             print(f"Skipping frame {i} (already completed).")
+            if reuse_wfn and pool is None and find_wfn('.', label):
+                computed[i] = atoms.copy()
             continue
 
-        atoms = atoms_list[i]
-        calc = CP2K(
-            basis_set=None,
-            basis_set_file=None,
-            max_scf=None,
-            cutoff=None,
-            force_eval_method=None,
-            potential_file=None,
-            poisson_solver=None,
-            pseudo_potential=None,
-            stress_tensor=False,
-            xc=None,
-            inp=inp,
-            label=f"{label_prefix}_{i}"
-        )
-        atoms.calc = calc
+        # Attempts in order: a pooled shell, or the wavefunction of the closest
+        # computed frame; a fresh calculator with the atomic guess is the fallback
+        restart_file, seed = None, None
+        if reuse_wfn and pool is None:
+            seed, distance = nearest_frame(atoms, computed)
+            restart_file = find_wfn('.', f"{label_prefix}_{seed}") if seed is not None else None
+        attempts = ["pool"] if pool is not None else (["restart"] if restart_file else [])
+        start = time.perf_counter()
+        for attempt in attempts + ["atomic"]:
+            new_shell = False
+            if attempt == "pool":
+                calc, new_shell = pool.get(atoms)
+            else:
+                guess_file = restart_file if attempt == "restart" else None
+                calc = make_calculator(label, set_scf_guess(inp, guess_file) if reuse_wfn else inp)
+            # A pooled shell appends every frame to one output file
+            cp2k_out = f"{calc.label}.out"
+            offset = os.path.getsize(cp2k_out) if os.path.exists(cp2k_out) else 0
+            atoms.calc = calc
+
+            try:
+                energy = atoms.get_potential_energy()
+                forces = atoms.get_forces()
+                atoms.info["REF_energy"] = energy
+                atoms.arrays["REF_forces"] = forces
+
+                with lock:
+                    journal.append(i, atoms)
+
+                steps, _ = scf_summary(cp2k_out, offset)
+                guess = "shell" if attempt == "pool" and not new_shell else ("atomic" if attempt == "pool" else attempt)
+                scf_records.append((guess, steps))
+                frame_times.append(time.perf_counter() - start)
+                if reuse_wfn and pool is None:
+                    computed[i] = atoms.copy()
+                    guess += f" from frame {seed}, {distance:.3f} Å RMSD" if attempt == "restart" else ""
+                print(f"Frame {i}: Energy = {energy:.6f} eV, {steps} SCF steps ({guess} guess), "
+                      f"{frame_times[-1]:.1f} s (saved)")
+                break
+
+            except Exception as e:
+                if attempt == "pool":
+                    print(f"Frame {i}: CP2K failed in {calc.label}:\n{e}\nRetrying in a new calculator with atomic guess.")
+                    pool.discard(atoms)
+                elif attempt == "restart":
+                    print(f"Frame {i}: CP2K failed from the wavefunction of frame {seed}:\n{e}\nRetrying with atomic guess.")
+                else:
+                    print(f"Frame {i}: CP2K failed with error:\n{e}\nSkipping.")
+            finally:
+                if attempt != "pool":
+                    calc.close()
+
+    if pool is not None:
+        pool.close()
+    report_scf_steps(scf_records)
+    if frame_times:
+        print(f"Mean wall time per frame: {np.mean(frame_times):.1f} s over {len(frame_times)} frames")
+
+def iter_chunks(chunks):
+    """Yield the frames of the chunks taken from a worker queue, up to the None that ends it."""
+    for chunk in iter(chunks.get, None):
+        yield from chunk
 
+def run_worker(k, chunks, cores, label_prefix, journal_file, lock, reuse_wfn=False, pool_size=0):
+    """Compute the frame chunks of parallel worker k on its cores, with its CP2K files in <label_prefix>_worker<k>/."""
+    # The CP2K shells started below inherit the affinity and thread count
+    os.sched_setaffinity(0, cores)
+    os.environ["OMP_NUM_THREADS"] = str(len(cores))
+    label_dir = f"{label_prefix}_worker{k}"
+    os.makedirs(label_dir, exist_ok=True)
+    print(f"Worker {k}: cores {','.join(map(str, cores))} in {label_dir}/", flush=True)
+    run_cp2k_calculations(iter_chunks(chunks), os.path.join(label_dir, label_prefix), journal_file,
+                          reuse_wfn=reuse_wfn, pool_size=pool_size, lock=lock)
+
+def put_while_alive(chunks, item, workers):
+    """Put item on the bounded worker queue, giving up if no worker is left to take it."""
+    while True:
         try:
-            energy = atoms.get_potential_energy()
-            forces = atoms.get_forces()
-            atoms.info["REF_energy"] = energy
-            atoms.arrays["REF_forces"] = forces
+            chunks.put(item, timeout=5)
+            return
+        except queue.Full:
+            if not any(worker.is_alive() for worker in workers):
+                raise RuntimeError("All CP2K workers exited before the frames were handed out.")
 
-            write(output_file, atoms, append=True)
-            append_checkpoint(checkpoint_file, i)
+def run_parallel(frames, n_workers, label_prefix, journal_file, cores=None, reuse_wfn=False, pool_size=0,
+                 chunk_size=4):
+    """
+    Compute frames with n_workers CP2K worker processes, each on its own subset of the cores.
 
-            print(f"Frame {i}: Energy = {energy:.6f} eV (saved)")
+    Frames are read from the frames iterator as the workers need them and
+    handed out in chunks of chunk_size consecutive frames through a bounded
+    queue, so at most a few chunks per worker are held in memory.
+    Consecutive frames stay together in a chunk (neighbours in similarity
+    order for --reuse_wfn). Frames already in the journal are skipped, and
+    the workers append to the journal under one lock.
+    """
+    completed = ResultJournal(journal_file).completed()
+    print(f"{len(completed)} frames already completed.")
 
-        except Exception as e:
-            print(f"Frame {i}: CP2K failed with error:\n{e}\nSkipping.")
-        finally:
-            calc.close()
+    available = sorted(os.sched_getaffinity(0))[:cores]
+    if n_workers > len(available):
+        raise ValueError(f"{n_workers} workers need at least as many cores, but only {len(available)} are available.")
+
+    ctx = multiprocessing.get_context("fork")
+    lock = ctx.Lock()
+    chunks = ctx.Queue(maxsize=2 * n_workers)
+    core_sets = np.array_split(np.array(available), n_workers)
+    workers = [ctx.Process(target=run_worker,
+                           args=(k, chunks, [int(c) for c in core_sets[k]], label_prefix, journal_file, lock,
+                                 reuse_wfn, pool_size))
+               for k in range(n_workers)]
+    for worker in workers:
+        worker.start()
+
+    remaining = ((i, atoms) for i, atoms in frames if i not in completed)
+    n_frames = 0
+    for chunk in iter(lambda: list(itertools.islice(remaining, chunk_size)), []):
+        put_while_alive(chunks, chunk, workers)
+        n_frames += len(chunk)
+    for _ in workers:
+        put_while_alive(chunks, None, workers)
+    print(f"Handed out {n_frames} frames to compute.", flush=True)
+    for worker in workers:
+        worker.join()
+
+    failed = [k for k, worker in enumerate(workers) if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"CP2K workers {failed} exited with an error; rerun to resume from {journal_file}.")
 
 def main():
     args = parse_args()
 
-    atoms_list = read(args.xyz, index=":")
-    indices = select_indices(args, len(atoms_list))
+    journal = ResultJournal(args.journal)
+    journal.repair()
+    import_checkpoint(journal, args.checkpoint, args.output)
+    if args.export_only:
+        print(f"Wrote {journal.export(args.output)} frames from {args.journal} to {args.output}")
+        return
 
-    run_cp2k_calculations(
-        atoms_list=atoms_list,
-        indices=indices,
-        label_prefix=args.cp2k_label,
-        output_file=args.output,
-        checkpoint_file=args.checkpoint
-    )
+    frames = iter_selected_frames(args)
+    if args.reuse_wfn and not args.stream:
+        frames = list(frames)
+        frames = [frames[k] for k in similarity_order([atoms for _, atoms in frames])]
+
+    if args.workers > 1:
+        run_parallel(
+            frames=frames,
+            n_workers=args.workers,
+            label_prefix=args.cp2k_label,
+            journal_file=args.journal,
+            cores=args.cores,
+            reuse_wfn=args.reuse_wfn,
+            pool_size=args.pool_size
+        )
+    else:
+        run_cp2k_calculations(
+            frames=frames,
+            label_prefix=args.cp2k_label,
+            journal_file=args.journal,
+            reuse_wfn=args.reuse_wfn,
+            pool_size=args.pool_size
+        )
 
-    print(f"Done. Results saved in {args.output}")
+    n_frames = journal.export(args.output)
+    print(f"Done. {n_frames} frames from {args.journal} saved in {args.output}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,247 @@
+import math
+import os
+import signal
+import subprocess
+import time
+
+# === Work-queue scheduler for CP2K single points ===
+# Replaces a static FARMING block (fixed NGROUPS, every job the same size,
+# the batch as slow as its slowest group) by a queue over the core budget
+# of the allocation. Each job gets cores according to its atom count, jobs
+# start largest first and smaller ones backfill the remaining cores, and a
+# job exceeding its time limit (e.g. an SCF stuck in the outer loop) is
+# cancelled and requeued once at the end of the queue with twice the limit
+# before it is given up, so it does not stall the rest of the batch.
+#
+# Jobs run through an executor: SrunExecutor starts srun job steps inside a
+# SLURM allocation, LocalExecutor runs the command directly (no MPI), as a
+# stand-in for testing without SLURM.
+
+CP2K_END_MARKER = "PROGRAM ENDED AT"
+
+
+def core_budget(default=None):
+    """Number of cores of the SLURM allocation, or of this machine outside SLURM."""
+    env = os.environ
+    cpus_per_task = int(env.get("SLURM_CPUS_PER_TASK", 1))
+    if "SLURM_NTASKS" in env:
+        return int(env["SLURM_NTASKS"]) * cpus_per_task
+    if "SLURM_JOB_NUM_NODES" in env and "SLURM_CPUS_ON_NODE" in env:
+        return int(env["SLURM_JOB_NUM_NODES"]) * int(env["SLURM_CPUS_ON_NODE"])
+    return default or os.cpu_count()
+
+
+def cores_for_atoms(n_atoms, atoms_per_core=2.0, granularity=64, max_cores=None):
+    """Cores for one structure: one per atoms_per_core atoms, rounded up to a multiple of granularity."""
+    cores = math.ceil(math.ceil(n_atoms / atoms_per_core) / granularity) * granularity
+    return min(cores, max_cores) if max_cores else cores
+
+
+def count_atoms(xyz_path):
+    """Atom count from the first line of an (ext)xyz file, without parsing the frame."""
+    with open(xyz_path, "r") as f:
+        return int(f.readline())
+
+
+def job_finished(output_path):
+    """True if a CP2K output file exists and CP2K ran to its end."""
+    if not os.path.isfile(output_path):
+        return False
+    with open(output_path, "rb") as f:
+        f.seek(max(0, os.path.getsize(output_path) - 4096))
+        return CP2K_END_MARKER.encode() in f.read()
+
+
+class LocalExecutor:
+    """Runs the command directly in the job directory, with one OpenMP thread per core."""
+
+    def launch(self, command, run_dir, cores):
+        env = dict(os.environ, OMP_NUM_THREADS=str(cores))
+        with open(os.path.join(run_dir, "cp2k.err"), "w") as err:
+            return subprocess.Popen(command, shell=True, cwd=run_dir, env=env, stderr=err, start_new_session=True)
+
+
+class SrunExecutor:
+    """Runs the command as an srun job step of cores / SLURM_CPUS_PER_TASK MPI ranks."""
+
+    def __init__(self):
+        self.cpus_per_task = int(os.environ.get("SLURM_CPUS_PER_TASK", 1))
+        self.cpus_per_node = int(os.environ.get("SLURM_CPUS_ON_NODE", 0))
+
+    def launch(self, command, run_dir, cores):
+        ntasks = max(1, cores // self.cpus_per_task)
+        nodes = "--nodes=1 " if self.cpus_per_node and cores <= self.cpus_per_node else ""
+        srun = f"srun --exact {nodes}--ntasks={ntasks} --cpus-per-task={self.cpus_per_task} {command}"
+        with open(os.path.join(run_dir, "cp2k.err"), "w") as err:
+            return subprocess.Popen(srun, shell=True, cwd=run_dir, stderr=err, start_new_session=True)
+
+
+class Job:
+    def __init__(self, run_dir, n_atoms, cores, timeout):
+        self.run_dir = run_dir
+        self.n_atoms = n_atoms
+        self.cores = cores
+        self.timeout = timeout
+        self.attempts = 0
+        self.process = None
+        self.started = None
+
+    @property
+    def cost(self):
+        # Plane-wave DFT scales roughly cubically with system size
+        return self.n_atoms ** 3
+
+
+class JobScheduler:
+    """
+    Runs CP2K jobs on a fixed core budget, largest first with backfilling.
+
+    Jobs can be submitted while others are running (e.g. frames streamed by
+    the MTD propagator); call poll() regularly, or run() to wait for all.
+    A batch known up front is submitted with start=False, so the first
+    jobs are picked by size from the whole batch rather than in submission
+    order. on_start(job) is called just before a job is launched, and
+    on_finish(job, exit_code) when it ends; if on_finish returns True the
+    job is queued again (e.g. to rerun it with a different input).
+
+    CP2K appends to an existing output file, so an output_name file left in
+    the job directory by an earlier attempt is moved to
+    <output_name>.attempt<k> before the job is launched again.
+    """
+
+    def __init__(self, executor, total_cores, command, timeout=None, max_attempts=2, on_start=None, on_finish=None,
+                 output_name=None):
+        self.executor = executor
+        self.output_name = output_name
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.total_cores = total_cores
+        self.command = command
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.pending = []
+        self.running = []
+        self.completed = {}  # run_dir -> exit code
+        self.failed = []  # run_dirs given up after max_attempts time limits
+
+    @property
+    def free_cores(self):
+        return self.total_cores - sum(job.cores for job in self.running)
+
+    def submit(self, run_dir, n_atoms, cores, start=True):
+        """Queue a job; with start=False it waits for the next poll() or run()."""
+        self.pending.append(Job(run_dir, n_atoms, min(cores, self.total_cores), self.timeout))
+        if start:
+            self._start_ready()
+
+    def _set_aside_output(self, job):
+        if self.output_name is None:
+            return
+        output = os.path.join(job.run_dir, self.output_name)
+        if os.path.exists(output):
+            k = 1
+            while os.path.exists(f"{output}.attempt{k}"):
+                k += 1
+            os.replace(output, f"{output}.attempt{k}")
+
+    def _start_ready(self):
+        # Requeued jobs go after all first attempts; within an attempt, largest first
+        self.pending.sort(key=lambda job: (job.attempts, -job.cost))
+        for job in list(self.pending):
+            if job.cores <= self.free_cores:
+                self.pending.remove(job)
+                job.attempts += 1
+                self._set_aside_output(job)
+                if self.on_start is not None:
+                    self.on_start(job)
+                job.started = time.monotonic()
+                job.process = self.executor.launch(self.command, job.run_dir, job.cores)
+                self.running.append(job)
+                print(f"Started {job.run_dir}: {job.n_atoms} atoms on {job.cores} cores"
+                      f"{f' (attempt {job.attempts})' if job.attempts > 1 else ''}", flush=True)
+
+    def _cancel(self, job):
+        try:
+            os.killpg(job.process.pid, signal.SIGTERM)
+            job.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(job.process.pid, signal.SIGKILL)
+            job.process.wait()
+        except ProcessLookupError:
+            pass
+
+    def poll(self):
+        """Collect finished jobs, cancel timed-out ones and start queued jobs on the freed cores."""
+        now = time.monotonic()
+        for job in list(self.running):
+            code = job.process.poll()
+            if code is None and job.timeout is not None and now - job.started > job.timeout:
+                self._cancel(job)
+                self.running.remove(job)
+                if job.attempts < self.max_attempts:
+                    print(f"⚠️ {job.run_dir} exceeded {job.timeout:.0f} s, requeued", flush=True)
+                    job.timeout *= 2
+                    self.pending.append(job)
+                else:
+                    print(f"⚠️ {job.run_dir} exceeded {job.timeout:.0f} s, cancelled", flush=True)
+                    self.failed.append(job.run_dir)
+            elif code is not None:
+                self.running.remove(job)
+                print(f"{'✅' if code == 0 else '⚠️'} {job.run_dir} finished in {now - job.started:.0f} s "
+                      f"with exit code {code}", flush=True)
+                if self.on_finish is not None and self.on_finish(job, code):
+                    self.pending.append(job)
+                else:
+                    self.completed[job.run_dir] = code
+        self._start_ready()
+        return bool(self.pending or self.running)
+
+    def discard(self, run_dirs):
+        """Forget the jobs of run_dirs, cancelling those still running (e.g. frames of a superseded stream)."""
+        run_dirs = set(run_dirs)
+        for job in [job for job in self.running if job.run_dir in run_dirs]:
+            self._cancel(job)
+            self.running.remove(job)
+        self.pending = [job for job in self.pending if job.run_dir not in run_dirs]
+        self.completed = {run_dir: code for run_dir, code in self.completed.items() if run_dir not in run_dirs}
+        self.failed = [run_dir for run_dir in self.failed if run_dir not in run_dirs]
+
+    def run(self, poll_interval=5.0):
+        """Wait until every submitted job has finished or been given up."""
+        while self.poll():
+            time.sleep(poll_interval)
+
+
+def add_scheduler_arguments(parser):
+    """Command-line options shared by the scripts running CP2K through JobScheduler."""
+    parser.add_argument("--cp2k_cmd", type=str, default="cp2k.psmp",
+                        help="CP2K executable; '-i sp.inp -o sp.out' is appended")
+    parser.add_argument("--launcher", choices=["srun", "local"], default=None,
+                        help="Start jobs as srun steps or as local processes (default: srun inside SLURM)")
+    parser.add_argument("--total_cores", type=int, default=None,
+                        help="Core budget (default: from the SLURM environment, else all cores of this machine)")
+    parser.add_argument("--atoms_per_core", type=float, default=2.0, help="Atoms per core when sizing a job")
+    parser.add_argument("--core_granularity", type=int, default=64, help="Job sizes are multiples of this")
+    parser.add_argument("--max_cores_per_job", type=int, default=None, help="Upper limit of a job's cores")
+    parser.add_argument("--job_timeout", type=float, default=None,
+                        help="Seconds before a job is cancelled and requeued with twice the limit")
+    parser.add_argument("--max_attempts", type=int, default=2, help="Attempts of a job that keeps timing out")
+    parser.add_argument("--poll_interval", type=float, default=5.0, help="Seconds between scheduler checks")
+
+
+def scheduler_from_args(args, input_name="sp.inp", output_name="sp.out", on_start=None, on_finish=None):
+    """Return the JobScheduler and the job sizing function set up by add_scheduler_arguments options."""
+    launcher = args.launcher or ("srun" if "SLURM_JOB_ID" in os.environ else "local")
+    executor = SrunExecutor() if launcher == "srun" else LocalExecutor()
+    total_cores = args.total_cores or core_budget()
+    granularity = min(args.core_granularity, total_cores)
+    scheduler = JobScheduler(executor, total_cores, f"{args.cp2k_cmd} -i {input_name} -o {output_name}",
+                             timeout=args.job_timeout, max_attempts=args.max_attempts,
+                             on_start=on_start, on_finish=on_finish, output_name=output_name)
+
+    def size(n_atoms):
+        return cores_for_atoms(n_atoms, args.atoms_per_core, granularity,
+                               max_cores=min(args.max_cores_per_job or total_cores, total_cores))
+
+    print(f"Scheduling CP2K jobs on {total_cores} cores with the {launcher} launcher", flush=True)
+    return scheduler, size
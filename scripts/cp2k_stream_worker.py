@@ -0,0 +1,89 @@
+import argparse
+import os
+import shutil
+import sys
+from ase.io import read
+from cp2k_scheduler import add_scheduler_arguments, scheduler_from_args
+from dft_stream import follow_stream, stream_exit_code
+from parse_cp2k_farmed_to_extxyz import collect_cp2k_results
+from prepare_cp2k_farming_jobs import output_input_name, output_log_name, output_prefix, write_job
+from wfn_restart import WavefunctionSeeder, report_scf_steps
+
+# === Streaming CP2K single points ===
+# Follows the frame stream written by the MTD propagator (--stream_dir) and
+# queues a CP2K single point for each frame as soon as it is accepted, so
+# the DFT allocation works while sampling is still running. Jobs run through
+# the load-balancing scheduler of cp2k_scheduler.py (core budget from SLURM,
+# jobs sized by atom count, per-job timeouts). Frame k of the stream is
+# computed in run<k>/, laid out like the jobs of prepare_cp2k_farming_jobs.py,
+# and the results are collected into the same cp2k_farmed_dataset.xyz once
+# the stream is closed.
+#
+# Usage (inside the CP2K allocation):
+#   python cp2k_stream_worker.py --stream_dir /shared/dft_stream --template template.inp --job_timeout 3600
+
+parser = argparse.ArgumentParser(description="Run CP2K single points on frames streamed by the MTD propagator")
+parser.add_argument("--stream_dir", type=str, required=True, help="Directory the propagator streams frames to")
+parser.add_argument("--template", type=str, default="template.inp", help="CP2K input template with @CELL@")
+parser.add_argument("--idle_timeout", type=float, default=None,
+                    help="Stop following after this many seconds without a new frame or the end of the stream "
+                         "(e.g. the propagator was killed), counted from when the stream opens; the frames "
+                         "received so far are still computed and collected, and the worker exits with 1")
+parser.add_argument("--output", type=str, default="cp2k_farmed_dataset.xyz", help="Output extxyz dataset")
+parser.add_argument("--reuse_wfn", action="store_true",
+                    help="Seed each job with the converged wavefunction of the closest finished job")
+add_scheduler_arguments(parser)
+args = parser.parse_args()
+
+with open(args.template, "r") as f:
+    template_text = f.read()
+
+seeder = WavefunctionSeeder(output_input_name, output_log_name) if args.reuse_wfn else None
+scheduler, size = scheduler_from_args(args, output_input_name, output_log_name,
+                                      on_start=seeder.on_start if seeder else None,
+                                      on_finish=seeder.on_finish if seeder else None)
+
+# follow_stream sleeps between checks for new frames; the scheduler is
+# polled at the same pace, so finished jobs free their cores meanwhile.
+run_dirs = []
+
+
+def discard_stream():
+    # A fresh propagator replaced the stream: the jobs of its frames are
+    # cancelled and their run directories removed, so they are not collected
+    scheduler.discard(run_dirs)
+    if seeder is not None:
+        seeder.remove_frames(run_dirs)
+    for run_dir in run_dirs:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    print(f"Discarded {len(run_dirs)} jobs of the superseded stream.", flush=True)
+    run_dirs.clear()
+
+
+print(f"Following frames in {args.stream_dir}...", flush=True)
+abandoned = False
+try:
+    for frame_path in follow_stream(args.stream_dir, args.poll_interval, args.idle_timeout,
+                                    on_wait=scheduler.poll, on_restart=discard_stream):
+        frame = read(frame_path)
+        run_dir = f"{output_prefix}{len(run_dirs) + 1}"
+        write_job(frame, run_dir, template_text)
+        if seeder is not None:
+            seeder.add_frame(run_dir, frame)
+        scheduler.submit(run_dir, len(frame), size(len(frame)))
+        run_dirs.append(run_dir)
+except TimeoutError as e:
+    # The propagator died without closing the stream (e.g. killed at its walltime);
+    # the frames received so far are still computed and collected
+    print(f"⚠️ {e}; the propagator is presumed dead.", flush=True)
+    abandoned = True
+else:
+    print(f"Stream closed by the propagator (exit code {stream_exit_code(args.stream_dir)}) after {len(run_dirs)} frames.",
+          flush=True)
+scheduler.run(args.poll_interval)
+print("All CP2K jobs finished.")
+if seeder is not None:
+    report_scf_steps(seeder.records)
+collect_cp2k_results(run_prefix=output_prefix, output=args.output)
+if abandoned or not os.path.isfile(args.output):
+    sys.exit(1)
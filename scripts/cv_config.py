@@ -0,0 +1,166 @@
+import json
+import numpy as np
+from ase.geometry import get_distances
+
+# === Declarative CV/bias configuration for the MTD propagator ===
+# A YAML or JSON file describes the atom groups, CVs, walls, METAD bias and
+# stop conditions of a system, instead of hard-coding PLUMED atom indices
+# in a copy of the propagator. Atom groups are resolved once, on the
+# initial structure, from any combination of:
+#
+#   indices: [216, 218]        0-based atom indices
+#   plumed: "219-221,39"       1-based PLUMED atom list
+#   element: N | [O, Si]       chemical symbol(s)
+#   z_below / z_above: 2.6     position along z (Å)
+#   within: {group: g, cutoff: 3.0}   closer than cutoff to an atom of group g
+#   nearest: {group: g, count: 4}     the count atoms closest to group g
+#   group: g                   the atoms of another group
+#
+# All selectors of one group are intersected; "within" and "nearest"
+# never select atoms of the reference group itself. See
+# input/mtd_cv_config.yaml for the TDMAS/SiO2 system.
+
+
+def load_cv_config(path):
+    """Load a CV/bias configuration from a .yaml/.yml or .json file."""
+    with open(path, "r") as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def _distances_to(atoms, candidates, reference):
+    """Minimum image distance from each candidate atom to its nearest reference atom."""
+    _, dist = get_distances(atoms.positions[candidates], atoms.positions[reference],
+                            cell=atoms.cell, pbc=atoms.pbc)
+    return dist.min(axis=1)
+
+
+def resolve_groups(config, atoms):
+    """Return {group name: sorted 0-based indices} for config["groups"] on atoms."""
+    specs = config.get("groups", {})
+    resolved = {}
+    resolving = set()
+
+    def resolve(name):
+        if name in resolved:
+            return resolved[name]
+        if name not in specs:
+            raise ValueError(f"Unknown atom group '{name}'")
+        if name in resolving:
+            raise ValueError(f"Atom group '{name}' refers to itself")
+        resolving.add(name)
+        spec = specs[name]
+        if isinstance(spec, (list, int)):
+            spec = {"indices": spec if isinstance(spec, list) else [spec]}
+
+        selected = np.ones(len(atoms), dtype=bool)
+        if "indices" in spec:
+            mask = np.zeros(len(atoms), dtype=bool)
+            mask[np.asarray(spec["indices"], dtype=int)] = True
+            selected &= mask
+        if "plumed" in spec:
+            from native_bias import parse_atom_list
+            mask = np.zeros(len(atoms), dtype=bool)
+            mask[parse_atom_list(spec["plumed"])] = True
+            selected &= mask
+        if "element" in spec:
+            elements = spec["element"] if isinstance(spec["element"], list) else [spec["element"]]
+            selected &= np.isin(atoms.get_chemical_symbols(), elements)
+        if "z_below" in spec:
+            selected &= atoms.positions[:, 2] < spec["z_below"]
+        if "z_above" in spec:
+            selected &= atoms.positions[:, 2] > spec["z_above"]
+        if "group" in spec:
+            mask = np.zeros(len(atoms), dtype=bool)
+            mask[resolve(spec["group"])] = True
+            selected &= mask
+        if "within" in spec:
+            reference = resolve(spec["within"]["group"])
+            selected[reference] = False
+            candidates = np.flatnonzero(selected)
+            if len(candidates):
+                close = _distances_to(atoms, candidates, reference) < spec["within"]["cutoff"]
+                selected[candidates[~close]] = False
+        if "nearest" in spec:
+            reference = resolve(spec["nearest"]["group"])
+            selected[reference] = False
+            candidates = np.flatnonzero(selected)
+            order = np.argsort(_distances_to(atoms, candidates, reference), kind="stable") if len(candidates) else []
+            selected[:] = False
+            selected[candidates[order[:spec["nearest"]["count"]]]] = True
+
+        indices = np.flatnonzero(selected).tolist()
+        if not indices:
+            raise ValueError(f"Atom group '{name}' selects no atoms")
+        resolving.discard(name)
+        resolved[name] = indices
+        return indices
+
+    for name in specs:
+        resolve(name)
+    return resolved
+
+
+def _plumed_atoms(indices):
+    return ",".join(str(i + 1) for i in indices)
+
+
+def plumed_bias_lines(config, groups, defaults, metad_suffix=""):
+    """
+    Return the PLUMED lines (CVs, walls, METAD, PRINT) described by config.
+
+    METAD keys missing from config["metad"] (height, pace, sigma,
+    biasfactor, temp, grid_min, grid_max) and the PRINT stride are taken
+    from defaults, i.e. the propagator's command-line arguments.
+    metad_suffix is appended to the METAD line (e.g. WALKERS_* keywords).
+    """
+    lines, cv_names = [], []
+    for cv in config["cvs"]:
+        cv_type = cv.get("type", "COORDINATION").upper()
+        if cv_type != "COORDINATION":
+            raise ValueError(f"Unsupported CV type {cv_type}")
+        words = [f"{cv['name']}: COORDINATION",
+                 f"GROUPA={_plumed_atoms(groups[cv['group_a']])}",
+                 f"GROUPB={_plumed_atoms(groups[cv['group_b']])}",
+                 f"R_0={cv['r_0']}"]
+        words += [f"{key.upper()}={cv[key]}" for key in ("nn", "mm", "d_0", "d_max") if key in cv]
+        lines.append(" ".join(words))
+        cv_names.append(cv["name"])
+
+    for wall in config.get("walls", []):
+        words = [f"{wall.get('type', 'LOWER_WALLS').upper()} ARG={wall['arg']} AT={wall['at']} KAPPA={wall['kappa']}"]
+        words += [f"{key.upper()}={wall[key]}" for key in ("exp", "eps", "offset") if key in wall]
+        if "label" in wall:
+            words.append(f"LABEL={wall['label']}")
+        lines.append(" ".join(words))
+
+    metad = dict(defaults)
+    metad.update(config.get("metad", {}))
+    metad_args = metad.get("args", cv_names)
+    joined = lambda values: ",".join(str(v) for v in values)
+    lines.append(
+        f"metad: METAD ARG={joined(metad_args)} HEIGHT={metad['height']} PACE={metad['pace']} "
+        f"SIGMA={joined(metad['sigma'])} GRID_MIN={joined(metad['grid_min'])} GRID_MAX={joined(metad['grid_max'])} "
+        f"BIASFACTOR={metad['biasfactor']} TEMP={metad['temp']} FILE=HILLS{metad_suffix}"
+    )
+    stride = config.get("print", {}).get("stride", defaults["stride"])
+    lines.append(f"PRINT ARG={joined(cv_names)},metad.bias STRIDE={stride} FILE=COLVAR")
+    return lines
+
+
+def stop_conditions(config):
+    """
+    Return [(cv position, "below"/"above", threshold)] from config["stop"].
+
+    MD stops once any CV is below/above its threshold. Positions index the
+    CV columns of COLVAR, i.e. the order of config["cvs"].
+    """
+    names = [cv["name"] for cv in config["cvs"]]
+    conditions = []
+    for stop in config.get("stop", []):
+        for kind in ("below", "above"):
+            if kind in stop:
+                conditions.append((names.index(stop["cv"]), kind, float(stop[kind])))
+    return conditions
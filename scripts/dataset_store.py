@@ -0,0 +1,355 @@
+import argparse
+import hashlib
+import io
+import os
+from collections import Counter
+import numpy as np
+from ase.io import iread, read
+
+# === Append-only growing dataset store ===
+# The training set grows by a few hundred frames per iteration. Instead of
+# rewriting the whole extxyz file every iteration (cat old new > growing)
+# and keeping full copies as backups, a store directory holds:
+#
+#   frames.xyz     append-only frame log; itself a valid extxyz file
+#   index.tsv      one row per frame: byte offset and length in the log,
+#                  number of atoms, iteration, source file, composition
+#                  signature and REF energy
+#   snapshots.tsv  one row per update: label and the number of frames and
+#                  log bytes at that point
+#
+# Frames are never rewritten, so a snapshot is just a prefix of the log and
+# the delta of an update is the byte range between two snapshots. Any frame
+# is read with one seek, and frames of one composition are sliced from the
+# index without parsing the others.
+#
+# The index also holds a fingerprint of every frame: a hash of the species,
+# the positions and cell rounded to FINGERPRINT_DECIMALS decimals (Å) and
+# the PBC. Appends skip frames whose fingerprint is already in the store,
+# e.g. frames re-emitted by a retried MTD run or appended twice by a rerun
+# CP2K step, including copies that went through another extxyz write.
+#
+# Usage:
+#   python dataset_store.py append --store growing_dataset/store --frames new.xyz --label iter_1 --seed old.xyz
+#   python dataset_store.py export --store growing_dataset/store --output growing_dataset.xyz [--snapshot iter_1]
+#   python dataset_store.py info --store growing_dataset/store
+
+LOG_FILE = "frames.xyz"
+INDEX_FILE = "index.tsv"
+SNAPSHOT_FILE = "snapshots.tsv"
+INDEX_COLUMNS = ("offset", "length", "n_atoms", "iteration", "source", "signature", "energy", "fingerprint")
+FINGERPRINT_DECIMALS = 3
+
+
+def composition_signature(atoms):
+    """Composition as a string with elements in alphabetical order, e.g. 'C7H10O2'."""
+    counts = Counter(atoms.get_chemical_symbols())
+    return "".join(f"{element}{n}" for element, n in sorted(counts.items()))
+
+
+def structure_fingerprint(atoms, decimals=FINGERPRINT_DECIMALS):
+    """Hash of species, positions and cell rounded to decimals (Å), and PBC."""
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(atoms.numbers, dtype=np.int64).tobytes())
+    # + 0.0 turns -0.0 into 0.0
+    h.update(np.round(atoms.positions, decimals).astype(np.float64) + 0.0)
+    h.update(np.round(atoms.cell.array, decimals).astype(np.float64) + 0.0)
+    h.update(np.asarray(atoms.pbc, dtype=bool).tobytes())
+    return h.hexdigest()
+
+
+def frame_ranges(data):
+    """(offset, length, n_atoms) of each frame of extxyz bytes, found from the atom count lines alone."""
+    line_starts = np.concatenate(([0], np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n")) + 1))
+    ranges = []
+    line = 0
+    while line < len(line_starts) - 1:
+        count = data[line_starts[line]:line_starts[line + 1]].strip()
+        if not count:  # trailing blank lines
+            line += 1
+            continue
+        n_atoms = int(count)
+        end_line = line + n_atoms + 2
+        if end_line >= len(line_starts):
+            raise ValueError(f"Truncated frame at byte {line_starts[line]}")
+        ranges.append((int(line_starts[line]), int(line_starts[end_line] - line_starts[line]), n_atoms))
+        line = end_line
+    return ranges
+
+
+def _parse_frame(text):
+    return read(io.StringIO(text), format="extxyz")
+
+
+class DatasetStore:
+    """
+    Append-only extxyz frame log with a byte offset and metadata index.
+
+    Appends write the frames first and the index rows after them, and a
+    store is opened by truncating the log to the last indexed frame, so an
+    interrupted append leaves the store as it was before.
+    """
+
+    def __init__(self, directory, energy_key="REF_energy"):
+        self.directory = directory
+        self.energy_key = energy_key
+        self.log_path = os.path.join(directory, LOG_FILE)
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        os.makedirs(directory, exist_ok=True)
+        self.rows = self._read_tsv(self.index_path)
+        self.snapshots = self._read_tsv(self.snapshot_path)
+        self.offsets = np.array([int(row["offset"]) for row in self.rows], dtype=np.int64)
+        self.lengths = np.array([int(row["length"]) for row in self.rows], dtype=np.int64)
+        # Repair an interrupted append: frames or snapshots beyond the index are dropped
+        n_snapshots = len(self.snapshots)
+        self.snapshots = [s for s in self.snapshots if int(s["n_frames"]) <= len(self.rows)]
+        log_size = os.path.getsize(self.log_path) if os.path.isfile(self.log_path) else 0
+        missing = [i for i, row in enumerate(self.rows) if not row.get("fingerprint")]
+        for i, atoms in zip(missing, self.iter_frames(missing)):  # stores indexed before fingerprints
+            self.rows[i]["fingerprint"] = structure_fingerprint(atoms)
+        if (log_size != self.log_bytes or len(self.snapshots) != n_snapshots or missing
+                or not os.path.isfile(self.index_path)):
+            self._truncate(len(self.rows))
+        self.fingerprints = {row["fingerprint"] for row in self.rows}
+
+    @staticmethod
+    def _read_tsv(path):
+        if not os.path.isfile(path):
+            return []
+        with open(path, "r") as f:
+            text = f.read()
+        # A row cut short by an interrupted append has no line end yet and is dropped
+        lines = text.split("\n")[:-1]
+        if not lines:
+            return []
+        header = lines[0].split("\t")
+        return [dict(zip(header, line.split("\t"))) for line in lines[1:]]
+
+    @staticmethod
+    def _write_tsv(path, header, rows):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write("\t".join(header) + "\n")
+            for row in rows:
+                f.write("\t".join(str(row[key]) for key in header) + "\n")
+        os.replace(tmp, path)
+
+    def _truncate(self, n_frames):
+        """Cut the log, index and snapshots back to the first n_frames frames."""
+        log_bytes = int(self.offsets[n_frames - 1] + self.lengths[n_frames - 1]) if n_frames else 0
+        with open(self.log_path, "ab") as f:
+            f.truncate(log_bytes)
+        self.rows = self.rows[:n_frames]
+        self.fingerprints = {row["fingerprint"] for row in self.rows}
+        self.offsets = self.offsets[:n_frames]
+        self.lengths = self.lengths[:n_frames]
+        self._write_tsv(self.index_path, INDEX_COLUMNS, self.rows)
+        self._write_tsv(self.snapshot_path, ("label", "n_frames", "log_bytes"), self.snapshots)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def log_bytes(self):
+        return int(self.offsets[-1] + self.lengths[-1]) if len(self.rows) else 0
+
+    def snapshot(self, label):
+        """(n_frames, log_bytes) of the snapshot label; KeyError if there is none."""
+        for s in self.snapshots:
+            if s["label"] == label:
+                return int(s["n_frames"]), int(s["log_bytes"])
+        raise KeyError(f"No snapshot {label!r} in {self.directory}")
+
+    def append(self, path, iteration, label=None, deduplicate=True):
+        """
+        Append the frames of the extxyz file path; return (frames added, duplicates skipped).
+
+        The frames are copied byte for byte. With deduplicate, frames whose
+        fingerprint is already in the store or earlier in path are skipped,
+        one set lookup per frame. With label, a snapshot is
+        recorded after the append; appending again under the label of the
+        latest snapshot (e.g. a retried pipeline step) first drops the
+        frames of that snapshot, so a rerun does not duplicate them.
+        """
+        if label is not None and any(s["label"] == label for s in self.snapshots):
+            if self.snapshots[-1]["label"] != label:
+                raise ValueError(f"Snapshot {label!r} is not the latest one in {self.directory}; cannot redo it")
+            self.snapshots.pop()
+            previous = int(self.snapshots[-1]["n_frames"]) if self.snapshots else 0
+            print(f"Redoing update {label}: dropping {len(self) - previous} frames appended by it.")
+            self._truncate(previous)
+
+        with open(path, "rb") as f:
+            data = f.read()
+        ranges = frame_ranges(data)
+        source = os.path.basename(path)
+        rows = []
+        kept = []  # byte ranges in data of the frames to append
+        n_read = n_duplicates = 0
+        offset = self.log_bytes
+        seen = set(self.fingerprints)
+        for (start, length, n_atoms), atoms in zip(ranges, iread(path, index=":")):
+            n_read += 1
+            fingerprint = structure_fingerprint(atoms)
+            if deduplicate and fingerprint in seen:
+                n_duplicates += 1
+                continue
+            seen.add(fingerprint)
+            energy = atoms.info.get(self.energy_key)
+            rows.append({"offset": offset, "length": length, "n_atoms": n_atoms,
+                         "iteration": iteration, "source": source,
+                         "signature": composition_signature(atoms),
+                         "energy": "nan" if energy is None else repr(float(energy)),
+                         "fingerprint": fingerprint})
+            kept.append((start, length))
+            offset += length
+        if n_read != len(ranges):
+            raise ValueError(f"{path}: {len(ranges)} frames by atom counts but ASE read {n_read}")
+
+        with open(self.log_path, "ab") as f:
+            if n_duplicates == 0 and kept:
+                f.write(data[:kept[-1][0] + kept[-1][1]])
+            else:
+                for start, length in kept:
+                    f.write(data[start:start + length])
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.index_path, "a") as f:
+            for row in rows:
+                f.write("\t".join(str(row[key]) for key in INDEX_COLUMNS) + "\n")
+        self.rows.extend(rows)
+        self.fingerprints.update(row["fingerprint"] for row in rows)
+        self.offsets = np.append(self.offsets, [row["offset"] for row in rows]).astype(np.int64)
+        self.lengths = np.append(self.lengths, [row["length"] for row in rows]).astype(np.int64)
+
+        if label is not None:
+            self.snapshots.append({"label": label, "n_frames": len(self), "log_bytes": self.log_bytes})
+            with open(self.snapshot_path, "a") as f:
+                if os.path.getsize(self.snapshot_path) == 0:
+                    f.write("label\tn_frames\tlog_bytes\n")
+                f.write(f"{label}\t{len(self)}\t{self.log_bytes}\n")
+        return len(rows), n_duplicates
+
+    def raw(self, i):
+        """Bytes of frame i in the log."""
+        with open(self.log_path, "rb") as f:
+            f.seek(self.offsets[i])
+            return f.read(self.lengths[i])
+
+    def __getitem__(self, i):
+        return _parse_frame(self.raw(i).decode())
+
+    def select(self, signatures=None, iterations=None, stop=None):
+        """Indices of the frames (of the first stop frames) matching the given signatures and iterations."""
+        signatures = set(signatures) if signatures is not None else None
+        iterations = set(iterations) if iterations is not None else None
+        return [i for i, row in enumerate(self.rows[:stop])
+                if (signatures is None or row["signature"] in signatures)
+                and (iterations is None or row["iteration"] in iterations)]
+
+    def iter_frames(self, indices=None):
+        """Yield the Atoms of the given frames (all by default), in log order, with one open file."""
+        indices = range(len(self)) if indices is None else sorted(indices)
+        with open(self.log_path, "rb") as f:
+            for i in indices:
+                f.seek(self.offsets[i])
+                yield _parse_frame(f.read(self.lengths[i]).decode())
+
+    def export(self, output, indices=None, snapshot=None, since=None, chunk_size=1 << 24):
+        """
+        Write frames of the store to the extxyz file output and return their number.
+
+        Without indices this is a byte copy of the log up to snapshot (the
+        whole log by default), from snapshot since on if given; otherwise the
+        given frames are copied in log order.
+        """
+        if indices is None:
+            start = self.snapshot(since)[1] if since is not None else 0
+            n_frames, end = self.snapshot(snapshot) if snapshot is not None else (len(self), self.log_bytes)
+            ranges = [(start, end - start)]
+            n_exported = n_frames - (self.snapshot(since)[0] if since is not None else 0)
+        else:
+            ranges = [(self.offsets[i], self.lengths[i]) for i in sorted(indices)]
+            n_exported = len(ranges)
+
+        tmp = output + ".tmp"
+        with open(self.log_path, "rb") as src, open(tmp, "wb") as dst:
+            for offset, length in ranges:
+                src.seek(offset)
+                while length > 0:
+                    chunk = src.read(min(chunk_size, length))
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    length -= len(chunk)
+        os.replace(tmp, output)
+        return n_exported
+
+    def summary(self):
+        """Frame counts per snapshot delta and per composition signature."""
+        lines = [f"{len(self)} frames, {self.log_bytes} bytes in {self.log_path}"]
+        previous = 0
+        for s in self.snapshots:
+            lines.append(f"  {s['label']}: +{int(s['n_frames']) - previous} frames")
+            previous = int(s["n_frames"])
+        for signature, n in Counter(row["signature"] for row in self.rows).most_common():
+            lines.append(f"  {signature}: {n} frames")
+        return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Append-only indexed store of the growing training dataset")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    append_parser = subparsers.add_parser("append", help="Append the frames of an extxyz file")
+    append_parser.add_argument("--store", required=True, help="Store directory")
+    append_parser.add_argument("--frames", required=True, help="extxyz file with the new frames")
+    append_parser.add_argument("--label", required=True, help="Snapshot label of this update (e.g. the iteration)")
+    append_parser.add_argument("--seed", default=None,
+                               help="extxyz dataset to import first (as iteration 'initial') if the store is empty")
+    append_parser.add_argument("--keep_duplicates", action="store_true",
+                               help="Also append frames whose structure fingerprint is already in the store")
+
+    export_parser = subparsers.add_parser("export", help="Write (part of) the store as an extxyz file")
+    export_parser.add_argument("--store", required=True, help="Store directory")
+    export_parser.add_argument("--output", required=True, help="Output extxyz file")
+    export_parser.add_argument("--snapshot", default=None, help="Export the dataset as of this snapshot")
+    export_parser.add_argument("--since", default=None, help="Only frames added after this snapshot")
+    export_parser.add_argument("--signatures", nargs="*", default=None,
+                               help="Only frames of these compositions (e.g. C7H10O2)")
+    export_parser.add_argument("--iterations", nargs="*", default=None, help="Only frames added by these updates")
+
+    info_parser = subparsers.add_parser("info", help="Summarise the store")
+    info_parser.add_argument("--store", required=True, help="Store directory")
+
+    args = parser.parse_args()
+    store = DatasetStore(args.store)
+
+    if args.command == "append":
+        if args.seed and len(store) == 0 and os.path.getsize(args.seed) > 0:
+            n_seed, n_duplicates = store.append(args.seed, "initial", label="initial",
+                                                deduplicate=not args.keep_duplicates)
+            print(f"Imported {n_seed} frames from {args.seed} into {args.store} ({n_duplicates} duplicates dropped)")
+        n_added, n_duplicates = store.append(args.frames, args.label, label=args.label,
+                                             deduplicate=not args.keep_duplicates)
+        print(f"Appended {n_added} frames from {args.frames} as {args.label} ({n_duplicates} duplicates dropped); "
+              f"{len(store)} frames in {args.store}")
+
+    elif args.command == "export":
+        if args.signatures is not None or args.iterations is not None:
+            stop = store.snapshot(args.snapshot)[0] if args.snapshot else None
+            indices = store.select(args.signatures, args.iterations, stop=stop)
+            if args.since:
+                indices = [i for i in indices if i >= store.snapshot(args.since)[0]]
+            n = store.export(args.output, indices=indices)
+        else:
+            n = store.export(args.output, snapshot=args.snapshot, since=args.since)
+        print(f"Exported {n} frames to {args.output}")
+
+    else:
+        print(store.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import numpy as np
+
+
+class NoveltyIndex:
+    """
+    Nearest-neighbour index over MACE descriptors, grouped by structure signature.
+
+    Each descriptor (per-atom matrix, or list of matrices for a committee) is
+    flattened, so the distance between two entries equals
+    np.linalg.norm(desc_a - desc_b) as used by the descriptor filter. Entries
+    of one signature are kept in a contiguous, geometrically growing matrix
+    together with their squared norms, and queried with matrix products
+    instead of a Python loop.
+
+    method selects how nearest_distance(s)() is answered:
+      "brute"    vectorised exact search over the stacked matrix (default)
+      "kdtree"   scipy.spatial.cKDTree
+      "balltree" sklearn.neighbors.BallTree
+      "faiss"    faiss.IndexFlatL2 (float32)
+    Tree/FAISS indices are (re)built lazily after entries are added, so they
+    pay off for a large, static reference set rather than a growing one.
+    Tree indices degrade towards brute force for very high-dimensional
+    descriptors; benchmark before switching.
+    """
+
+    METHODS = ("brute", "kdtree", "balltree", "faiss")
+
+    def __init__(self, method="brute"):
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown nearest-neighbour method '{method}', choose from {self.METHODS}")
+        self.method = method
+        self._data = {}     # sig -> (n_entries, dim) matrix with spare capacity
+        self._norms = {}    # sig -> squared norms of the rows of _data
+        self._labels = {}   # sig -> list of labels, one per entry
+        self._size = {}     # sig -> number of valid rows
+        self._trees = {}    # sig -> spatial index for the current rows
+
+    def __len__(self):
+        return sum(self._size.values())
+
+    def __contains__(self, sig):
+        return self._size.get(sig, 0) > 0
+
+    def add(self, sig, desc, label=None):
+        """Append one descriptor under signature sig."""
+        vec = np.asarray(desc).ravel()
+        n = self._size.get(sig, 0)
+        data = self._data.get(sig)
+        if data is None:
+            data = np.empty((16, vec.size), dtype=vec.dtype)
+            self._norms[sig] = np.empty(16, dtype=np.float64)
+            self._labels[sig] = []
+        elif vec.size != data.shape[1]:
+            raise ValueError(f"Descriptor size {vec.size} does not match {data.shape[1]} for signature {sig}")
+        elif n == len(data):
+            data = np.concatenate([data, np.empty_like(data)])
+            self._norms[sig] = np.concatenate([self._norms[sig], np.empty_like(self._norms[sig])])
+        data[n] = vec
+        self._norms[sig][n] = np.dot(vec, vec)
+        self._data[sig] = data
+        self._labels[sig].append(label)
+        self._size[sig] = n + 1
+        self._trees.pop(sig, None)
+
+    def matrix(self, sig):
+        """Return the stacked (n_entries, dim) descriptor matrix of signature sig."""
+        return self._data[sig][:self._size[sig]] if sig in self else None
+
+    def distances(self, sig, desc):
+        """Return (labels, distances) from desc to every entry of signature sig."""
+        if sig not in self:
+            return [], np.empty(0)
+        n = self._size[sig]
+        vec = np.asarray(desc).ravel()
+        d2 = self._norms[sig][:n] - 2.0 * (self._data[sig][:n] @ vec) + np.dot(vec, vec)
+        return self._labels[sig], np.sqrt(np.maximum(d2, 0.0))
+
+    def nearest_distance(self, sig, desc):
+        """Return the distance from desc to its nearest entry of signature sig (inf if none)."""
+        return float(self.nearest_distances(sig, [desc])[0])
+
+    def nearest_distances(self, sig, descs):
+        """
+        Return the nearest-entry distance for each descriptor in descs (all of signature sig).
+
+        Querying many descriptors at once turns the brute-force search into a
+        matrix-matrix product, which is far cheaper per query than repeated
+        matrix-vector products over the same (memory-bound) stacked matrix.
+        """
+        queries = np.stack([np.asarray(desc).ravel() for desc in descs])
+        if sig not in self:
+            return np.full(len(queries), np.inf)
+
+        if self.method == "brute":
+            n = self._size[sig]
+            d2 = (self._norms[sig][:n][None, :]
+                  - 2.0 * (queries @ self._data[sig][:n].T)
+                  + np.einsum("ij,ij->i", queries, queries)[:, None])
+            return np.sqrt(np.maximum(d2.min(axis=1), 0.0))
+
+        tree = self._trees.get(sig)
+        if tree is None:
+            tree = self._build_tree(self.matrix(sig))
+            self._trees[sig] = tree
+        if self.method == "kdtree":
+            dist, _ = tree.query(queries, k=1)
+            return np.asarray(dist, dtype=np.float64)
+        if self.method == "balltree":
+            dist, _ = tree.query(queries, k=1)
+            return dist[:, 0]
+        dist2, _ = tree.search(np.ascontiguousarray(queries, dtype=np.float32), 1)
+        return np.sqrt(np.maximum(dist2[:, 0].astype(np.float64), 0.0))
+
+    def _build_tree(self, data):
+        if self.method == "kdtree":
+            from scipy.spatial import cKDTree
+            return cKDTree(data)
+        if self.method == "balltree":
+            from sklearn.neighbors import BallTree
+            return BallTree(data)
+        import faiss
+        index = faiss.IndexFlatL2(data.shape[1])
+        index.add(np.ascontiguousarray(data, dtype=np.float32))
+        return index
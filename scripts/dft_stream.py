@@ -0,0 +1,125 @@
+import glob
+import os
+import time
+import uuid
+from ase.io import write
+
+# === Frame stream between the MTD propagator and the DFT workers ===
+# The propagator writes every accepted frame as its own numbered file in a
+# shared directory (frame_000001.xyz, ...) and a DONE file holding its exit
+# code once sampling ends. cp2k_stream_worker.py follows the directory and
+# starts the single points while sampling is still running. Files are
+# written under a temporary name and renamed, so a reader never sees a
+# partially written frame. A propagator that starts from scratch (not
+# --resume) clears the directory and writes a new STREAM_ID, and a reader
+# that sees the ID change starts over from the first frame.
+
+FRAME_PATTERN = "frame_{:06d}.xyz"
+DONE_FILE = "DONE"
+ID_FILE = "STREAM_ID"
+
+
+class FrameStream:
+    """Writer side: one extxyz file per accepted frame, numbered from 1."""
+
+    def __init__(self, directory, resume=False):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, DONE_FILE)):
+            os.remove(os.path.join(directory, DONE_FILE))
+        frames = glob.glob(os.path.join(directory, FRAME_PATTERN.replace("{:06d}", "*")))
+        if resume and os.path.exists(os.path.join(directory, ID_FILE)):
+            # A resumed propagator continues the stream and its numbering
+            self.n_frames = len(frames)
+        else:
+            # A fresh propagator starts a new stream; frames of an earlier attempt are dropped
+            for path in frames:
+                os.remove(path)
+            self.n_frames = 0
+
+            def write_id(tmp):
+                with open(tmp, "w") as f:
+                    f.write(f"{uuid.uuid4().hex}\n")
+            self._publish(ID_FILE, write_id)
+
+    def _publish(self, name, write_to):
+        path = os.path.join(self.directory, name)
+        write_to(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        return path
+
+    def write(self, atoms):
+        self.n_frames += 1
+        return self._publish(FRAME_PATTERN.format(self.n_frames),
+                             lambda tmp: write(tmp, atoms, format="extxyz", write_results=False))
+
+    def close(self, exit_code):
+        def write_done(tmp):
+            with open(tmp, "w") as f:
+                f.write(f"{exit_code}\n")
+        self._publish(DONE_FILE, write_done)
+
+
+def follow_stream(directory, poll_interval=10.0, idle_timeout=None, on_wait=None, on_restart=None):
+    """
+    Yield the frame files of a stream in order as they appear, until it is closed.
+
+    on_wait, if given, is called before each sleep between checks.
+
+    If the stream is restarted by a fresh propagator (new STREAM_ID),
+    on_restart is called so the frames yielded so far can be discarded,
+    and the frames of the new stream are yielded from the first one on.
+
+    Raises TimeoutError if neither a new frame nor the DONE file appeared
+    for idle_timeout seconds (e.g. the propagator was killed). The idle
+    clock starts once the stream is opened (its STREAM_ID exists), so a
+    propagator still waiting in the queue does not count.
+    """
+    pattern = os.path.join(directory, FRAME_PATTERN.replace("{:06d}", "*"))
+    n_seen = 0
+    stream_id = None
+    last_change = None
+    while True:
+        # DONE is checked before listing, so frames written before it are never missed
+        done = os.path.exists(os.path.join(directory, DONE_FILE))
+        current_id = _read_stream_id(directory)
+        frames = sorted(glob.glob(pattern))
+        if _read_stream_id(directory) != current_id:
+            continue  # restarted while listing
+        if current_id != stream_id:
+            if stream_id is not None:
+                print(f"Stream in {directory} was restarted by a new propagator; following it from its first frame.",
+                      flush=True)
+                if on_restart is not None:
+                    on_restart()
+                n_seen = 0
+            stream_id = current_id
+            last_change = time.monotonic()
+        if len(frames) > n_seen:
+            last_change = time.monotonic()
+        yield from frames[n_seen:]
+        n_seen = len(frames)
+        if done:
+            return
+        if idle_timeout is not None and last_change is not None and time.monotonic() - last_change > idle_timeout:
+            raise TimeoutError(f"No new frames in {directory} for {idle_timeout} s")
+        if on_wait is not None:
+            on_wait()
+        time.sleep(poll_interval)
+
+
+def _read_stream_id(directory):
+    try:
+        with open(os.path.join(directory, ID_FILE), "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def stream_exit_code(directory):
+    """Exit code recorded by the propagator, or None while the stream is open."""
+    path = os.path.join(directory, DONE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return int(f.read().strip())
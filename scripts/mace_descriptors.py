@@ -0,0 +1,344 @@
+import hashlib
+import itertools
+import json
+import os
+import time
+import uuid
+from collections import Counter
+import numpy as np
+import torch
+from e3nn import o3
+from mace import data as mace_data
+from mace.modules.utils import extract_invariant
+from mace.tools import torch_geometric, torch_tools
+from tqdm import tqdm
+from descriptor_index import NoveltyIndex
+
+# === MACE descriptor helpers ===
+# Shared by the descriptor filter (MACE_compare_descriptors.py) and the
+# online novelty filter of the MTD propagator: structure signatures, the
+# on-disk reference descriptor store, batched descriptor evaluation and the
+# reference NoveltyIndex built from them.
+
+# Descriptor model of both filters; their distance thresholds are calibrated
+# for its descriptors.
+DEFAULT_DESCRIPTOR_MODEL = "/scratch/project_462000838/active_learning_nextflow/input/MACE_models/mace-mpa-0-medium.model"
+
+# -----------------------
+# Helper: Structure Signature
+# -----------------------
+def structure_signature(atoms):
+    """Return a canonical chemical signature based on atom types."""
+    counts = Counter(atoms.get_chemical_symbols())
+    return tuple(sorted(counts.items()))  # e.g. (('C',7),('H',10),('O',2))
+
+
+# -----------------------
+# Helper: Descriptor cache
+# -----------------------
+def structure_hash(atoms):
+    """Return a content hash of species, positions, cell and PBC of a structure."""
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(atoms.get_atomic_numbers(), dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(atoms.get_positions(), dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(atoms.get_cell().array, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(atoms.get_pbc(), dtype=np.bool_).tobytes())
+    return h.hexdigest()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Return the SHA-256 of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_descriptor_cache(cache_dir):
+    """
+    Load the descriptor store in cache_dir as {structure_hash: descriptor}.
+
+    The store is a set of append-only .npy shards plus an index.jsonl file
+    mapping each structure hash to a row range of one shard. Shards are
+    memory-mapped, so only the descriptors actually used are read from disk.
+    """
+    index_path = os.path.join(cache_dir, "index.jsonl")
+    if not os.path.isfile(index_path):
+        return {}
+
+    shards = {}
+    cache = {}
+    with open(index_path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # partially written line from an interrupted run
+            shard = entry["shard"]
+            if shard not in shards:
+                shard_path = os.path.join(cache_dir, shard)
+                if not os.path.isfile(shard_path):
+                    continue
+                shards[shard] = np.load(shard_path, mmap_mode="r")
+            cache[entry["key"]] = shards[shard][entry["start"]:entry["stop"]]
+    return cache
+
+
+def save_descriptor_cache(cache_dir, new_entries):
+    """
+    Append {structure_hash: descriptor} entries to the store as one new shard.
+
+    The shard is written before the index lines referencing it, so an
+    interrupted run never leaves index entries pointing at missing data.
+    """
+    if not new_entries:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+
+    keys = list(new_entries)
+    arrays = [np.asarray(new_entries[k]) for k in keys]
+    shard = f"shard_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.npy"
+    tmp_path = os.path.join(cache_dir, shard + ".tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.concatenate(arrays, axis=0))
+    os.replace(tmp_path, os.path.join(cache_dir, shard))
+
+    lines = []
+    start = 0
+    for key, arr in zip(keys, arrays):
+        lines.append(json.dumps({"key": key, "shard": shard, "start": start, "stop": start + len(arr)}))
+        start += len(arr)
+    with open(os.path.join(cache_dir, "index.jsonl"), "a") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+# -----------------------
+# Helper: Batched descriptors
+# -----------------------
+def atoms_to_graph(calculator, atoms):
+    """Build the MACE graph of one structure the same way MACECalculator does."""
+    keyspec = mace_data.KeySpecification(info_keys=calculator.info_keys, arrays_keys=calculator.arrays_keys)
+    with torch_tools.default_dtype(calculator.default_dtype):
+        config = mace_data.config_from_atoms(atoms, key_specification=keyspec, head_name=calculator.head)
+        return mace_data.AtomicData.from_config(
+            config, z_table=calculator.z_table, cutoff=calculator.r_max, heads=calculator.available_heads
+        )
+
+
+def get_descriptors_batch(calculator, atoms_list, invariants_only=False, num_layers=-1, models=None):
+    """
+    Batched equivalent of calculator.get_descriptors for a list of structures.
+
+    All structures are collated into one MACE batch, so each committee member
+    runs a single forward pass (without forces) for the whole list. Returns
+    one descriptor per structure, shaped as get_descriptors would return it.
+    models restricts the evaluation to a subset of calculator.models, e.g.
+    the first member of an MTD committee.
+    """
+    models = calculator.models if models is None else models
+    model0 = models[0]
+    num_interactions = int(model0.num_interactions)
+    if num_layers == -1:
+        num_layers = num_interactions
+    irreps_out = o3.Irreps(str(model0.products[0].linear.irreps_out))
+    l_max = irreps_out.lmax
+    num_invariant_features = irreps_out.dim // (l_max + 1) ** 2
+    per_layer_features = [irreps_out.dim for _ in range(num_interactions)]
+    per_layer_features[-1] = num_invariant_features  # no equivariant features after the last layer
+    to_keep = int(np.sum(per_layer_features[:num_layers]))
+
+    graphs = [atoms_to_graph(calculator, atoms) for atoms in atoms_list]
+    batch = torch_geometric.Batch.from_data_list(graphs).to(calculator.device)
+    ptr = batch["ptr"].cpu().numpy()
+
+    per_model = []
+    for model in models:
+        model_dtype = next(model.parameters()).dtype
+        batch_dict = {
+            key: value.to(dtype=model_dtype) if torch.is_tensor(value) and torch.is_floating_point(value) else value
+            for key, value in batch.to_dict().items()
+        }
+        with torch.no_grad():
+            node_feats = model(batch_dict, compute_force=False)["node_feats"]
+        if invariants_only:
+            node_feats = extract_invariant(
+                node_feats, num_layers=num_layers, num_features=num_invariant_features, l_max=l_max
+            )
+        per_model.append(node_feats[:, :to_keep].cpu().numpy())
+
+    descriptors = []
+    for i in range(len(atoms_list)):
+        descs = [d[ptr[i]:ptr[i + 1]] for d in per_model]
+        descriptors.append(descs[0] if len(per_model) == 1 else descs)
+    return descriptors
+
+
+def iter_descriptors(calculator, atoms_list, batch_size, invariants_only=False, models=None):
+    """
+    Yield (index, atoms, descriptor, error) for atoms_list, batch_size structures at a time.
+
+    atoms_list may be any iterable (e.g. ase.io.iread), in which case only one
+    batch of structures is held in memory. If a batch fails, its structures
+    are retried one by one; descriptor is None and error is set for
+    structures that still fail.
+    """
+    atoms_iter = iter(atoms_list)
+    for start in itertools.count(0, batch_size):
+        chunk = list(itertools.islice(atoms_iter, batch_size))
+        if not chunk:
+            return
+        try:
+            descs = get_descriptors_batch(calculator, chunk, invariants_only=invariants_only, models=models)
+        except Exception:
+            descs = None
+        for offset, atoms in enumerate(chunk):
+            if descs is not None:
+                yield start + offset, atoms, descs[offset], None
+                continue
+            try:
+                desc = get_descriptors_batch(calculator, [atoms], invariants_only=invariants_only, models=models)[0]
+                yield start + offset, atoms, desc, None
+            except Exception as e:
+                yield start + offset, atoms, None, e
+
+
+def with_reference_distances(items, reference_index, batch_size):
+    """
+    Attach the nearest reference distance to (index, atoms, descriptor, error) items.
+
+    Items are gathered batch_size at a time so the reference index is queried
+    once per signature per batch instead of once per structure.
+    """
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, batch_size))
+        if not chunk:
+            return
+        by_sig = {}
+        for pos, (_, atoms, desc, error) in enumerate(chunk):
+            if error is None:
+                by_sig.setdefault(structure_signature(atoms), []).append(pos)
+        ref_dist = [np.inf] * len(chunk)
+        for sig, positions in by_sig.items():
+            dists = reference_index.nearest_distances(sig, [chunk[pos][2] for pos in positions])
+            for pos, dist in zip(positions, dists):
+                ref_dist[pos] = dist
+        for item, dist in zip(chunk, ref_dist):
+            yield (*item, dist)
+
+
+# -----------------------
+# Helper: Reference index
+# -----------------------
+def build_reference_index(calculator, reference_structures, cache_dir=None, batch_size=32, method="brute",
+                          models=None):
+    """
+    Return a NoveltyIndex of the descriptors of reference_structures.
+
+    Reference frames are consumed batch_size at a time: descriptors found in
+    the store in cache_dir go straight into the index, the rest are
+    evaluated as one batch and appended to the store afterwards, so only
+    frames added since the last call are recomputed.
+    """
+    reference_index = NoveltyIndex(method=method)
+
+    cached_desc = {}
+    if cache_dir is not None:
+        cached_desc = load_descriptor_cache(cache_dir)
+        print(f"Loaded {len(cached_desc)} cached reference descriptors from {cache_dir}")
+
+    new_cache_entries = {}
+    reference_iter = iter(reference_structures)
+    progress = tqdm(desc="Reference descriptors", unit="frame")
+    try:
+        while True:
+            chunk = list(itertools.islice(reference_iter, batch_size))
+            if not chunk:
+                break
+            progress.update(len(chunk))
+
+            missing = {}
+            for atoms in chunk:
+                key = structure_hash(atoms)
+                desc = cached_desc.get(key)
+                if desc is None:
+                    desc = new_cache_entries.get(key)
+                if desc is not None:
+                    reference_index.add(structure_signature(atoms), desc)
+                elif key not in missing:
+                    missing[key] = atoms
+            missing_keys = list(missing)
+
+            for i, atoms, desc, error in iter_descriptors(calculator, list(missing.values()), batch_size,
+                                                          models=models):
+                if error is not None:
+                    print(f"Skipping reference structure due to descriptor error: {error}")
+                    continue
+                new_cache_entries[missing_keys[i]] = desc
+                reference_index.add(structure_signature(atoms), desc)
+    except Exception as e:
+        print(f"Warning: failed to read reference dataset: {e}")
+    progress.close()
+    print(f"Indexed {len(reference_index)} reference descriptors "
+          f"({len(new_cache_entries)} newly computed).")
+
+    if cache_dir is not None and new_cache_entries:
+        try:
+            save_descriptor_cache(cache_dir, new_cache_entries)
+            print(f"Added {len(new_cache_entries)} reference descriptors to {cache_dir}")
+        except OSError as e:
+            print(f"Warning: failed to update descriptor cache: {e}")
+
+    return reference_index
+
+
+def reference_cache_dir(reference, model_path, descriptor_cache=None):
+    """
+    Return the descriptor store directory for a reference dataset and model.
+
+    Descriptors are keyed on structure hash inside a per-model subdirectory of
+    descriptor_cache, which defaults to <reference>_descriptor_cache next to
+    the (resolved) reference file.
+    """
+    cache_root = descriptor_cache
+    if cache_root is None:
+        cache_root = os.path.splitext(os.path.realpath(reference))[0] + "_descriptor_cache"
+    return os.path.join(cache_root, file_hash(model_path)[:16])
+
+
+# -----------------------
+# Helper: Online novelty filter
+# -----------------------
+class OnlineNoveltyFilter:
+    """
+    Accept or reject structures one at a time as they are generated.
+
+    A structure is novel if its descriptor is at least threshold away from
+    every reference descriptor and every previously accepted structure of
+    the same signature, the same criterion MACE_compare_descriptors.py
+    applies to a finished candidate file.
+    """
+
+    def __init__(self, calculator, reference_index, threshold, models=None):
+        self.calculator = calculator
+        self.reference_index = reference_index
+        self.threshold = threshold
+        self.models = models
+        self.accepted_index = NoveltyIndex()
+        self.n_accepted = 0
+
+    def consider(self, atoms):
+        """Return True and remember atoms if it is novel, False otherwise."""
+        desc = get_descriptors_batch(self.calculator, [atoms], models=self.models)[0]
+        sig = structure_signature(atoms)
+        if self.reference_index.nearest_distance(sig, desc) < self.threshold:
+            return False
+        if self.accepted_index.nearest_distance(sig, desc) < self.threshold:
+            return False
+        self.accepted_index.add(sig, desc, label=self.n_accepted)
+        self.n_accepted += 1
+        return True
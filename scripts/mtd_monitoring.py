@@ -0,0 +1,142 @@
+import io
+import os
+import numpy as np
+from ase.io import write
+from ase.io.trajectory import Trajectory
+
+# === Monitoring and output of the committee MTD propagators ===
+# Shared by the MTD_committee_plumed_MACE_system*.py drivers: the NumPy
+# time-series log rendered by plot_mtd_log.py, the buffered trajectory
+# writer and the incremental COLVAR reader of the stop conditions.
+
+
+class TimeSeriesLog:
+    """
+    Preallocated NumPy buffers for the time series monitored during MD.
+
+    Recording a callback is a handful of array writes; the buffers only grow
+    (by doubling) if more records arrive than were preallocated.
+    """
+
+    def __init__(self, n_records, n_models):
+        self.n = 0
+        self.time_fs = np.full(n_records, np.nan)
+        self.temperatures = np.full(n_records, np.nan)
+        self.variances = np.full(n_records, np.nan)
+        self.committee_energies = np.full(n_records, np.nan)
+        self.energies_all = np.full((n_models, n_records), np.nan)
+
+    def append(self, t_fs, temperature, variance, committee_energy, energies):
+        if self.n == len(self.time_fs):
+            for name in ("time_fs", "temperatures", "variances", "committee_energies", "energies_all"):
+                buf = getattr(self, name)
+                setattr(self, name, np.concatenate([buf, np.full_like(buf, np.nan)], axis=-1))
+        self.time_fs[self.n] = t_fs
+        self.temperatures[self.n] = temperature
+        self.variances[self.n] = np.nan if variance is None else variance
+        self.committee_energies[self.n] = committee_energy
+        self.energies_all[:len(energies), self.n] = energies
+        self.n += 1
+
+    def save(self, filename, variance_limit):
+        np.savez(
+            filename,
+            time_fs=self.time_fs[:self.n],
+            temperatures=self.temperatures[:self.n],
+            variances=self.variances[:self.n],
+            committee_energies=self.committee_energies[:self.n],
+            energies_all=self.energies_all[:, :self.n],
+            variance_limit=variance_limit,
+        )
+
+
+class BufferedTrajectoryWriter:
+    """
+    Append frames to a trajectory through one open file handle.
+
+    extxyz frames are serialised into an in-memory buffer and written out
+    every flush_every frames (and on close), instead of opening, appending
+    to and closing the file for each frame. A .traj filename writes a
+    binary ASE trajectory instead, which is faster to read back.
+    """
+
+    def __init__(self, filename, flush_every=20):
+        self.flush_every = max(1, flush_every)
+        self.n_buffered = 0
+        if filename.endswith(".traj"):
+            self.traj = Trajectory(filename, "a")
+            self.handle = None
+        else:
+            self.traj = None
+            self.handle = open(filename, "a")
+            self.buffer = io.StringIO()
+
+    def write(self, atoms):
+        if self.traj is not None:
+            self.traj.write(atoms)
+            return
+        write(self.buffer, atoms, format="extxyz", write_results=False)
+        self.n_buffered += 1
+        if self.n_buffered >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.traj is not None:
+            return
+        self.handle.write(self.buffer.getvalue())
+        self.handle.flush()
+        self.buffer = io.StringIO()
+        self.n_buffered = 0
+
+    def close(self):
+        if self.traj is not None:
+            self.traj.close()
+        elif not self.handle.closed:
+            self.flush()
+            self.handle.close()
+
+
+class ColvarTail:
+    """
+    Incremental reader for the CVs on the last line of a PLUMED COLVAR file.
+
+    Keeps the file open and remembers the byte offset, so each call only
+    parses the lines appended since the previous call instead of re-reading
+    the whole file.
+    """
+
+    def __init__(self, filename="COLVAR", n_cvs=2):
+        self.filename = filename
+        self.n_cvs = n_cvs
+        self.handle = None
+        self.offset = 0
+        self.partial = b""
+        self.last = None
+
+    def read_last(self):
+        """Return the CV values of the most recent complete data line, or None before the first one."""
+        if self.handle is None:
+            if not os.path.exists(self.filename):
+                return self.last
+            self.handle = open(self.filename, "rb")
+
+        if os.fstat(self.handle.fileno()).st_size < self.offset:
+            # File was truncated/rewritten: start over
+            self.offset, self.partial = 0, b""
+        self.handle.seek(self.offset)
+        chunk = self.handle.read()
+        self.offset += len(chunk)
+
+        lines = (self.partial + chunk).split(b"\n")
+        self.partial = lines.pop()  # incomplete last line, completed by a later read
+        for line in reversed(lines):
+            if line.strip() and not line.startswith(b"#"):
+                fields = line.split()
+                self.last = [float(v) for v in fields[1:1 + self.n_cvs]]  # column 0 is the time
+                break
+        return self.last
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
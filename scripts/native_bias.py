@@ -0,0 +1,430 @@
+import io
+import numpy as np
+from ase import units
+from ase.calculators.calculator import Calculator, all_changes
+from ase.geometry import find_mic
+
+# === Built-in CVs and bias for the committee MTD propagators ===
+# A NumPy implementation of the subset of PLUMED used by the MTD scripts:
+# COORDINATION collective variables (rational switching function),
+# LOWER_WALLS/UPPER_WALLS restraints and a gridded well-tempered METAD bias.
+# Everything stays in memory; COLVAR and HILLS are written in PLUMED's
+# format, but only every flush_stride steps. Energies are in eV, lengths
+# in Å, so the parameters are those of the PLUMED input with
+# "UNITS LENGTH=A ENERGY=eV". NumPy is used rather than Torch: the CVs
+# involve a few dozen atom pairs, far too few to benefit from a GPU.
+
+
+def parse_atom_list(spec):
+    """Return 0-based indices for a PLUMED atom list such as "39,56-64,79" (1-based)."""
+    indices = []
+    for item in str(spec).split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "-" in item:
+            first, last = item.split("-")
+            indices.extend(range(int(first) - 1, int(last)))
+        else:
+            indices.append(int(item) - 1)
+    return indices
+
+
+def rational_switch(r, r0, nn=6, mm=0, d0=0.0, d_max=None):
+    """
+    PLUMED's rational switching function s(r) = (1 - x^nn) / (1 - x^mm), x = (r - d0) / r0.
+
+    Returns (s, ds/dr). As in PLUMED, mm=0 means 2*nn, s is 1 for r <= d0,
+    and s is 0 beyond d_max (default: where s drops to about 1e-5).
+    """
+    mm = 2 * nn if mm == 0 else mm
+    if d_max is None:
+        d_max = d0 + r0 * 0.00001 ** (1.0 / (nn - mm))
+    x = np.maximum(r - d0, 0.0) / r0
+
+    near_one = np.abs(x - 1.0) < 1e-6
+    xs = np.where(near_one, 0.5, x)  # placeholder value away from the removable singularity
+    num = 1.0 - xs ** nn
+    den = 1.0 - xs ** mm
+    s = num / den
+    dsdx = (-nn * xs ** (nn - 1) * den + mm * xs ** (mm - 1) * num) / den ** 2
+    s = np.where(near_one, nn / mm, s)
+    dsdx = np.where(near_one, 0.5 * nn * (nn - mm) / mm, dsdx)
+
+    outside = r > d_max
+    s = np.where(outside, 0.0, np.where(r <= d0, 1.0, s))
+    dsdr = np.where(outside | (r <= d0), 0.0, dsdx / r0)
+    return s, dsdr
+
+
+class CoordinationCV:
+    """
+    PLUMED COORDINATION: sum of rational switching functions over all (A, B) pairs.
+
+    Distances use the minimum image convention of the current cell, as
+    PLUMED does by default.
+    """
+
+    def __init__(self, name, group_a, group_b, r0, nn=6, mm=0, d0=0.0, d_max=None):
+        self.name = name
+        self.group_a = np.asarray(group_a, dtype=int)
+        self.group_b = np.asarray(group_b, dtype=int)
+        self.r0, self.nn, self.mm, self.d0, self.d_max = r0, nn, mm, d0, d_max
+        a, b = np.meshgrid(self.group_a, self.group_b, indexing="ij")
+        keep = a != b  # an atom in both groups is not paired with itself
+        self.pairs_a = a[keep]
+        self.pairs_b = b[keep]
+
+    def compute(self, positions, cell, pbc):
+        """Return (value, gradient) with gradient shaped like positions."""
+        vectors = positions[self.pairs_b] - positions[self.pairs_a]
+        vectors, r = find_mic(vectors, cell, pbc)
+        s, dsdr = rational_switch(r, self.r0, self.nn, self.mm, self.d0, self.d_max)
+
+        pair_grad = (dsdr / np.where(r > 0, r, 1.0))[:, None] * vectors
+        grad = np.zeros_like(positions)
+        np.add.at(grad, self.pairs_b, pair_grad)
+        np.add.at(grad, self.pairs_a, -pair_grad)
+        return float(s.sum()), grad
+
+
+class Wall:
+    """PLUMED LOWER_WALLS (lower=True) or UPPER_WALLS restraint on one CV."""
+
+    def __init__(self, name, cv_index, at, kappa, exp=2, eps=1.0, offset=0.0, lower=True):
+        self.name = name
+        self.cv_index = cv_index
+        self.at, self.kappa, self.exp, self.eps, self.offset = at, kappa, exp, eps, offset
+        self.lower = lower
+
+    def energy(self, s):
+        """Return (bias, d bias / d s) at CV value s."""
+        scale = (s - self.at - (self.offset if self.lower else -self.offset)) / self.eps
+        if (self.lower and scale >= 0.0) or (not self.lower and scale <= 0.0):
+            return 0.0, 0.0
+        return self.kappa * scale ** self.exp, self.kappa * self.exp / self.eps * scale ** (self.exp - 1)
+
+
+class WellTemperedMetad:
+    """
+    Well-tempered metadynamics bias on a regular grid.
+
+    Hills are added to the grid around their centre only, truncated at
+    2.5 sigma and shifted to zero there as PLUMED does. The grid stores the
+    bias with its first and mixed derivatives, and is evaluated by
+    tensor-product cubic Hermite interpolation, so the returned gradient is
+    the exact derivative of the returned bias. A hill deposited at s gets
+    the height height * exp(-V(s) / (kB T (biasfactor - 1))). HILLS rows
+    store the height times biasfactor / (biasfactor - 1), as PLUMED writes
+    them, so the files are interchangeable.
+    """
+
+    DP2CUTOFF = 6.25
+
+    def __init__(self, cv_names, sigma, height, pace, biasfactor, temperature, grid_min, grid_max, grid_bin=None):
+        self.cv_names = list(cv_names)
+        self.sigma = np.asarray(sigma, dtype=float)
+        self.height = height
+        self.pace = pace
+        self.biasfactor = biasfactor
+        self.kT = units.kB * temperature
+        self.grid_min = np.asarray(grid_min, dtype=float)
+        self.grid_max = np.asarray(grid_max, dtype=float)
+        if grid_bin is None:
+            # PLUMED's default spacing is a fifth of the hill width
+            grid_bin = np.ceil((self.grid_max - self.grid_min) / (self.sigma / 5.0)).astype(int)
+        self.grid_bin = np.asarray(grid_bin, dtype=int)
+        self.spacing = (self.grid_max - self.grid_min) / self.grid_bin
+        self.ndim = len(self.cv_names)
+        shape = tuple(self.grid_bin + 1)
+        # derivs[..., m] is the derivative of the bias with respect to the CVs
+        # whose bits are set in m (m = 0: the bias itself)
+        self.masks = np.array([[(m >> d) & 1 for d in range(self.ndim)] for m in range(2 ** self.ndim)])
+        self.derivs = np.zeros(shape + (2 ** self.ndim,))
+        self.axes = [self.grid_min[d] + self.spacing[d] * np.arange(shape[d]) for d in range(self.ndim)]
+        self.cv_indices = list(range(self.ndim))  # positions of the METAD CVs among all CVs
+        self.hills = []  # (center, sigma, height) of every deposited hill
+        self._stretch_a = 1.0 / (1.0 - np.exp(-0.5 * self.DP2CUTOFF))
+        self._stretch_b = -np.exp(-0.5 * self.DP2CUTOFF) * self._stretch_a
+
+    def add_hill(self, center, height):
+        """Add a Gaussian of the given (unscaled) height at center to the grid."""
+        center = np.asarray(center, dtype=float)
+        self.hills.append((center, self.sigma.copy(), height))
+        reach = np.sqrt(self.DP2CUTOFF) * self.sigma
+        lo = np.clip(np.floor((center - reach - self.grid_min) / self.spacing).astype(int), 0, self.grid_bin)
+        hi = np.clip(np.ceil((center + reach - self.grid_min) / self.spacing).astype(int), 0, self.grid_bin)
+        window = tuple(slice(l, h + 1) for l, h in zip(lo, hi))
+        mesh = np.meshgrid(*[self.axes[d][window[d]] for d in range(self.ndim)], indexing="ij")
+        delta = np.stack([(m - c) / s for m, c, s in zip(mesh, center, self.sigma)], axis=-1)
+        dp2 = np.sum(delta ** 2, axis=-1)
+        inside = dp2 < self.DP2CUTOFF
+        gauss = height * self._stretch_a * np.exp(-0.5 * dp2)
+
+        # d/ds_d of exp(-0.5 dp2) brings down a factor -delta_d / sigma_d
+        factors = -delta / self.sigma
+        update = np.empty(dp2.shape + (len(self.masks),))
+        for m, mask in enumerate(self.masks):
+            update[..., m] = gauss * np.prod(np.where(mask == 1, factors, 1.0), axis=-1)
+        update[..., 0] += height * self._stretch_b
+        self.derivs[window] += np.where(inside[..., None], update, 0.0)
+
+    @staticmethod
+    def _hermite(t):
+        """Cubic Hermite basis (h00, h10, h01, h11) at t and their derivatives."""
+        t2, t3 = t * t, t * t * t
+        values = np.array([2 * t3 - 3 * t2 + 1, t3 - 2 * t2 + t, -2 * t3 + 3 * t2, t3 - t2])
+        slopes = np.array([6 * t2 - 6 * t, 3 * t2 - 4 * t + 1, -6 * t2 + 6 * t, 3 * t2 - 2 * t])
+        return values, slopes
+
+    def bias(self, s):
+        """Return (V(s), dV/ds) interpolated on the grid (zero outside it)."""
+        s = np.asarray(s, dtype=float)
+        if np.any(s < self.grid_min) or np.any(s > self.grid_max):
+            return 0.0, np.zeros(self.ndim)
+        t = (s - self.grid_min) / self.spacing
+        i0 = np.minimum(np.floor(t).astype(int), self.grid_bin - 1)
+        frac = t - i0
+        basis = [self._hermite(frac[d]) for d in range(self.ndim)]
+
+        value, grad = 0.0, np.zeros(self.ndim)
+        for corner in np.ndindex(*([2] * self.ndim)):
+            derivs = self.derivs[tuple(i0 + np.asarray(corner))]
+            for m, mask in enumerate(self.masks):
+                # value basis h00/h01 for plain values, h10/h11 (scaled by the
+                # spacing) for derivative entries
+                terms, slopes = [], []
+                for d in range(self.ndim):
+                    k = 2 * corner[d] + mask[d]
+                    scale = self.spacing[d] if mask[d] else 1.0
+                    terms.append(basis[d][0][k] * scale)
+                    slopes.append(basis[d][1][k] * scale / self.spacing[d])
+                value += derivs[m] * np.prod(terms)
+                for d in range(self.ndim):
+                    grad[d] += derivs[m] * slopes[d] * np.prod(terms[:d] + terms[d + 1:])
+        return float(value), grad
+
+    def hill_height(self, s):
+        """Well-tempered height of a hill deposited at s."""
+        return self.height * np.exp(-self.bias(s)[0] / (self.kT * (self.biasfactor - 1.0)))
+
+    def hills_header(self):
+        names = " ".join(self.cv_names)
+        sigmas = " ".join(f"sigma_{n}" for n in self.cv_names)
+        return f"#! FIELDS time {names} {sigmas} height biasf\n#! SET multivariate false\n#! SET kerneltype gaussian\n"
+
+    def hills_line(self, time, center, height):
+        scaled = height * self.biasfactor / (self.biasfactor - 1.0)
+        values = " ".join(f"{x:14.9f}" for x in (*center, *self.sigma, scaled))
+        return f"{time:14.9f} {values} {self.biasfactor:14.9f}\n"
+
+    def read_hills(self, filename):
+        """Add the hills of a PLUMED HILLS file (e.g. to restart)."""
+        n = len(self.cv_names)
+        with open(filename, "r") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                fields = [float(x) for x in line.split()]
+                center, height = fields[1:1 + n], fields[1 + 2 * n]
+                self.add_hill(center, height * (self.biasfactor - 1.0) / self.biasfactor)
+
+
+class NativeBiasCalculator(Calculator):
+    """
+    ASE calculator adding the CV restraints and metadynamics bias to calc.
+
+    Drop-in replacement for ase.calculators.plumed.Plumed with the PLUMED
+    input of the MTD scripts: every call is one MD step, the bias is
+    evaluated before the hill of that step is deposited, and no hill is
+    deposited on the first step. COLVAR rows (every stride steps) and HILLS
+    rows are buffered in memory and appended to the files every
+    flush_stride steps and on close().
+    """
+
+    implemented_properties = ["energy", "free_energy", "forces"]
+
+    def __init__(self, calc, cvs, walls, metad, timestep, stride=10, flush_stride=100,
+                 colvar_file="COLVAR", hills_file="HILLS", restart=False):
+        Calculator.__init__(self)
+        self.calc = calc
+        self.cvs = cvs
+        self.walls = walls
+        self.metad = metad
+        self.timestep = timestep
+        self.stride = stride
+        self.flush_stride = max(1, flush_stride)
+        self.colvar_file = colvar_file
+        self.hills_file = hills_file
+        self.istep = 0
+        self.cv_values = None
+        self.bias_energy = 0.0
+
+        if restart and metad is not None:
+            try:
+                metad.read_hills(hills_file)
+            except FileNotFoundError:
+                pass
+        mode = "a" if restart else "w"
+        self.colvar_handle = open(colvar_file, mode)
+        self.hills_handle = open(hills_file, mode) if metad is not None else None
+        self.colvar_buffer = io.StringIO()
+        self.hills_buffer = io.StringIO()
+        fields = [cv.name for cv in cvs] + (["metad.bias"] if metad is not None else []) + [w.name + ".bias" for w in walls]
+        self.colvar_buffer.write("#! FIELDS time " + " ".join(fields) + "\n")
+        if metad is not None and not restart:
+            self.hills_buffer.write(metad.hills_header())
+
+    def calculate(self, atoms=None, properties=["energy"], system_changes=all_changes):
+        Calculator.calculate(self, atoms, properties, system_changes)
+        self.calc.calculate(atoms, ["energy", "forces"], system_changes)
+        energy = self.calc.results["energy"]
+        forces = self.calc.results["forces"].copy()
+
+        positions = atoms.get_positions()
+        values, grads = [], []
+        for cv in self.cvs:
+            value, grad = cv.compute(positions, atoms.cell.array, atoms.pbc)
+            values.append(value)
+            grads.append(grad)
+        self.cv_values = values
+
+        dbias = np.zeros(len(self.cvs))
+        wall_energies = []
+        for wall in self.walls:
+            e_wall, de = wall.energy(values[wall.cv_index])
+            wall_energies.append(e_wall)
+            dbias[wall.cv_index] += de
+        metad_energy = 0.0
+        if self.metad is not None:
+            metad_cvs = [values[i] for i in self.metad.cv_indices]
+            metad_energy, metad_grad = self.metad.bias(metad_cvs)
+            dbias[self.metad.cv_indices] += metad_grad
+        self.bias_energy = metad_energy + sum(wall_energies)
+        for d, grad in zip(dbias, grads):
+            if d:
+                forces -= d * grad
+
+        self.results = {
+            "energy": energy + self.bias_energy,
+            "free_energy": energy + self.bias_energy,
+            "forces": forces,
+        }
+
+        time = self.istep * self.timestep
+        if self.istep % self.stride == 0:
+            row = [time, *values] + ([metad_energy] if self.metad is not None else []) + wall_energies
+            self.colvar_buffer.write(" ".join(f"{x:.6f}" for x in row) + "\n")
+        if self.metad is not None and self.istep > 0 and self.istep % self.metad.pace == 0:
+            height = self.metad.hill_height(metad_cvs)
+            self.metad.add_hill(metad_cvs, height)
+            self.hills_buffer.write(self.metad.hills_line(time, metad_cvs, height))
+        if self.istep % self.flush_stride == 0:
+            self.flush()
+        self.istep += 1
+
+    def flush(self):
+        self.colvar_handle.write(self.colvar_buffer.getvalue())
+        self.colvar_handle.flush()
+        self.colvar_buffer = io.StringIO()
+        if self.hills_handle is not None:
+            self.hills_handle.write(self.hills_buffer.getvalue())
+            self.hills_handle.flush()
+            self.hills_buffer = io.StringIO()
+
+    def close(self):
+        if self.colvar_handle.closed:
+            return
+        self.flush()
+        self.colvar_handle.close()
+        if self.hills_handle is not None:
+            self.hills_handle.close()
+
+
+def _parse_line(line):
+    """Split a PLUMED directive into (label, action, {KEY: value})."""
+    words = line.split("#")[0].split()
+    label = None
+    if words and words[0].endswith(":"):
+        label = words.pop(0)[:-1]
+    if not words:
+        return None, None, {}
+    action, keywords = words[0].upper(), {}
+    for word in words[1:]:
+        key, _, value = word.partition("=")
+        keywords[key.upper()] = value
+    if "LABEL" in keywords:
+        label = keywords.pop("LABEL")
+    return label, action, keywords
+
+
+def _floats(value):
+    return [float(x) for x in value.split(",")]
+
+
+def from_plumed_input(calc, plumed_input, timestep, flush_stride=100, restart=False):
+    """
+    Build a NativeBiasCalculator from the PLUMED input lines of the MTD scripts.
+
+    Supported: UNITS (must be LENGTH=A and energies in eV), RESTART,
+    COORDINATION, LOWER_WALLS, UPPER_WALLS, METAD (one per input, no
+    multiple walkers), PRINT and FLUSH (ignored: the native engine flushes
+    every flush_stride steps). Anything else raises ValueError, so an input
+    is never silently run with part of its bias missing.
+    """
+    cvs, walls, metad = [], [], None
+    stride, colvar_file, hills_file = 1, "COLVAR", "HILLS"
+
+    def cv_index(name):
+        for i, cv in enumerate(cvs):
+            if cv.name == name:
+                return i
+        raise ValueError(f"Unknown CV '{name}' in PLUMED input")
+
+    for line in plumed_input:
+        label, action, kw = _parse_line(line)
+        if action is None or action == "FLUSH":
+            continue
+        if action == "RESTART":
+            restart = True
+        elif action == "UNITS":
+            if kw.get("LENGTH", "A") != "A" or abs(float(kw.get("ENERGY", "0")) - units.mol / units.kJ) > 1e-6:
+                raise ValueError(f"Native bias engine needs UNITS LENGTH=A and ENERGY in eV, got: {line}")
+        elif action == "COORDINATION":
+            cvs.append(CoordinationCV(
+                label, parse_atom_list(kw["GROUPA"]), parse_atom_list(kw["GROUPB"]), float(kw["R_0"]),
+                nn=int(kw.get("NN", 6)), mm=int(kw.get("MM", 0)), d0=float(kw.get("D_0", 0.0)),
+                d_max=float(kw["D_MAX"]) if "D_MAX" in kw else None,
+            ))
+        elif action in ("LOWER_WALLS", "UPPER_WALLS"):
+            args = kw["ARG"].split(",")
+            n = len(args)
+            per_arg = {k: (_floats(kw[k]) if k in kw else [d] * n)
+                       for k, d in (("AT", None), ("KAPPA", None), ("EXP", 2.0), ("EPS", 1.0), ("OFFSET", 0.0))}
+            for j, arg in enumerate(args):
+                walls.append(Wall(label or action.lower(), cv_index(arg), per_arg["AT"][j], per_arg["KAPPA"][j],
+                                  exp=per_arg["EXP"][j], eps=per_arg["EPS"][j], offset=per_arg["OFFSET"][j],
+                                  lower=action == "LOWER_WALLS"))
+        elif action == "METAD":
+            if metad is not None:
+                raise ValueError("Native bias engine supports a single METAD action")
+            if any(k.startswith("WALKERS_") for k in kw):
+                raise ValueError("Native bias engine does not support multiple walkers; use the PLUMED engine")
+            names = kw["ARG"].split(",")
+            for name in names:
+                cv_index(name)
+            metad = WellTemperedMetad(
+                names, _floats(kw["SIGMA"]), float(kw["HEIGHT"]), int(kw["PACE"]), float(kw["BIASFACTOR"]),
+                float(kw["TEMP"]), _floats(kw["GRID_MIN"]), _floats(kw["GRID_MAX"]),
+                grid_bin=[int(x) for x in kw["GRID_BIN"].split(",")] if "GRID_BIN" in kw else None,
+            )
+            metad.cv_indices = [cv_index(name) for name in names]
+            hills_file = kw.get("FILE", "HILLS")
+        elif action == "PRINT":
+            stride = int(kw.get("STRIDE", 1))
+            colvar_file = kw.get("FILE", "COLVAR")
+        else:
+            raise ValueError(f"PLUMED action {action} is not supported by the native bias engine: {line}")
+
+    return NativeBiasCalculator(calc, cvs, walls, metad, timestep, stride=stride, flush_stride=flush_stride,
+                                colvar_file=colvar_file, hills_file=hills_file, restart=restart)
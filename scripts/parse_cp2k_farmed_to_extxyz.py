@@ -1,90 +1,139 @@
+import mmap
+import multiprocessing
 import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from ase.io import read, write
 from ase import Atoms
 from ase.units import Hartree, Bohr
 
-def parse_cp2k_farming_output(filepath):
-    energy = None
-    forces = []
-    in_force_block = False
-    scf_converged = True
-
-    with open(filepath, 'r') as f:
-        for line in f:
-            # Check SCF convergence more robustly
-            if "SCF run NOT converged" in line:
-                scf_converged = False
-
-            # Parse energy
-            if 'ENERGY|' in line and 'Total FORCE_EVAL ( QS ) energy [a.u.]:' in line:
-                try:
-                    energy = float(line.split()[-1]) * Hartree  # Convert to eV
-                except ValueError:
-                    continue
-
-            # Detect start of force block
-            elif 'ATOMIC FORCES in [a.u.]' in line:
-                in_force_block = True
-                skip_lines = 2  # Skip headers
+# CP2K output markers. Files are memory mapped and searched with these
+# byte patterns instead of being scanned line by line in Python.
+ENERGY_PATTERN = re.compile(rb"ENERGY\|\s+Total FORCE_EVAL \( QS \) energy \[a\.u\.\]:\s+(\S+)")
+FORCES_HEADER = b"ATOMIC FORCES in [a.u.]"
+FORCE_LINE_PATTERN = re.compile(rb"^\s*\d+\s+\d+\s+\S+\s+(\S+)\s+(\S+)\s+(\S+)\s*$", re.MULTILINE)
+BLANK_LINE_PATTERN = re.compile(rb"\n[ \t\r]*\n")
+SCF_NOT_CONVERGED = b"SCF run NOT converged"
+
+
+def read_cp2k_output(filepath):
+    """
+    Return (energy in eV, forces in eV/Å as an (N, 3) array, None), or (None, None, reason).
+
+    The energy is the last FORCE_EVAL energy of the file and the forces
+    are the first ATOMIC FORCES block, decoded into NumPy in one go.
+    """
+    if os.path.getsize(filepath) == 0:
+        return None, None, "empty output"
+    with open(filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data.find(SCF_NOT_CONVERGED) != -1:
+            return None, None, "SCF did not converge"
+
+        # The last energy line wins, as in a line-by-line scan
+        energy = None
+        for value in reversed(ENERGY_PATTERN.findall(data)):
+            try:
+                energy = float(value) * Hartree  # Convert to eV
+                break
+            except ValueError:
                 continue
 
-            elif in_force_block:
-                if skip_lines > 0:
-                    skip_lines -= 1
-                    continue
-                if line.strip() == "":
-                    break  # End of block
-                try:
-                    parts = line.split()
-                    fx, fy, fz = [float(x) * Hartree / Bohr for x in parts[3:6]]
-                    forces.append([fx, fy, fz])
-                except (ValueError, IndexError):
-                    continue
-
-    if not scf_converged:
-        print(f"⚠️ Skipping {filepath} — SCF did not converge.")
-        return None
+        # Force block: two header lines after the marker, atom lines up to the next blank line
+        forces = None
+        start = data.find(FORCES_HEADER)
+        if start != -1:
+            for _ in range(3):
+                start = data.find(b"\n", start) + 1 if start != -1 else -1
+            if start > 0:
+                end = BLANK_LINE_PATTERN.search(data, start - 1)
+                block = data[start:end.start() if end else len(data)]
+                values = FORCE_LINE_PATTERN.findall(block)
+                if values:
+                    forces = np.array(values, dtype=np.float64) * (Hartree / Bohr)
+
+    if energy is None or forces is None:
+        return None, None, "energy or forces not found"
+    return energy, forces, None
 
-    if energy is None or not forces:
-        print(f"⚠️ Skipping {filepath} — energy or forces not found.")
-        return None
 
+def parse_cp2k_farming_output(filepath):
+    energy, forces, reason = read_cp2k_output(filepath)
+    if reason is not None:
+        print(f"⚠️ Skipping {filepath} — {reason}.")
+        return None
     return energy, forces
 
 
-def collect_cp2k_results(run_prefix='run', structure_file='structure.xyz', farming_prefix='FARMING_OUT_', output='cp2k_farmed_dataset.xyz'):
-    all_atoms = []
+def harvest_run(run_dir, structure_file='structure.xyz', farming_prefix=('FARMING_OUT_', 'sp.out')):
+    """Return (atoms with REF_energy/REF_forces, None) for one run directory, or (None, reason)."""
+    structure_path = os.path.join(run_dir, structure_file)
+    farming_file = None
+    for f in sorted(os.listdir(run_dir)):
+        # cp2k_scheduler.py sets the outputs of earlier attempts aside as <output>.attempt<k>
+        if f.startswith(farming_prefix) and ".attempt" not in f:
+            farming_file = os.path.join(run_dir, f)
+            break
 
-    for run_dir in sorted(os.listdir()):
-        if not run_dir.startswith(run_prefix) or not os.path.isdir(run_dir):
-            continue
+    if not os.path.isfile(structure_path) or not farming_file:
+        return None, "missing structure or CP2K output"
 
-        structure_path = os.path.join(run_dir, structure_file)
-        farming_file = None
-        for f in os.listdir(run_dir):
-            if f.startswith(farming_prefix):
-                farming_file = os.path.join(run_dir, f)
-                break
+    try:
+        atoms = read(structure_path)
+    except Exception as e:
+        return None, f"unreadable structure ({e})"
 
-        if not os.path.isfile(structure_path) or not farming_file:
-            print(f"⚠️ Missing files in {run_dir}, skipping.")
-            continue
+    energy, forces, reason = read_cp2k_output(farming_file)
+    if reason is not None:
+        return None, reason
+    if len(forces) != len(atoms):
+        return None, f"{len(forces)} forces for {len(atoms)} atoms"
 
-        try:
-            atoms = read(structure_path)
-        except Exception as e:
-            print(f"⚠️ Failed to read {structure_path}: {e}")
-            continue
+    atoms.info["REF_energy"] = energy
+    atoms.set_array("REF_forces", forces)
+    return atoms, None
 
-        parsed = parse_cp2k_farming_output(farming_file)
-        if parsed is None:
-            continue
 
-        energy, forces = parsed
-        atoms.info["REF_energy"] = energy
-        atoms.set_array("REF_forces", np.array(forces))
-        all_atoms.append(atoms)
+def _harvest_run(task):
+    return harvest_run(*task)
+
+
+# FARMING writes FARMING_OUT_* per job; run_cp2k_jobs.py and cp2k_stream_worker.py write sp.out
+def collect_cp2k_results(run_prefix='run', structure_file='structure.xyz', farming_prefix=('FARMING_OUT_', 'sp.out'), output='cp2k_farmed_dataset.xyz', workers=None, skip_report='cp2k_skipped_runs.txt'):
+    """
+    Parse all run directories into one extxyz dataset, fanned out over a process pool.
+
+    Skipped runs are printed with their reason, listed in skip_report and
+    summarised by reason at the end.
+    """
+    run_dirs = [d for d in sorted(os.listdir()) if d.startswith(run_prefix) and os.path.isdir(d)]
+    tasks = [(run_dir, structure_file, farming_prefix) for run_dir in run_dirs]
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+
+    if workers > 1:
+        # fork: the callers are scripts without a __main__ guard
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+            results = list(pool.map(_harvest_run, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+    else:
+        results = [_harvest_run(task) for task in tasks]
+
+    all_atoms = []
+    skipped = []
+    for run_dir, (atoms, reason) in zip(run_dirs, results):
+        if atoms is None:
+            print(f"⚠️ Skipping {run_dir} — {reason}.")
+            skipped.append((run_dir, reason))
+        else:
+            all_atoms.append(atoms)
+
+    if skip_report:
+        with open(skip_report, "w") as f:
+            for run_dir, reason in skipped:
+                f.write(f"{run_dir}\t{reason}\n")
+    if skipped:
+        summary = ", ".join(f"{n} {reason}" for reason, n in Counter(reason for _, reason in skipped).most_common())
+        print(f"Skipped {len(skipped)} of {len(run_dirs)} runs: {summary}")
 
     if all_atoms:
         write(output, all_atoms)
@@ -94,4 +143,3 @@ def collect_cp2k_results(run_prefix='run', structure_file='structure.xyz', farmi
 
 if __name__ == "__main__":
     collect_cp2k_results()
-
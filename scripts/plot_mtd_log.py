@@ -0,0 +1,47 @@
+import argparse
+import numpy as np
+
+
+def plot_mtd_log(log_file="mace_mtd_log.npz", output="mace_mtd_committee_analysis.png"):
+    """
+    Render the committee MTD analysis figure from the NPZ log written by the
+    MTD_committee_plumed_MACE_system*.py propagators.
+
+    The log holds time_fs, temperatures, variances, committee_energies,
+    energies_all (one row per committee member) and variance_limit.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    log = np.load(log_file)
+    time_fs = log["time_fs"]
+
+    fig, ax = plt.subplots(3, 1, figsize=(8, 6), sharex='all', gridspec_kw={'hspace': 0})
+
+    ax[0].axhline(y=float(log["variance_limit"]), color='r', linestyle=':')
+    ax[0].plot(time_fs, log["variances"], color="y")
+    ax[0].set_ylabel("Variance")
+    ax[0].legend(["Threshold", "Estimated Variance"])
+
+    ax[1].plot(time_fs, log["temperatures"], color="r")
+    ax[1].set_ylabel("T (K)")
+
+    for i, e_list in enumerate(log["energies_all"]):
+        ax[2].plot(time_fs, e_list, label=f"E mace{i+1}")
+    ax[2].plot(time_fs, log["committee_energies"], color="black", label="E committee")
+    ax[2].set_ylabel("E (eV/atom)")
+    ax[2].set_xlabel("Time (fs)")
+    ax[2].legend(loc='upper left')
+
+    plt.tight_layout()
+    plt.savefig(output, dpi=300)
+    plt.close(fig)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plot variance, temperature and energies of a committee MTD run")
+    parser.add_argument("--log", default="mace_mtd_log.npz", help="NPZ log written by the MTD propagator")
+    parser.add_argument("--output", default="mace_mtd_committee_analysis.png", help="Output figure")
+    args = parser.parse_args()
+    plot_mtd_log(args.log, args.output)
@@ -1,10 +1,6 @@
 import os
-from ase.io import read, write
-import shutil
-
-if os.path.exists("farming_driver.inp") and len([d for d in os.listdir() if d.startswith("run")]) > 0:
-    print("Farming input already exists. Skipping regeneration.")
-    exit(0)
+from ase.io import iread, write
+from cp2k_scheduler import core_budget
 
 # === Configuration ===
 xyz_file = "frames_for_DFT_eval_filtered.xyz"
@@ -12,25 +8,19 @@ template_input = "template.inp"  # Must contain @CELL@ as a placeholder
 output_prefix = "run"
 output_input_name = "sp.inp"
 output_xyz_name = "structure.xyz"
+output_log_name = "sp.out"  # CP2K output of a job run by run_cp2k_jobs.py or cp2k_stream_worker.py
 farming_input_file = "farming_driver.inp"
 
 # === Hardware configuration ===
-total_cores = 512
+# Only used by the static FARMING input; run_cp2k_jobs.py sizes each job by
+# its atom count instead.
+total_cores = core_budget(default=512)
 cores_per_job = 128
-ngroups = total_cores // cores_per_job
-
-# === Load frames ===
-frames = read(xyz_file, index=":")
-nframes = len(frames)
-print(f"Found {nframes} frames. Preparing {nframes} jobs...")
+ngroups = max(1, total_cores // cores_per_job)
 
-# === Read the CP2K input template ===
-with open(template_input, "r") as f:
-    template_text = f.read()
 
-# === Create job directories ===
-for i, frame in enumerate(frames, start=1):
-    run_dir = f"{output_prefix}{i}"
+def write_job(frame, run_dir, template_text):
+    """Write the structure and the CP2K input of one single point into run_dir."""
     os.makedirs(run_dir, exist_ok=True)
 
     # Write the structure
@@ -57,25 +47,44 @@ for i, frame in enumerate(frames, start=1):
     with open(input_dest, "w") as f:
         f.write(customized_input)
 
-# === Generate FARMING input ===
-with open(farming_input_file, "w") as f:
-    f.write("&GLOBAL\n")
-    f.write("  PROJECT cp2k_farming\n")
-    f.write("  PROGRAM FARMING\n")
-    f.write("  RUN_TYPE NONE\n")
-    f.write("&END GLOBAL\n\n")
-
-    f.write("&FARMING\n")
-    f.write(f"  NGROUPS {ngroups}\n")
-
-    for i in range(1, nframes + 1):
-        f.write("  &JOB\n")
-        f.write(f"    DIRECTORY {output_prefix}{i}\n")
-        f.write(f"    INPUT_FILE_NAME {output_input_name}\n")
-        f.write("  &END JOB\n")
+
+if __name__ == "__main__":
+    if os.path.exists(farming_input_file) and len([d for d in os.listdir() if d.startswith("run")]) > 0:
+        print("Farming input already exists. Skipping regeneration.")
+        exit(0)
+
+    # === Read the CP2K input template ===
+    with open(template_input, "r") as f:
+        template_text = f.read()
+
+    # === Create job directories ===
+    # Frames are streamed one at a time, so memory use does not grow with the
+    # number of candidate structures.
+    print(f"Streaming frames from {xyz_file}...")
+    nframes = 0
+    for i, frame in enumerate(iread(xyz_file, index=":"), start=1):
+        nframes = i
+        write_job(frame, f"{output_prefix}{i}", template_text)
+
+    # === Generate FARMING input ===
+    with open(farming_input_file, "w") as f:
+        f.write("&GLOBAL\n")
+        f.write("  PROJECT cp2k_farming\n")
+        f.write("  PROGRAM FARMING\n")
+        f.write("  RUN_TYPE NONE\n")
+        f.write("&END GLOBAL\n\n")
+
+        f.write("&FARMING\n")
+        f.write(f"  NGROUPS {ngroups}\n")
+
+        for i in range(1, nframes + 1):
+            f.write("  &JOB\n")
+            f.write(f"    DIRECTORY {output_prefix}{i}\n")
+            f.write(f"    INPUT_FILE_NAME {output_input_name}\n")
+            f.write("  &END JOB\n")
     
-    f.write("&END FARMING\n")
+        f.write("&END FARMING\n")
 
-print(f"\nAll jobs prepared in {nframes} directories.")
-print(f"FARMING input written to: {farming_input_file}")
-print(f"Parallel jobs: {ngroups} at a time")
+    print(f"\nAll jobs prepared in {nframes} directories.")
+    print(f"FARMING input written to: {farming_input_file}")
+    print(f"Parallel jobs: {ngroups} at a time")
@@ -0,0 +1,61 @@
+import argparse
+import os
+import re
+import sys
+from ase.io import read
+from cp2k_scheduler import add_scheduler_arguments, count_atoms, job_finished, scheduler_from_args
+from prepare_cp2k_farming_jobs import output_input_name, output_log_name, output_prefix, output_xyz_name
+from wfn_restart import WavefunctionSeeder, report_scf_steps, similarity_order
+
+# === Load-balanced CP2K single points ===
+# Runs the job directories written by prepare_cp2k_farming_jobs.py through
+# the work-queue scheduler of cp2k_scheduler.py instead of a static FARMING
+# run: the core budget comes from the SLURM allocation, each job is sized
+# by its atom count, the largest jobs start first and jobs over
+# --job_timeout are cancelled and requeued. Jobs whose output already ran
+# to the end are skipped, so an interrupted batch can be rerun. With
+# --reuse_wfn, jobs are queued in similarity order and each SCF starts from
+# the wavefunction of the closest finished job (see wfn_restart.py).
+#
+# Usage (inside the CP2K allocation, after prepare_cp2k_farming_jobs.py):
+#   python run_cp2k_jobs.py --job_timeout 3600
+# Without SLURM (e.g. for testing), jobs run locally:
+#   python run_cp2k_jobs.py --launcher local --total_cores 8 --core_granularity 4
+
+parser = argparse.ArgumentParser(description="Run prepared CP2K jobs with a load-balancing work queue")
+parser.add_argument("--reuse_wfn", action="store_true",
+                    help="Seed each job with the converged wavefunction of the closest finished job")
+add_scheduler_arguments(parser)
+args = parser.parse_args()
+
+run_dirs = sorted((d for d in os.listdir() if re.fullmatch(rf"{output_prefix}\d+", d) and os.path.isdir(d)),
+                  key=lambda d: int(d[len(output_prefix):]))
+seeder = None
+if args.reuse_wfn:
+    seeder = WavefunctionSeeder(output_input_name, output_log_name)
+    frames = [read(os.path.join(d, output_xyz_name)) for d in run_dirs]
+    for run_dir, atoms in zip(run_dirs, frames):
+        seeder.add_frame(run_dir, atoms, finished=job_finished(os.path.join(run_dir, output_log_name)))
+    # Jobs of equal size start in this order, so neighbours finish one after another
+    run_dirs = [run_dirs[k] for k in similarity_order(frames)]
+scheduler, size = scheduler_from_args(args, output_input_name, output_log_name,
+                                      on_start=seeder.on_start if seeder else None,
+                                      on_finish=seeder.on_finish if seeder else None)
+
+n_skipped = 0
+for run_dir in run_dirs:
+    if job_finished(os.path.join(run_dir, output_log_name)):
+        n_skipped += 1
+        continue
+    n_atoms = count_atoms(os.path.join(run_dir, output_xyz_name))
+    scheduler.submit(run_dir, n_atoms, size(n_atoms), start=False)
+print(f"Queued {len(run_dirs) - n_skipped} CP2K jobs ({n_skipped} already finished)", flush=True)
+
+scheduler.run(args.poll_interval)
+
+n_succeeded = sum(code == 0 for code in scheduler.completed.values())
+n_failed = len(scheduler.completed) - n_succeeded + len(scheduler.failed)
+print(f"All CP2K jobs done: {n_succeeded} succeeded, {n_failed} failed or cancelled.")
+if seeder is not None:
+    report_scf_steps(seeder.records)
+sys.exit(1 if n_failed else 0)
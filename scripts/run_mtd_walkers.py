@@ -0,0 +1,148 @@
+import argparse
+import glob
+import os
+import shutil
+import subprocess
+import sys
+from ase.io import read, write
+
+# === Multi-walker driver for the committee MTD propagator ===
+# Runs N independent copies of the propagator in walker_<k>/ directories,
+# each with its own velocity seed, and optionally lets them share one METAD
+# bias through PLUMED multiple walkers (HILLS.<k> files in a shared
+# directory). The walkers' candidate frames are merged, highest variance
+# first, into ./frames_for_DFT_eval.xyz, so the descriptor filter sees the
+# frames of all walkers at once.
+#
+# Usage:
+#   python run_mtd_walkers.py --propagator MTD_committee_plumed_MACE_system.py \
+#       --n_walkers 4 --shared_hills -- --input_file start.traj --model_paths m1.model m2.model ...
+#
+# Rerunning with --resume among the propagator arguments continues every
+# walker from its last positions, velocities and hills.
+
+parser = argparse.ArgumentParser(description="Run several MTD walkers in parallel and merge their frames")
+parser.add_argument("--propagator", type=str, required=True,
+                    help="MTD propagator script; must be MTD_committee_plumed_MACE_system.py, the _fix and "
+                         "_stopCond variants have no --seed/--walkers_* options")
+parser.add_argument("--n_walkers", type=int, default=4, help="Number of walkers")
+parser.add_argument("--seed", type=int, default=0, help="Seed of walker 0; walker k uses seed + k")
+parser.add_argument("--shared_hills", action="store_true", help="Share the METAD bias between walkers (PLUMED WALKERS_*)")
+parser.add_argument("--walkers_rstride", type=int, default=100, help="Steps between reading the other walkers' hills")
+parser.add_argument("--frames_file", type=str, default="frames_for_DFT_eval.xyz",
+                    help="Candidate frame file written by each walker and appended to here")
+parser.add_argument("propagator_args", nargs=argparse.REMAINDER,
+                    help="Arguments passed on to every walker (after --)")
+args = parser.parse_args()
+
+propagator_args = args.propagator_args
+if propagator_args and propagator_args[0] == "--":
+    propagator_args = propagator_args[1:]
+
+if os.path.basename(args.propagator) in ("MTD_committee_plumed_MACE_system_fix.py",
+                                          "MTD_committee_plumed_MACE_system_stopCond.py"):
+    parser.error(f"{os.path.basename(args.propagator)} has no --seed/--walkers_* options; "
+                 "use MTD_committee_plumed_MACE_system.py as --propagator")
+
+# Walkers run in subdirectories, so the relative input paths of the propagator
+# are made absolute. Outputs (restart, trajectory, logs) stay per walker.
+PATH_OPTIONS = {"--input_file", "--model_paths", "--cv_config", "--reference",
+                "--descriptor_model", "--descriptor_cache"}
+
+
+def absolutise_paths(arguments):
+    result = []
+    option = None
+    for a in arguments:
+        if a.startswith("--"):
+            name, sep, value = a.partition("=")
+            option = name if name in PATH_OPTIONS else None
+            if option and sep:
+                a = f"{name}={os.path.abspath(value)}"
+                option = None
+        elif option:
+            # --model_paths takes several values, so every value up to the next option is a path
+            a = os.path.abspath(a)
+        result.append(a)
+    return result
+
+
+propagator_args = absolutise_paths(propagator_args)
+propagator = os.path.abspath(args.propagator)
+
+# With --resume the walkers continue from their restart files and the
+# existing hills, so neither the shared bias nor the trajectories are reset.
+resume = "--resume" in propagator_args
+
+hills_dir = os.path.abspath("walkers_hills")
+if args.shared_hills:
+    os.makedirs(hills_dir, exist_ok=True)
+    for f in [] if resume else glob.glob(os.path.join(hills_dir, "HILLS*")):
+        os.remove(f)
+
+# === Launch walkers ===
+walkers = []
+for k in range(args.n_walkers):
+    walker_dir = f"walker_{k}"
+    os.makedirs(walker_dir, exist_ok=True)
+    for stale in (args.frames_file,) if resume else (args.frames_file, "MACE_MTD_committee_system.xyz"):
+        if os.path.exists(os.path.join(walker_dir, stale)):
+            os.remove(os.path.join(walker_dir, stale))
+
+    cmd = [sys.executable, propagator, *propagator_args, "--seed", str(args.seed + k)]
+    if args.shared_hills:
+        cmd += ["--walkers_n", str(args.n_walkers), "--walker_id", str(k),
+                "--walkers_dir", hills_dir, "--walkers_rstride", str(args.walkers_rstride)]
+
+    print(f"Starting walker {k}: {' '.join(cmd)}")
+    log = open(os.path.join(walker_dir, "walker.log"), "w")
+    walkers.append((k, walker_dir, log, subprocess.Popen(cmd, cwd=walker_dir, stdout=log, stderr=subprocess.STDOUT)))
+
+failed = []
+for k, walker_dir, log, proc in walkers:
+    proc.wait()
+    log.close()
+    if proc.returncode != 0:
+        print(f"⚠️ Walker {k} exited with code {proc.returncode} (see {walker_dir}/walker.log)")
+        failed.append(k)
+
+if len(failed) == args.n_walkers:
+    print("❌ All walkers failed.")
+    sys.exit(1)
+
+# === Merge candidate frames, highest variance first ===
+frames = []
+for k, walker_dir, _, _ in walkers:
+    path = os.path.join(walker_dir, args.frames_file)
+    if k in failed or not os.path.isfile(path):
+        continue
+    for atoms in read(path, ":"):
+        atoms.info["walker"] = k
+        frames.append(atoms)
+
+def variance_key(atoms):
+    # Frames without a variance (written as variance=None, read back as True) go last
+    variance = atoms.info.get("variance")
+    if isinstance(variance, bool) or not isinstance(variance, (int, float)):
+        return 1
+    return -variance
+
+frames.sort(key=variance_key)
+write(args.frames_file, frames, format="extxyz", write_results=False, append=True)
+print(f"✅ Merged {len(frames)} frames from {args.n_walkers - len(failed)} walkers into {args.frames_file}")
+
+# === Collect PLUMED output and figures for publishing ===
+first = next(walker_dir for k, walker_dir, _, _ in walkers if k not in failed)
+if os.path.isfile(os.path.join(first, "COLVAR")):
+    shutil.copy(os.path.join(first, "COLVAR"), "COLVAR")
+hills_files = (sorted(glob.glob(os.path.join(hills_dir, "HILLS.*"))) if args.shared_hills
+               else [os.path.join(d, "HILLS") for k, d, _, _ in walkers if k not in failed])
+with open("HILLS", "w") as out:
+    for path in hills_files:
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                shutil.copyfileobj(f, out)
+for k, walker_dir, _, _ in walkers:
+    figure = os.path.join(walker_dir, "mace_mtd_committee_analysis.png")
+    if os.path.isfile(figure):
+        shutil.copy(figure, f"mace_mtd_committee_analysis_walker{k}.png")
@@ -0,0 +1,124 @@
+import argparse
+import os
+import tempfile
+import numpy as np
+from ase import units
+from ase.calculators.calculator import Calculator, all_changes
+from ase.calculators.plumed import Plumed
+from ase.io import read
+from native_bias import from_plumed_input
+
+# === Validation: native bias engine against PLUMED ===
+# Replays the frames of an MTD trajectory as consecutive MD steps through
+# PLUMED (ase.calculators.plumed) and through native_bias.py with the same
+# PLUMED input, on top of a zero-energy calculator, so that both return the
+# bias alone. Compares CVs, bias energies, bias forces and deposited hills.
+#
+# Usage (in an MTD output directory, needs the plumed Python module):
+#   python validate_native_bias.py --plumed_input plumed.dat --frames MACE_MTD_committee_system.xyz
+
+
+class ZeroCalculator(Calculator):
+    """Zero energy and forces, so the wrapping calculator returns its bias only."""
+
+    implemented_properties = ["energy", "free_energy", "forces"]
+
+    def calculate(self, atoms=None, properties=["energy"], system_changes=all_changes):
+        Calculator.calculate(self, atoms, properties, system_changes)
+        self.results = {"energy": 0.0, "free_energy": 0.0, "forces": np.zeros((len(atoms), 3))}
+
+
+parser = argparse.ArgumentParser(description="Validate the native CV/bias engine against PLUMED")
+parser.add_argument("--plumed_input", type=str, default="plumed.dat", help="PLUMED input written by the MTD propagator")
+parser.add_argument("--frames", type=str, required=True, help="Trajectory whose frames are replayed as MD steps")
+parser.add_argument("--max_frames", type=int, default=500, help="Number of frames to replay")
+parser.add_argument("--pace", type=int, default=None,
+                    help="Override METAD PACE, so that hills are deposited within the replayed frames")
+parser.add_argument("--temperature", type=float, default=400, help="Temperature in Kelvin (kT passed to PLUMED)")
+parser.add_argument("--timestep", type=float, default=1.0, help="Timestep passed to both engines")
+parser.add_argument("--energy_tol", type=float, default=1e-3, help="Tolerance on bias energies (eV)")
+parser.add_argument("--force_tol", type=float, default=1e-2, help="Tolerance on bias forces (eV/Å)")
+parser.add_argument("--cv_tol", type=float, default=1e-5, help="Tolerance on CV values")
+args = parser.parse_args()
+
+with open(args.plumed_input, "r") as f:
+    plumed_input = []
+    for line in f:
+        line = line.strip()
+        if not line or line.upper() == "RESTART":
+            continue
+        if args.pace is not None and " METAD " in f" {line} ":
+            line = " ".join(f"PACE={args.pace}" if w.startswith("PACE=") else w for w in line.split())
+        plumed_input.append(line)
+
+frames = read(args.frames, f":{args.max_frames}")
+print(f"Replaying {len(frames)} frames of {args.frames}")
+
+
+def colvar_fields(path):
+    """Column names of a COLVAR file, from its '#! FIELDS' header."""
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith("#! FIELDS"):
+                return line.split()[2:]
+    raise ValueError(f"No FIELDS header in {path}")
+
+
+def replay(engine, workdir):
+    """Return per-frame (CV values or None, bias energy, bias forces) and the HILLS rows of one engine."""
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        atoms = frames[0].copy()
+        if engine == "native":
+            calc = from_plumed_input(ZeroCalculator(), plumed_input, timestep=args.timestep, flush_stride=1)
+        else:
+            calc = Plumed(calc=ZeroCalculator(), input=plumed_input, timestep=args.timestep, atoms=atoms,
+                          kT=units.kB * args.temperature)
+        atoms.calc = calc
+        energies, forces = [], []
+        for frame in frames:
+            atoms.set_positions(frame.get_positions())
+            energies.append(atoms.get_potential_energy())
+            forces.append(atoms.get_forces())
+        if engine == "native":
+            calc.close()
+        else:
+            calc.plumed.finalize()
+        colvar = dict(zip(colvar_fields("COLVAR"), np.loadtxt("COLVAR", comments="#", ndmin=2).T))
+        hills = np.loadtxt("HILLS", comments="#", ndmin=2) if os.path.isfile("HILLS") else np.empty((0, 0))
+        return np.array(energies), np.array(forces), colvar, hills
+    finally:
+        os.chdir(cwd)
+
+
+with tempfile.TemporaryDirectory() as plumed_dir, tempfile.TemporaryDirectory() as native_dir:
+    results = {engine: replay(engine, d) for engine, d in (("plumed", plumed_dir), ("native", native_dir))}
+
+(e_ref, f_ref, colvar_ref, hills_ref), (e_nat, f_nat, colvar_nat, hills_nat) = results["plumed"], results["native"]
+# COLVAR columns are matched by name, so any number of CVs is compared
+n_rows = min(len(colvar_ref["time"]), len(colvar_nat["time"]))
+fields = [name for name in colvar_ref if name != "time" and name in colvar_nat]
+cv_fields = [name for name in fields if not name.endswith(".bias")]
+checks = [
+    (f"CVs {','.join(cv_fields)} (COLVAR)",
+     max(np.abs(colvar_ref[name][:n_rows] - colvar_nat[name][:n_rows]).max() for name in cv_fields), args.cv_tol),
+    ("bias energy", np.abs(e_ref - e_nat).max(), args.energy_tol),
+    ("bias forces", np.abs(f_ref - f_nat).max(), args.force_tol),
+]
+for name in fields:
+    if name.endswith(".bias"):
+        checks.append((f"{name} (COLVAR)", np.abs(colvar_ref[name][:n_rows] - colvar_nat[name][:n_rows]).max(),
+                       args.energy_tol))
+if len(hills_ref) != len(hills_nat):
+    checks.append(("number of hills", abs(len(hills_ref) - len(hills_nat)), 0))
+elif len(hills_ref):
+    checks.append(("hill centres and heights", np.abs(hills_ref[:, 1:] - hills_nat[:, 1:]).max(), args.energy_tol))
+
+failed = False
+for name, deviation, tol in checks:
+    ok = deviation <= tol
+    failed |= not ok
+    print(f"{name:<26}: max deviation {deviation:.3e} (tolerance {tol:.1e}) {'OK' if ok else 'FAILED'}")
+print(f"{len(hills_nat)} hills deposited by the native engine, {len(hills_ref)} by PLUMED")
+exit(1 if failed else 0)
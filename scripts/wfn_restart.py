@@ -0,0 +1,158 @@
+import glob
+import os
+import re
+import numpy as np
+from ase.geometry import find_mic
+
+# === Wavefunction restarts between similar DFT frames ===
+# Candidate frames come from one MTD trajectory, so many of them are
+# geometrically close. Starting the SCF of a frame from the converged
+# wavefunction of its nearest already computed frame (SCF_GUESS RESTART)
+# instead of an atomic guess saves SCF steps. A CP2K wavefunction only
+# transfers between frames with the same atoms in the same order, so the
+# similarity used here is the minimum image RMSD of the positions, and
+# frames of different composition are never paired.
+
+WFN_PATTERN = "*-RESTART.wfn"
+
+
+def frame_distance(a, b):
+    """Minimum image RMSD (Å) between two frames, inf if their atoms differ."""
+    if len(a) != len(b) or not np.array_equal(a.numbers, b.numbers):
+        return np.inf
+    displacement, _ = find_mic(b.positions - a.positions, a.cell, a.pbc)
+    return float(np.sqrt(np.mean(np.sum(displacement ** 2, axis=1))))
+
+
+def nearest_frame(atoms, candidates):
+    """Return (key, distance) of the closest frame in the dict candidates, or (None, inf)."""
+    best, best_distance = None, np.inf
+    for key, other in candidates.items():
+        distance = frame_distance(atoms, other)
+        if distance < best_distance:
+            best, best_distance = key, distance
+    return best, best_distance
+
+
+def similarity_order(frames):
+    """
+    Indices of frames in greedy nearest-neighbour order, starting from the first.
+
+    Consecutive frames are as close as possible, so when they are computed
+    in this order each frame has a close neighbour already computed.
+    """
+    remaining = list(range(len(frames)))
+    order = [remaining.pop(0)] if remaining else []
+    while remaining:
+        last = frames[order[-1]]
+        k = min(range(len(remaining)), key=lambda j: frame_distance(last, frames[remaining[j]]))
+        order.append(remaining.pop(k))
+    return order
+
+
+def set_scf_guess(input_text, restart_file=None):
+    """
+    Return the CP2K input with SCF_GUESS RESTART from restart_file, or SCF_GUESS ATOMIC without one.
+
+    Also switches on writing the wavefunction (without backup copies), so
+    the frame can seed its own neighbours.
+    """
+    text = re.sub(r"^\s*WFN_RESTART_FILE_NAME .*\n", "", input_text, flags=re.MULTILINE)
+    text = re.sub(r"(SCF_GUESS\s+)\w+", r"\g<1>" + ("RESTART" if restart_file else "ATOMIC"), text, count=1)
+    text = re.sub(r"&RESTART\s+OFF\b", "&RESTART ON\n          BACKUP_COPIES 0", text, count=1)
+    if restart_file:
+        text = re.sub(r"(&DFT\s*\n)", rf"\g<1>    WFN_RESTART_FILE_NAME {restart_file}\n", text, count=1)
+    return text
+
+
+def find_wfn(directory, project=None):
+    """Path of the wavefunction CP2K wrote in directory (of project, if given), or None."""
+    pattern = f"{project}-RESTART.wfn" if project else WFN_PATTERN
+    found = glob.glob(os.path.join(directory, pattern))
+    return os.path.abspath(found[0]) if found else None
+
+
+def scf_summary(output_path, offset=0):
+    """Return (total SCF steps, converged) from a CP2K output file from byte offset on, or (None, False)."""
+    if not os.path.isfile(output_path):
+        return None, False
+    with open(output_path, "rb") as f:
+        f.seek(offset)
+        text = f.read().decode(errors="replace")
+    outer = re.findall(r"outer SCF loop (?:converged in|FAILED to converge after)\s+\d+\s+iterations or\s+(\d+)\s+steps",
+                       text)
+    if outer:
+        steps = int(outer[-1])
+    else:
+        inner = re.findall(r"SCF run converged in\s+(\d+)\s+steps", text)
+        steps = sum(int(n) for n in inner) if inner else None
+    converged = steps is not None and "SCF run NOT converged" not in text and "FAILED to converge" not in text
+    return steps, converged
+
+
+def report_scf_steps(records):
+    """Print mean SCF steps per initial guess (e.g. restart vs atomic); records are (guess, steps)."""
+    for guess in dict.fromkeys(g for g, _ in records):
+        steps = [s for g, s in records if g == guess and s is not None]
+        if steps:
+            print(f"SCF steps with {guess} guess: mean {np.mean(steps):.1f} over {len(steps)} frames "
+                  f"(min {min(steps)}, max {max(steps)})")
+
+
+class WavefunctionSeeder:
+    """
+    JobScheduler hooks seeding each CP2K job directory from its nearest finished neighbour.
+
+    on_start rewrites the job input with SCF_GUESS RESTART from the closest
+    job that finished with a converged wavefunction (ATOMIC if none), and
+    on_finish requeues a seeded job that failed or did not converge with
+    the atomic guess.
+    """
+
+    def __init__(self, input_name="sp.inp", output_name="sp.out"):
+        self.input_name = input_name
+        self.output_name = output_name
+        self.frames = {}  # run_dir -> atoms
+        self.computed = {}  # run_dir -> atoms, jobs with a converged wavefunction
+        self.atomic_only = set()
+        self.seeds = {}  # run_dir -> run_dir of the seed of the current attempt
+        self.records = []  # (guess, SCF steps)
+
+    def add_frame(self, run_dir, atoms, finished=False):
+        self.frames[run_dir] = atoms
+        if finished and scf_summary(os.path.join(run_dir, self.output_name))[1] and find_wfn(run_dir):
+            self.computed[run_dir] = atoms
+
+    def remove_frames(self, run_dirs):
+        """Stop using run_dirs as seeds, e.g. after their jobs were discarded."""
+        for run_dir in run_dirs:
+            self.frames.pop(run_dir, None)
+            self.computed.pop(run_dir, None)
+            self.seeds.pop(run_dir, None)
+            self.atomic_only.discard(run_dir)
+
+    def on_start(self, job):
+        seed, restart_file = None, None
+        if job.run_dir not in self.atomic_only:
+            seed, _ = nearest_frame(self.frames[job.run_dir], self.computed)
+            restart_file = find_wfn(seed) if seed is not None else None
+        self.seeds[job.run_dir] = seed if restart_file else None
+        path = os.path.join(job.run_dir, self.input_name)
+        with open(path, "r") as f:
+            text = f.read()
+        with open(path, "w") as f:
+            f.write(set_scf_guess(text, restart_file))
+
+    def on_finish(self, job, exit_code):
+        steps, converged = scf_summary(os.path.join(job.run_dir, self.output_name))
+        seed = self.seeds.get(job.run_dir)
+        if seed is not None and (exit_code != 0 or not converged):
+            print(f"⚠️ {job.run_dir} failed from the wavefunction of {seed}, requeued with atomic guess", flush=True)
+            self.atomic_only.add(job.run_dir)
+            return True
+        self.records.append(("restart" if seed is not None else "atomic", steps))
+        if exit_code == 0 and converged and find_wfn(job.run_dir):
+            self.computed[job.run_dir] = self.frames[job.run_dir]
+        if seed is not None:
+            print(f"{job.run_dir}: {steps} SCF steps from the wavefunction of {seed}", flush=True)
+        return False
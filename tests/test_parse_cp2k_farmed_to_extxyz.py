@@ -0,0 +1,52 @@
+import os
+import sys
+
+import numpy as np
+from ase import Atoms
+from ase.io import write
+from ase.units import Hartree, Bohr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+from parse_cp2k_farmed_to_extxyz import harvest_run
+
+
+def write_cp2k_output(path, energy, forces, converged=True):
+    lines = []
+    if not converged:
+        lines.append(" *** SCF run NOT converged ***")
+    lines.append(f" ENERGY| Total FORCE_EVAL ( QS ) energy [a.u.]:          {energy:.10f}")
+    lines += ["", " ATOMIC FORCES in [a.u.]", "",
+              " # Atom   Kind   Element          X              Y              Z"]
+    lines += [f"      {i + 1}      1      H     {fx:14.8f} {fy:14.8f} {fz:14.8f}"
+              for i, (fx, fy, fz) in enumerate(forces)]
+    lines += [" SUM OF ATOMIC FORCES          0.0  0.0  0.0", "", ""]
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+
+
+def test_harvest_run_ignores_set_aside_attempts(tmp_path):
+    run_dir = tmp_path / "run_0"
+    run_dir.mkdir()
+    write(run_dir / "structure.xyz", Atoms("H2", positions=[[0, 0, 0], [0, 0, 0.74]]))
+    forces = np.array([[0.01, 0.0, -0.02], [-0.01, 0.0, 0.02]])
+    # The timed-out first attempt did not converge; the retry did
+    write_cp2k_output(run_dir / "sp.out.attempt1", -1.0, forces, converged=False)
+    write_cp2k_output(run_dir / "sp.out", -1.1, forces)
+
+    atoms, reason = harvest_run(str(run_dir))
+
+    assert reason is None
+    assert np.isclose(atoms.info["REF_energy"], -1.1 * Hartree)
+    assert np.allclose(atoms.arrays["REF_forces"], forces * Hartree / Bohr)
+
+
+def test_harvest_run_without_current_output(tmp_path):
+    run_dir = tmp_path / "run_0"
+    run_dir.mkdir()
+    write(run_dir / "structure.xyz", Atoms("H2", positions=[[0, 0, 0], [0, 0, 0.74]]))
+    write_cp2k_output(run_dir / "sp.out.attempt1", -1.0, np.zeros((2, 3)))
+
+    atoms, reason = harvest_run(str(run_dir))
+
+    assert atoms is None
+    assert reason == "missing structure or CP2K output"